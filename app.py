@@ -1,7 +1,11 @@
 import os
+import hmac
 import uuid
 import json
 import re
+import tempfile
+import threading
+import time
 import traceback 
 from urllib.parse import urlparse
 from werkzeug.utils import secure_filename
@@ -14,6 +18,13 @@ from langchain_core.messages import HumanMessage, AIMessage
 import config
 import s3_handler
 import vectorstore_handler
+import streaming_handler
+import embedding_migration
+import history_compactor
+import query_embedding_cache
+import request_profiler
+import retrieval_cache
+import token_counter
 import utils
 
 # --- Flask App Setup ---
@@ -28,6 +39,10 @@ config.check_secret_key()
 app_s3_client = None
 app_vector_store = None
 app_embeddings = None
+# Identical first-turn questions in flight at the same time share one generation
+chat_flights = streaming_handler.SingleFlightRegistry()
+# Running summaries of long conversations, per session_id
+chat_histories = history_compactor.HistoryCompactor()
 
 # --- Initialization Function (Call this before running the app) ---
 def initialize_app():
@@ -48,9 +63,14 @@ def initialize_app():
          print("FATAL: Embeddings model initialization failed. Cannot start application.")
          exit(1)
 
-    # Initialize Vector Store (loads/builds DB and syncs with S3)
-    # This function now handles S3 client needs internally
-    app_vector_store = vectorstore_handler.initialize_vector_store()
+    if config.INDEX_ROLE == "reader":
+        # Read-only replica: serve the newest published index and hot-swap to new versions
+        app_vector_store = vectorstore_handler.initialize_read_replica()
+        threading.Thread(target=_watch_published_index, name="index-watcher", daemon=True).start()
+    else:
+        # Initialize Vector Store (loads/builds DB and syncs with S3)
+        # This function now handles S3 client needs internally
+        app_vector_store = vectorstore_handler.initialize_vector_store()
     if not app_vector_store:
         print("FATAL: Vector Store initialization failed. Cannot start application.")
         exit(1)
@@ -58,6 +78,42 @@ def initialize_app():
     print("--- Application Components Initialized Successfully ---")
 
 
+def _watch_published_index():
+    """Reader role: polls for newly published index versions and swaps them in."""
+    global app_vector_store
+    while True:
+        time.sleep(config.INDEX_POLL_INTERVAL)
+        new_store = vectorstore_handler.refresh_published_index()
+        if new_store is not None:
+            # New requests use the new version; running chats finish on the one they started with
+            app_vector_store = new_store
+
+def _read_only_replica_response():
+    return jsonify({"error": "This server is a read-only index replica. Send uploads to the indexing (writer) process."}), 503
+
+def _is_admin_request():
+    """Admin routes need config.ADMIN_TOKEN in the X-Admin-Token header (and are off when it is unset)."""
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(config.ADMIN_TOKEN) and hmac.compare_digest(token, config.ADMIN_TOKEN)
+
+def _request_profile(kind, start=True):
+    """
+    A RequestProfile when this request is profiled (config.PROFILE_REQUESTS or
+    an admin X-Profile: 1), else None. Streamed responses pass start=False and
+    let request_profiler.profiled_stream start it.
+    """
+    if not config.PROFILE_REQUESTS and not (request.headers.get('X-Profile') == '1' and _is_admin_request()):
+        return None
+    profile = request_profiler.RequestProfile(kind, label=request.path)
+    return profile.start() if start else profile
+
+def _on_embedding_model_switch(new_store):
+    """Embedding migration finished: new requests use the re-embedded store."""
+    global app_vector_store, app_embeddings
+    app_vector_store = new_store
+    app_embeddings = new_store.embeddings
+
+
 # --- Flask Routes ---
 @app.route('/')
 def index():
@@ -89,10 +145,21 @@ def list_files_route():
         traceback.print_exc()
         return jsonify({"error": "An internal server error occurred listing files."}), 500
 
+def _build_s3_key(filename):
+    """S3 key for an uploaded file under the configured prefix."""
+    s3_key = os.path.join(config.S3_PREFIX, filename).replace("\\", "/")
+    # Remove leading slash if prefix is empty, os.path.join might add one
+    if s3_key.startswith('/') and not config.S3_PREFIX:
+         s3_key = s3_key[1:]
+    return s3_key
+
+
 @app.route('/upload_file', methods=['POST'])
 def upload_file_route():
     """Handles file uploads to S3 and immediate embedding."""
     print("Route /upload_file: Received POST request.")
+    if config.INDEX_ROLE == "reader":
+        return _read_only_replica_response()
 
     # --- Check Prerequisites ---
     if not app_s3_client:
@@ -114,82 +181,52 @@ def upload_file_route():
 
     original_filename = secure_filename(file.filename)
     # Construct S3 key using config prefix
-    s3_key = os.path.join(config.S3_PREFIX, original_filename).replace("\\", "/")
-    # Remove leading slash if prefix is empty, os.path.join might add one
-    if s3_key.startswith('/') and not config.S3_PREFIX:
-         s3_key = s3_key[1:]
+    s3_key = _build_s3_key(original_filename)
 
     print(f"  Processing upload for: {original_filename} -> s3://{config.S3_BUCKET_NAME}/{s3_key}")
-
+    profile = _request_profile("upload")
+    if profile:
+        profile.record(s3_key=s3_key)
 
     # --- Upload and Process ---
     try:
         # 1. Upload to S3
-        upload_ok = s3_handler.upload_to_s3(app_s3_client, file, config.S3_BUCKET_NAME, s3_key)
+        with request_profiler.stage(profile, "s3_upload"):
+            upload_ok = s3_handler.upload_to_s3(app_s3_client, file, config.S3_BUCKET_NAME, s3_key)
         if not upload_ok:
             
             return jsonify({"error": "Failed to upload file to S3 storage."}), 500
 
         # 2. Get Metadata (VersionId, LastModified)
-        new_version_id, last_modified = s3_handler.get_s3_object_metadata(
-            app_s3_client, config.S3_BUCKET_NAME, s3_key
-        )
+        with request_profiler.stage(profile, "s3_metadata"):
+            new_version_id, last_modified = s3_handler.get_s3_object_metadata(
+                app_s3_client, config.S3_BUCKET_NAME, s3_key
+            )
         if not new_version_id:
             print("  WARNING: Could not retrieve VersionId from uploaded S3 object. Update checks might be unreliable.")
             # Proceed, but log the warning
 
-        # 3. Process Locally & Prepare Chunks (Download > Load > Split > Metadata)
-        print("  Processing uploaded file for embedding...")
-        new_chunks = vectorstore_handler.process_s3_object(
-             app_s3_client, s3_key, new_version_id, last_modified
-        )
-
-        if not new_chunks:
-            print("  Error: Failed to process the uploaded file into chunks after upload.")
-            return jsonify({"error": f"File uploaded to S3, but failed during local processing/splitting. Check server logs."}), 500
-
-        # --- Database Operations ---
-        print(f"  Updating vector store for key: {s3_key}")
-
-        # 4. Delete Old Chunks (if any exist for this key)
-
-        ids_to_delete = []
+        # 3.-5. Download > Load > Split, then release old chunk references and add the new
+        # chunks (content-addressed, so text already stored under another key is referenced
+        # rather than re-embedded). Large PDFs are embedded page range by page range.
+        print(f"  Processing uploaded file and updating vector store for key: {s3_key}")
         try:
-            where_filter = {config.S3_KEY_METADATA_KEY: s3_key}
-            existing_data = app_vector_store.get(where=where_filter, include=[])
-            if existing_data and existing_data.get('ids'):
-                ids_to_delete = existing_data['ids']
-                if ids_to_delete:
-                    print(f"    Found {len(ids_to_delete)} existing chunk IDs. Deleting old version...")
-                    app_vector_store.delete(ids=ids_to_delete)
-                    print("    Old chunk deletion successful.")
-            else:
-                 print("    No existing chunks found for this key (first upload or previous deletion).")
-        except Exception as e:
-            print(f"    WARNING: Error querying/deleting existing chunks for {s3_key}: {e}. Proceeding to add new chunks.")
-            
-
-        # 5. Add New Chunks
-        print(f"  Adding {len(new_chunks)} new chunks to ChromaDB...")
-        try:
-            app_vector_store.add_documents(documents=new_chunks) # Embeddings are implicitly handled by Chroma if initialized with them
-            print("  Chunk addition successful.")
-
-            # 6. Persist Changes Immediately
-            try:
-                print("  Persisting ChromaDB changes after upload...")
-                app_vector_store.persist()
-                print("  ChromaDB persisted.")
-            except Exception as e:
-                print(f"  WARNING: Failed to persist ChromaDB changes immediately after upload: {e}")
-                
+            with request_profiler.stage(profile, "download_parse_embed_write"):
+                chunks_added = vectorstore_handler.index_s3_object(
+                    app_vector_store, app_s3_client, s3_key, new_version_id, last_modified
+                )
+            if profile:
+                profile.record(chunks_added=chunks_added)
+            if not chunks_added:
+                print("  Error: Failed to process the uploaded file into chunks after upload.")
+                return jsonify({"error": f"File uploaded to S3, but failed during local processing/splitting. Check server logs."}), 500
 
             return jsonify({
                 "message": f"File '{original_filename}' uploaded and processed successfully.",
                 "filename": original_filename,
                 "s3_key": s3_key,
                 "s3_url": s3_handler.construct_public_s3_url(s3_key),
-                "chunks_added": len(new_chunks)
+                "chunks_added": chunks_added
             }), 201 
 
         except Exception as e:
@@ -201,6 +238,139 @@ def upload_file_route():
         print(f"  Unexpected error during file upload process for {original_filename}: {e}")
         traceback.print_exc()
         return jsonify({"error": "An internal server error occurred during upload."}), 500
+    finally:
+        if profile:
+            profile.finish()
+
+
+@app.route('/upload_files', methods=['POST'])
+def upload_files_route():
+    """
+    Handles many files in one request: parallel S3 uploads, concurrent parsing,
+    one logged update for all replaced keys (batched embedding, one release) and a single persist.
+    Returns a per-file result so partial failures are visible.
+    """
+    print("Route /upload_files: Received POST request.")
+    if config.INDEX_ROLE == "reader":
+        return _read_only_replica_response()
+
+    # --- Check Prerequisites ---
+    if not app_s3_client:
+        return jsonify({"error": "S3 service not available for upload"}), 503
+    if not app_vector_store:
+        return jsonify({"error": "Vector database not ready for upload"}), 503
+    if not app_embeddings: 
+         return jsonify({"error": "Embeddings model not ready"}), 503
+
+    # The per-file limit stays MAX_CONTENT_LENGTH; the request as a whole may be larger
+    request.max_content_length = config.MAX_BATCH_CONTENT_LENGTH
+    files = [f for f in request.files.getlist('files') if f and f.filename]
+    if not files:
+        return jsonify({"error": "No files in the request (expected form field 'files')"}), 400
+    if len(files) > config.MAX_FILES_PER_BATCH_UPLOAD:
+        return jsonify({"error": f"Too many files. Maximum per request: {config.MAX_FILES_PER_BATCH_UPLOAD}"}), 400
+
+    results = {} # s3_key -> per-file result
+    order = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # --- 1. Validate and stage files locally ---
+        staged = {} # s3_key -> local path
+        for index, file in enumerate(files):
+            original_filename = secure_filename(file.filename)
+            s3_key = _build_s3_key(original_filename)
+            result = {"filename": original_filename, "s3_key": s3_key}
+            order.append(s3_key)
+            results[s3_key] = result
+            if not utils.allowed_file(file.filename):
+                result["error"] = f"File type not allowed. Allowed: {', '.join(config.ALLOWED_EXTENSIONS)}"
+                continue
+            if s3_key in staged:
+                result["error"] = "Duplicate filename in this batch."
+                continue
+            local_path = os.path.join(temp_dir, f"{index:05d}_{original_filename}")
+            file.save(local_path)
+            if os.path.getsize(local_path) > config.MAX_CONTENT_LENGTH:
+                result["error"] = f"File exceeds the {config.MAX_CONTENT_LENGTH // (1024 * 1024)} MB per-file limit."
+                continue
+            staged[s3_key] = local_path
+        print(f"  {len(staged)} of {len(files)} files passed validation.")
+
+        try:
+            # --- 2. Upload to S3 in parallel ---
+            uploaded = {} # s3_key -> {'path', 'VersionId', 'LastModified'}
+            for s3_key, ok, version_id, last_modified in s3_handler.upload_s3_objects_concurrently(
+                    app_s3_client, config.S3_BUCKET_NAME, staged):
+                if not ok:
+                    results[s3_key]["error"] = "Failed to upload file to S3 storage."
+                    continue
+                if not version_id:
+                    print(f"  WARNING: Could not retrieve VersionId for {s3_key}. Update checks might be unreliable.")
+                uploaded[s3_key] = {'path': staged[s3_key], 'VersionId': version_id, 'LastModified': last_modified}
+                results[s3_key]["s3_url"] = s3_handler.construct_public_s3_url(s3_key)
+
+            # --- 3. Parse concurrently from the local copies (no re-download) ---
+            chunks_by_key = {}
+            for s3_key, chunks in vectorstore_handler.process_local_files(uploaded, app_s3_client):
+                if chunks:
+                    chunks_by_key[s3_key] = chunks
+                else:
+                    results[s3_key]["error"] = "File uploaded to S3, but failed during local processing/splitting."
+
+            # --- 4. One logged update for all replaced keys: batched embed, one release, single persist ---
+            if chunks_by_key:
+                all_chunks = [chunk for chunks in chunks_by_key.values() for chunk in chunks]
+                print(f"  Replacing chunks for {len(chunks_by_key)} keys with {len(all_chunks)} new chunks...")
+                try:
+                    removed, _ = vectorstore_handler.replace_documents(app_vector_store, chunks_by_key.keys(), all_chunks)
+                    print(f"  Batch update complete: {removed} old chunks removed, {len(all_chunks)} added.")
+                    for s3_key, chunks in chunks_by_key.items():
+                        results[s3_key]["chunks_added"] = len(chunks)
+                except Exception as e:
+                    print(f"  ERROR adding batch chunks to ChromaDB: {e}")
+                    traceback.print_exc()
+                    for s3_key in chunks_by_key:
+                        results[s3_key]["error"] = f"File uploaded, but failed during embedding/database update: {e}"
+
+        except Exception as e:
+            print(f"  Unexpected error during batch upload: {e}")
+            traceback.print_exc()
+            for s3_key in order:
+                results[s3_key].setdefault("error", "An internal server error occurred during upload.")
+
+    file_results = []
+    for s3_key in order:
+        result = results[s3_key]
+        result["status"] = "error" if "error" in result else "ok"
+        file_results.append(result)
+    succeeded = sum(1 for r in file_results if r["status"] == "ok")
+    print(f"Route /upload_files: {succeeded}/{len(file_results)} files processed successfully.")
+
+    status_code = 201 if succeeded == len(file_results) else (207 if succeeded else 500)
+    return jsonify({
+        "message": f"{succeeded} of {len(file_results)} files uploaded and processed successfully.",
+        "succeeded": succeeded,
+        "failed": len(file_results) - succeeded,
+        "files": file_results,
+    }), status_code
+
+
+def _format_sources_for_event(source_documents):
+    """Builds the unique [{url, filename}] list sent in the 'sources' SSE event."""
+    source_data_for_event = []
+    seen_urls = set()
+    for doc in source_documents or []:
+        # Deduplicated chunks list every file that contains them; fall back to the stored URL
+        urls = doc.metadata.get(config.SOURCE_URLS_METADATA_KEY) or [doc.metadata.get(config.S3_URL_METADATA_KEY)]
+        for url in urls:
+            if url and url not in seen_urls:
+                try:
+                    filename = os.path.basename(urlparse(url).path) or "Source Document"
+                except:
+                    filename = "Source Document" # Fallback
+                source_data_for_event.append({"url": url, "filename": filename})
+                seen_urls.add(url)
+    return source_data_for_event
 
 
 @app.route('/chat', methods=['GET'])
@@ -228,9 +398,28 @@ def chat_stream_route():
              yield f"event: end\ndata: {{}}\n\n"
         return Response(error_stream_msg(), mimetype='text/event-stream')
 
+    # Optional retrieval scope: repeated `scope_key` params and/or a `scope_prefix`
+    requested_scope_keys = [k for k in request.args.getlist('scope_key') if k]
+    scope_prefix = request.args.get('scope_prefix', '').strip()
+    scope_keys = None
+    if requested_scope_keys or scope_prefix:
+        scope_keys = vectorstore_handler.chunk_index.resolve_scope(requested_scope_keys, scope_prefix)
+        if not scope_keys:
+            print(f"  Error: Scope matched no indexed documents (keys={requested_scope_keys}, prefix='{scope_prefix}').")
+            def error_stream_scope():
+                 yield f"event: error\ndata: {json.dumps({'error': 'No indexed documents match the requested scope'})}\n\n"
+                 yield f"event: end\ndata: {{}}\n\n"
+            return Response(error_stream_scope(), mimetype='text/event-stream')
+
     session_id = session.get('session_id', 'N/A') 
-    print(f"  Session {session_id}: Received message: '{user_message[:50]}...', Use Reasoning: {use_reasoning}")
+    print(f"  Session {session_id}: Received message: '{user_message[:50]}...', Use Reasoning: {use_reasoning}, "
+          f"Scope: {len(scope_keys) if scope_keys else 'all'} key(s)")
+
 
+    profile = _request_profile("chat", start=False)
+    if profile:
+        profile.record(session_id=session_id, message=user_message, use_reasoning=use_reasoning,
+                       scope_keys=len(scope_keys) if scope_keys else None)
 
     # --- Generator Function for the Stream ---
     def generate_response_stream(message, reasoning_flag):
@@ -240,72 +429,121 @@ def chat_stream_route():
         request_complete = False
         chain_created = False
         error_occurred = False
+        client_gone = False
+        handler = None
+        flight = None
 
         try:
-            # 1. Load History from Session
+            # 1. Load History from Session (reasoning blocks never go back into prompts)
             history_dicts = session.get('chat_history', [])
             chat_history_messages = [
-                HumanMessage(content=msg['content']) if msg.get('type') == 'human' else AIMessage(content=msg['content'])
+                HumanMessage(content=msg['content']) if msg.get('type') == 'human'
+                else AIMessage(content=streaming_handler.strip_thinking(msg['content']))
                 for msg in history_dicts
             ]
-            print(f"  Session {session_id}: Loaded {len(chat_history_messages)} history messages for chain.")
-
-            # 2. Select LLM and Get Chain
+            # Long histories go into prompts as a running summary plus the last few turns
+            prompt_history = chat_histories.compact(session_id, chat_history_messages)
+            print(f"  Session {session_id}: Loaded {len(chat_history_messages)} history messages "
+                  f"({len(prompt_history)} in prompts) for chain.")
+            if profile:
+                profile.mark("history_loaded")
+
+            # 2. Select LLM and join (or lead) a generation
             llm_to_use = config.REASONING_LLM_MODEL if reasoning_flag else config.DEFAULT_LLM_MODEL
-            chain = vectorstore_handler.get_chat_chain(app_vector_store, llm_to_use, chat_history_messages)
-
-            if not chain:
-                yield f"event: error\ndata: {json.dumps({'error': 'Failed to create chat processing chain.'})}\n\n"
-                error_occurred = True
-                return 
-
+            thinking_budget = config.THINKING_TOKEN_BUDGET if reasoning_flag else None
+            # Only first-turn questions are coalesced; with history the answer depends on the session
+            key = None
+            if not chat_history_messages:
+                key = streaming_handler.flight_key(message, llm_to_use, vectorstore_handler.corpus_version, scope_keys)
+            flight, is_leader = chat_flights.join(key, llm_to_use, thinking_budget)
+            handler = flight.handler
+
+            if profile:
+                profile.record(model=llm_to_use, flight_leader=is_leader)
+            if is_leader:
+                # Held until the chain finishes: a reader keeps this index version open meanwhile
+                chain_store = vectorstore_handler.acquire_index(app_vector_store)
+                try:
+                    with request_profiler.stage(profile, "chain_setup"):
+                        chain = vectorstore_handler.get_chat_chain(chain_store, llm_to_use, prompt_history, scope_keys,
+                                                                   question=message)
+                except Exception:
+                    vectorstore_handler.release_index(chain_store)
+                    raise
+
+                if not chain:
+                    vectorstore_handler.release_index(chain_store)
+                    # Requests that already joined this flight must not wait forever
+                    handler.event_queue.put(("error", RuntimeError("Failed to create chat processing chain.")))
+                    handler.event_queue.put(("done", None))
+                    chat_flights.finish(flight)
+                    yield f"event: error\ndata: {json.dumps({'error': 'Failed to create chat processing chain.'})}\n\n"
+                    error_occurred = True
+                    return 
+
+                handler.num_ctx = (chain.metadata or {}).get("num_ctx") # A forced answer reuses the chain's context window
+                print(f"  Session {session_id}: Running chain with model {llm_to_use} in background...")
+
+                # 3. Run the chain in a worker thread; its callback handler feeds tokens to every listener
+                worker = threading.Thread(
+                    target=_run_flight_on_index,
+                    args=(chain_store, flight, chain, {"question": message}),
+                    daemon=True,
+                )
+                worker.start()
+                if profile:
+                    profile.track(worker)
+            else:
+                print(f"  Session {session_id}: Identical question already in flight; "
+                      f"sharing its stream ({flight.listeners} listeners).")
             chain_created = True
-            print(f"  Session {session_id}: Invoking chain.stream() with model {llm_to_use}...")
-
-            # 3. Stream Response from Chain
-            full_response_object = {'answer': '', 'source_documents': []} 
-            processed_sources = False 
-
-            for chunk in chain.stream({"question": message}):
-                
-                if "source_documents" in chunk and chunk["source_documents"] and not processed_sources:
-                    final_sources = chunk["source_documents"]
-                    full_response_object['source_documents'] = final_sources 
-                    source_data_for_event = []
-                    seen_urls = set()
-                    for doc in final_sources:
-                        # Use the configured metadata key for the URL
-                        url = doc.metadata.get(config.S3_URL_METADATA_KEY)
-                        if url and url not in seen_urls:
-                            try:
-                                filename = os.path.basename(urlparse(url).path) or "Source Document"
-                            except:
-                                filename = "Source Document" # Fallback
-                            source_data_for_event.append({"url": url, "filename": filename})
-                            seen_urls.add(url)
 
+            thinking_open = False
+            for kind, payload in streaming_handler.iter_stream_events(handler):
+                if profile:
+                    profile.mark(f"first_{kind}")
+                if kind == "sources" and not final_sources_data:
+                    if profile:
+                        _record_prompt_profile(profile, prompt_history, message, payload)
+                    source_data_for_event = _format_sources_for_event(payload)
                     if source_data_for_event:
                         final_sources_data = source_data_for_event # Store formatted sources for history update
                         yield f"event: sources\ndata: {json.dumps(source_data_for_event)}\n\n"
                         print(f"  Session {session_id}: Sent 'sources' event with {len(source_data_for_event)} unique items.")
-                        processed_sources = True # Prevent sending sources again
-
-                # Check for answer chunk
-                if "answer" in chunk:
-                    answer_chunk = chunk["answer"]
-                    if answer_chunk:
-                        accumulated_answer += answer_chunk
-                        # Send text chunk as 'data' event (default event type)
-                        yield f"data: {json.dumps({'chunk': answer_chunk})}\n\n"
-                        # Optional small delay for smoother streaming effect on client
-                        # import time
-                        # time.sleep(0.01)
+
+                elif kind == "thinking":
+                    thinking_open = True
+                    yield f"event: thinking\ndata: {json.dumps({'chunk': payload})}\n\n"
+
+                elif kind == "thinking_end" or (kind == "answer" and thinking_open):
+                    if thinking_open:
+                        thinking_open = False
+                        yield (f"event: thinking_end\ndata: "
+                               f"{json.dumps({'truncated': handler.thinking_truncated, 'tokens': handler.thinking_tokens})}\n\n")
+                    if kind == "answer":
+                        accumulated_answer += payload
+                        yield f"data: {json.dumps({'chunk': payload})}\n\n"
+
+                elif kind == "answer":
+                    accumulated_answer += payload
+                    # Send text chunk as 'data' event (default event type)
+                    yield f"data: {json.dumps({'chunk': payload})}\n\n"
+
+                elif kind == "error":
+                    raise payload
 
             # Mark as complete after the stream finishes naturally
+            if profile:
+                profile.mark("stream_done")
             request_complete = True
-            print(f"  Session {session_id}: Stream finished. Full Answer Length: {len(accumulated_answer)}")
-            full_response_object['answer'] = accumulated_answer
-
+            accumulated_answer = accumulated_answer.strip()
+            print(f"  Session {session_id}: Stream finished. Full Answer Length: {len(accumulated_answer)}, "
+                  f"Thinking Tokens: {handler.thinking_tokens}{' (truncated)' if handler.thinking_truncated else ''}")
+
+        except GeneratorExit:
+            # Client went away; the generation stops once its last listener has left
+            client_gone = True
+            raise
         except Exception as e:
             error_occurred = True
             print(f"  Session {session_id}: ERROR during streaming generation: {e}")
@@ -313,7 +551,11 @@ def chat_stream_route():
             # Send an error event to the client
             yield f"event: error\ndata: {json.dumps({'error': 'An error occurred during response generation.'})}\n\n"
         finally:
+            if flight:
+                chat_flights.leave(flight)
+
             # --- Update Session History (only if successful and got an answer) ---
+            # Only the final answer is stored; thinking text would bloat every later prompt.
             if request_complete and accumulated_answer and not error_occurred:
             
                 current_history = session.get('chat_history', [])
@@ -329,6 +571,9 @@ def chat_stream_route():
                 session['chat_history'] = current_history
                 session.modified = True 
                 print(f"  Session {session_id}: Updated history with Human message and AI response (length {len(accumulated_answer)}).")
+                # Fold older turns into the summary off the request path, ready for the next turn
+                chat_history_messages.extend([HumanMessage(content=message), AIMessage(content=accumulated_answer)])
+                chat_histories.schedule(session_id, chat_history_messages)
             elif error_occurred:
                 print(f"  Session {session_id}: History not updated due to error during generation.")
             elif not accumulated_answer and chain_created:
@@ -338,10 +583,88 @@ def chat_stream_route():
 
 
             # --- Send End Signal ---
-           
-            print(f"  Session {session_id}: Sending 'end' event.")
-            yield f"event: end\ndata: {json.dumps({'model_used': llm_to_use if llm_to_use else 'N/A'})}\n\n"
-    return Response(stream_with_context(generate_response_stream(user_message, use_reasoning)), mimetype='text/event-stream')
+            if not client_gone:
+                print(f"  Session {session_id}: Sending 'end' event.")
+                yield f"event: end\ndata: {json.dumps({'model_used': llm_to_use if llm_to_use else 'N/A'})}\n\n"
+    stream = generate_response_stream(user_message, use_reasoning)
+    if profile:
+        stream = request_profiler.profiled_stream(profile, stream)
+    response = Response(stream_with_context(stream), mimetype='text/event-stream')
+    if profile:
+        response.call_on_close(profile.finish) # Also when the stream is never iterated
+    return response
+
+
+def _run_flight_on_index(store, flight, chain, inputs):
+    """Worker thread of a leader: runs the chain, then releases the index it was built on."""
+    try:
+        streaming_handler.run_flight_in_background(chat_flights, flight, chain, inputs)
+    finally:
+        vectorstore_handler.release_index(store)
+
+
+def _record_prompt_profile(profile, prompt_history, question, docs):
+    """Retrieved chunk IDs and the token counts of the answer prompt built from them."""
+    history_text = history_compactor.format_chat_history(prompt_history)
+    context_text = "\n\n".join(f"DOCUMENT: {doc.page_content}\nSOURCE: {doc.metadata.get(config.S3_URL_METADATA_KEY)}"
+                               for doc in docs)
+    profile.record(
+        chunk_ids=[doc.metadata.get(config.CHUNK_ID_METADATA_KEY) for doc in docs],
+        prompt_tokens={
+            "history": token_counter.count_tokens(history_text),
+            "context": token_counter.count_tokens(context_text),
+            "question": token_counter.count_tokens(question),
+            "qa_prompt": token_counter.count_tokens(vectorstore_handler.QA_PROMPT_TEMPLATE.format(
+                chat_history=history_text, context=context_text, question=question)),
+        },
+    )
+
+
+@app.route('/admin/embedding_migration', methods=['GET', 'POST'])
+def embedding_migration_route():
+    """
+    GET: progress and old-vs-new retrieval comparison of the current/last migration.
+    POST {"model": "<ollama embedding model>"}: re-embeds the index with that
+    model in the background and switches retrieval to it when done.
+    """
+    if not _is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    if config.INDEX_ROLE == "reader":
+        return _read_only_replica_response()
+
+    if request.method == 'GET':
+        migration = embedding_migration.get_migration()
+        state = vectorstore_handler.embedding_state or {}
+        return jsonify({
+            "active_model": state.get("model"),
+            "migration": migration.to_dict() if migration else None,
+        }), 200
+
+    data = request.get_json(silent=True) or {}
+    target_model = (data.get('model') or '').strip()
+    if not target_model:
+        return jsonify({"error": "Missing 'model'"}), 400
+    print(f"Route /admin/embedding_migration: Starting migration to '{target_model}'.")
+    migration, error = embedding_migration.start_migration(target_model, on_switch=_on_embedding_model_switch)
+    if error:
+        return jsonify({"error": error}), 409
+    return jsonify(migration.to_dict()), 202
+
+
+@app.route('/admin/query_cache', methods=['GET'])
+def query_cache_route():
+    """Hit rate, coalesced misses, batching state and batch sizes of this worker's query embedding cache."""
+    if not _is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(query_embedding_cache.query_cache.stats()), 200
+
+
+@app.route('/admin/retrieval_cache', methods=['GET'])
+def retrieval_cache_route():
+    """Hit rate, size and invalidation counters of this worker's retrieval result cache."""
+    if not _is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(retrieval_cache.result_cache.stats()), 200
 
 
 @app.route('/new_session', methods=['POST'])
@@ -349,6 +672,7 @@ def new_session_route():
     """Clears the chat history and assigns a new session ID."""
     session_id_before = session.get('session_id', 'N/A')
     history_len_before = len(session.get('chat_history', []))
+    chat_histories.forget(session_id_before)
 
     # Clear history and generate new session ID
     session.pop('chat_history', None)
@@ -0,0 +1,94 @@
+# benchmarks/bench_chunking.py
+"""
+Compares the two chunkers on a local corpus:
+
+  recursive: RecursiveCharacterTextSplitter (CHUNK_SIZE / CHUNK_OVERLAP characters)
+  structure: structure_splitter.StructureAwareSplitter (CHUNK_TOKENS / CHUNK_OVERLAP_TOKENS)
+
+Every file is loaded once with the app's loaders; both chunkers then split
+the same pages/slides and every chunk is embedded.
+
+Usage (from the project root):
+    python benchmarks/bench_chunking.py path/to/corpus [--embeddings ollama[:model] | hashing]
+
+Reports chunk count, stored tokens (and their ratio to the extracted text,
+i.e. the overlap duplication), mean chunk size, split time and embedding
+time per chunker, and the reduction achieved by the structure splitter.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import token_counter
+import vectorstore_handler
+from eval_retrieval import HashingEmbeddings, _corpus_files
+
+
+def _embed_all(embeddings, texts):
+    start = time.perf_counter()
+    for offset in range(0, len(texts), config.EMBED_BATCH_SIZE):
+        embeddings.embed_documents(texts[offset:offset + config.EMBED_BATCH_SIZE])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus_dir", help="Directory of PDF/PPT/PPTX files")
+    parser.add_argument("--embeddings", default="ollama", help="'ollama[:model]' (default) or 'hashing'")
+    args = parser.parse_args()
+
+    files = _corpus_files(args.corpus_dir)
+    if not files:
+        print(f"No supported files under {args.corpus_dir}.")
+        return 1
+    if args.embeddings == "hashing":
+        embeddings = HashingEmbeddings()
+    else:
+        _, _, model = args.embeddings.partition(":")
+        embeddings = vectorstore_handler.get_embeddings_for_model(model or config.EMBEDDING_MODEL)
+        if embeddings is None:
+            return 1
+
+    print(f"Loading {len(files)} files...")
+    pages = []
+    for s3_key, path in files.items():
+        pages.extend(vectorstore_handler._load_document(path, s3_key))
+    source_tokens = sum(token_counter.count_tokens(page.page_content) for page in pages)
+    print(f"  {len(pages)} pages/slides, {source_tokens} tokens of extracted text.")
+
+    results = {}
+    for name in ("recursive", "structure"):
+        splitter = vectorstore_handler.get_text_splitter(name)
+        start = time.perf_counter()
+        chunks = splitter.split_documents(pages)
+        split_seconds = time.perf_counter() - start
+        texts = [chunk.page_content for chunk in chunks]
+        stored_tokens = sum(token_counter.count_tokens(text) for text in texts)
+        print(f"  Embedding {len(texts)} '{name}' chunks with '{embeddings.model}'...")
+        results[name] = {
+            "chunks": len(chunks),
+            "tokens": stored_tokens,
+            "split_s": split_seconds,
+            "embed_s": _embed_all(embeddings, texts),
+        }
+
+    header = f"{'splitter':<10} {'chunks':>7} {'tokens':>9} {'x text':>7} {'tok/chunk':>10} {'split s':>8} {'embed s':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<10} {r['chunks']:>7} {r['tokens']:>9} {r['tokens'] / max(1, source_tokens):>7.2f} "
+              f"{r['tokens'] / max(1, r['chunks']):>10.0f} {r['split_s']:>8.2f} {r['embed_s']:>8.2f}")
+    print("-" * len(header))
+    before, after = results["recursive"], results["structure"]
+    for label, field in (("Chunk count", "chunks"), ("Stored tokens", "tokens"), ("Embedding time", "embed_s")):
+        reduction = (1 - after[field] / before[field]) * 100 if before[field] else 0
+        print(f"{label} reduction: {reduction:.0f}%")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# benchmarks/bench_mmr.py
+"""
+Times retrieval_handler.mmr_select (MMR + per-source cap) on synthetic
+candidate pools of the sizes the retriever fetches.
+
+Usage (from the project root):
+    python benchmarks/bench_mmr.py [--pools 20,50,100] [--dim 768] [--repeat 2000]
+
+Candidates are random vectors spread over a handful of source files, with
+runs of near-identical vectors (consecutive pages) mixed in.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import config
+from retrieval_handler import mmr_select
+
+
+def _pool(rng, size, dim, sources):
+    base = rng.normal(size=(size, dim)).astype(np.float32)
+    # Every third candidate is a near-copy of the one before it, like overlapping chunks of one page
+    base[1::3] = base[0:size - 1:3] + rng.normal(scale=0.05, size=(len(base[1::3]), dim))
+    source_ids = [f"notes/lecture{i * sources // size}.pdf" for i in range(size)]
+    return rng.normal(size=dim).astype(np.float32), base, source_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pools", default="20,50,100", help="Comma-separated candidate pool sizes")
+    parser.add_argument("--dim", type=int, default=768, help="Embedding dimension (nomic-embed-text: 768)")
+    parser.add_argument("--sources", type=int, default=6, help="Source files the candidates come from")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    header = f"{'pool':>6} {'k':>4} {'lambda':>7} {'cap':>4} {'mean us':>9} {'p99 us':>9} {'sources in top k':>17}"
+    print(header)
+    print("-" * len(header))
+    for size in [int(p) for p in args.pools.split(",")]:
+        query, vectors, source_ids = _pool(rng, size, args.dim, args.sources)
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            picked = mmr_select(query, vectors, config.RETRIEVER_K, config.MMR_LAMBDA,
+                                source_ids, config.MMR_MAX_PER_SOURCE)
+            timings.append((time.perf_counter() - start) * 1e6)
+        timings.sort()
+        distinct = len({source_ids[i] for i in picked})
+        print(f"{size:>6} {config.RETRIEVER_K:>4} {config.MMR_LAMBDA:>7} {config.MMR_MAX_PER_SOURCE:>4} "
+              f"{sum(timings) / len(timings):>9.1f} {timings[int(len(timings) * 0.99)]:>9.1f} {distinct:>17}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
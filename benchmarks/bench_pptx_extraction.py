@@ -0,0 +1,89 @@
+# benchmarks/bench_pptx_extraction.py
+"""
+Compares PPTX parsing before/after the native slide extractor.
+
+  before: UnstructuredFileLoader(mode="elements") -> RecursiveCharacterTextSplitter
+  after:  pptx_extractor.load_pptx              -> RecursiveCharacterTextSplitter
+
+Usage (from the project root):
+    python benchmarks/bench_pptx_extraction.py path/to/decks [--repeat 3]
+
+Reports per-deck and total parse time, loaded document count and chunk count.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+import config
+import pptx_extractor
+
+
+def _splitter():
+    return RecursiveCharacterTextSplitter(
+        chunk_size=config.CHUNK_SIZE,
+        chunk_overlap=config.CHUNK_OVERLAP,
+        length_function=len,
+        add_start_index=True,
+    )
+
+
+def _load_unstructured_elements(path):
+    # Imported lazily so the import cost is part of the first "before" measurement, as in the app
+    from langchain_community.document_loaders import UnstructuredFileLoader
+    return UnstructuredFileLoader(path, mode="elements").load()
+
+
+def _measure(load_fn, path, repeat):
+    timings = []
+    docs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        docs = load_fn(path)
+        timings.append(time.perf_counter() - start)
+    chunks = _splitter().split_documents(docs)
+    return statistics.median(timings), len(docs), len(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("deck_dir", help="Directory containing .pptx files")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per deck (median is reported)")
+    args = parser.parse_args()
+
+    decks = sorted(
+        os.path.join(args.deck_dir, name) for name in os.listdir(args.deck_dir)
+        if name.lower().endswith(".pptx")
+    )
+    if not decks:
+        print(f"No .pptx files found in {args.deck_dir}")
+        return 1
+
+    header = f"{'deck':<40} {'before s':>9} {'docs':>6} {'chunks':>7} | {'after s':>9} {'docs':>6} {'chunks':>7} {'speedup':>8}"
+    print(header)
+    print("-" * len(header))
+    totals = {"before": [0.0, 0, 0], "after": [0.0, 0, 0]}
+    for path in decks:
+        before = _measure(_load_unstructured_elements, path, args.repeat)
+        after = _measure(pptx_extractor.load_pptx, path, args.repeat)
+        for label, result in (("before", before), ("after", after)):
+            for i, value in enumerate(result):
+                totals[label][i] += value
+        speedup = before[0] / after[0] if after[0] else float("inf")
+        print(f"{os.path.basename(path)[:40]:<40} {before[0]:>9.3f} {before[1]:>6} {before[2]:>7} | "
+              f"{after[0]:>9.3f} {after[1]:>6} {after[2]:>7} {speedup:>7.1f}x")
+
+    print("-" * len(header))
+    b, a = totals["before"], totals["after"]
+    print(f"{'TOTAL':<40} {b[0]:>9.3f} {b[1]:>6} {b[2]:>7} | {a[0]:>9.3f} {a[1]:>6} {a[2]:>7} "
+          f"{(b[0] / a[0] if a[0] else float('inf')):>7.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
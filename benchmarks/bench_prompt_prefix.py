@@ -0,0 +1,143 @@
+# benchmarks/bench_prompt_prefix.py
+"""
+Measures Ollama prefill (prompt evaluation) time for a simulated multi-turn
+chat session under two prompt layouts:
+
+  before: condense prompt with its own preamble, QA prompt with the instructions
+  after:  both prompts start with CHAT_PROMPT_PREFIX (instructions + history),
+          so the condense call, the answer call and the next turn share a prefix
+
+Each turn sends the condense prompt (from the second turn on) and the QA
+prompt with fresh retrieved context, as get_chat_chain does. Generation is
+capped at one token so only prefill is measured. Both layouts use the same
+num_ctx, so only the layout differs.
+
+Usage (from the project root, with Ollama running):
+    python benchmarks/bench_prompt_prefix.py [--model qwen2.5:7b] [--turns 8] [--num-ctx 8192]
+
+Reports prompt tokens sent, tokens actually evaluated and prefill time per layout.
+"""
+import os
+import sys
+import argparse
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ollama
+
+import config
+import token_counter
+import vectorstore_handler
+
+# The condense prompt as it was before the shared prefix
+LEGACY_CONDENSE_TEMPLATE = """Given the conversation history and a new input from the user, create a standalone question that captures the user's core intent for information retrieval.
+
+If the new input is a simple greeting, confirmation ("ok", "thanks"), or casual chat that doesn't require retrieving documents, return it unchanged.
+If it's a follow-up question related to the topic (e.g., cryptography), reformulate it to be self-contained, incorporating necessary context from the history. Make it suitable for querying a vector database.
+
+Conversation History:
+{chat_history}
+
+New Input: {question}
+
+Standalone question (or unchanged input if casual):"""
+
+_QUESTIONS = [
+    "What is the difference between symmetric and asymmetric encryption?",
+    "How does the Diffie-Hellman key exchange work?",
+    "Why is ECB mode considered insecure?",
+    "What does a MAC protect against that a hash does not?",
+    "Explain how RSA signatures are verified.",
+    "What is a nonce and why must it never repeat in GCM?",
+    "How do certificate chains establish trust in TLS?",
+    "What makes SHA-1 unsuitable for new designs?",
+]
+_SENTENCES = [
+    "The block cipher processes fixed-size blocks of plaintext under a secret key.",
+    "A key exchange lets two parties agree on a shared secret over a public channel.",
+    "Modes of operation define how a block cipher is applied to messages longer than one block.",
+    "Message authentication codes bind a tag to a message using a shared secret key.",
+    "Public-key signatures let anyone verify a message with the signer's public key.",
+    "Collision resistance means it is infeasible to find two inputs with the same hash.",
+]
+
+
+def _filler(rng, sentences):
+    return " ".join(rng.choice(_SENTENCES) for _ in range(sentences))
+
+
+def _context(rng, k):
+    return "\n\n----------\n\n".join(
+        f"DOCUMENT: {_filler(rng, 12)}\nSOURCE: {config.S3_BASE_URL}/notes/lecture{rng.randint(1, 20)}.pdf"
+        for _ in range(k)
+    )
+
+
+def _history_text(turns):
+    return "\n".join(f"Human: {q}\nAssistant: {a}" for q, a in turns)
+
+
+def _prefill(client, model, prompt, num_ctx):
+    response = client.chat(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        options={"num_ctx": num_ctx, "num_predict": 1, "temperature": 0},
+    )
+    return response.prompt_eval_count or 0, (response.prompt_eval_duration or 0) / 1e9
+
+
+def _run_session(client, model, condense_template, qa_template, turns, num_ctx, seed):
+    rng = random.Random(seed)
+    # An unrelated prompt first, so no prefix is cached from an earlier run
+    _prefill(client, model, f"Reset {seed}: {_filler(rng, 3)}", num_ctx)
+    history = []
+    totals = {"calls": 0, "sent_tokens": 0, "evaluated_tokens": 0, "seconds": 0.0}
+    for turn in range(turns):
+        question = _QUESTIONS[turn % len(_QUESTIONS)]
+        prompts = []
+        if history:
+            prompts.append(condense_template.format(chat_history=_history_text(history), question=question))
+        prompts.append(qa_template.format(chat_history=_history_text(history), context=_context(rng, config.RETRIEVER_K),
+                                          question=question))
+        for prompt in prompts:
+            evaluated, seconds = _prefill(client, model, prompt, num_ctx)
+            totals["calls"] += 1
+            totals["sent_tokens"] += token_counter.count_tokens(prompt)
+            totals["evaluated_tokens"] += evaluated
+            totals["seconds"] += seconds
+        history.append((question, _filler(rng, 6)))
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=config.DEFAULT_LLM_MODEL)
+    parser.add_argument("--turns", type=int, default=8, help="Turns in the simulated session")
+    parser.add_argument("--num-ctx", type=int, default=8192)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    client = ollama.Client()
+    layouts = [
+        ("before", LEGACY_CONDENSE_TEMPLATE, vectorstore_handler.QA_PROMPT_TEMPLATE),
+        ("after", vectorstore_handler.CONDENSE_QUESTION_PROMPT_TEMPLATE, vectorstore_handler.QA_PROMPT_TEMPLATE),
+    ]
+    header = f"{'layout':<8} {'calls':>6} {'sent tok':>9} {'eval tok':>9} {'prefill s':>10} {'s/call':>8}"
+    print(f"Model {args.model}, {args.turns} turns, num_ctx {args.num_ctx}")
+    print(header)
+    print("-" * len(header))
+    results = {}
+    for label, condense_template, qa_template in layouts:
+        totals = _run_session(client, args.model, condense_template, qa_template, args.turns, args.num_ctx, args.seed)
+        results[label] = totals
+        print(f"{label:<8} {totals['calls']:>6} {totals['sent_tokens']:>9} {totals['evaluated_tokens']:>9} "
+              f"{totals['seconds']:>10.2f} {totals['seconds'] / max(1, totals['calls']):>8.3f}")
+    print("-" * len(header))
+    before, after = results["before"]["seconds"], results["after"]["seconds"]
+    print(f"Prefill time saved: {before - after:.2f} s ({(1 - after / before) * 100 if before else 0:.0f}%)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
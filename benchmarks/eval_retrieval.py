@@ -0,0 +1,211 @@
+# benchmarks/eval_retrieval.py
+"""
+Offline retrieval evaluation over a golden question set.
+
+For every chunking/retrieval configuration (size:overlap:k, in tokens for
+the structure splitter and characters for the recursive one) a fresh index is built from a local corpus directory with the app's own
+pipeline (_load_and_split_document -> add_chunks_deduplicated into a
+ShardedStore), then every golden question goes through the chat retriever
+(build_retriever: document stage, near-duplicate collapsing, MMR).
+
+Golden set (JSON list): {"question": ..., "expected": [key glob, ...]}.
+A corpus file is relevant to a question when its key (path relative to the
+corpus directory) matches any of the globs, case-insensitively. Questions
+with no relevant file in the corpus are skipped.
+
+  recall@k  relevant files among the top-k hits / min(relevant files, k)
+  MRR       1 / rank of the first hit from a relevant file (0 if none)
+
+Usage (from the project root):
+    python benchmarks/eval_retrieval.py path/to/corpus
+        [--golden benchmarks/golden_crypto.json]
+        [--configs 1000:200:5,800:100:5,1500:200:8]
+        [--embeddings hashing | ollama[:model]] [--splitter structure|recursive]
+
+`hashing` is a deterministic, dependency-free stand-in (feature-hashed word
+unigrams and bigrams) for fast, reproducible runs; `ollama` uses the real
+embeddings model (config.EMBEDDING_MODEL unless given). The query embedding
+and retrieval result caches are bypassed so every configuration pays the same
+embedding and search cost.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import fnmatch
+import hashlib
+import argparse
+import re
+import statistics
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+import config
+import content_registry
+import shard_store
+import utils
+import vectorstore_handler
+
+DEFAULT_GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden_crypto.json")
+_WORD_RE = re.compile(r"\w+")
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic bag-of-n-grams embeddings via feature hashing (L2-normalized)."""
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.model = f"hashing-{dim}"
+
+    def _embed(self, text):
+        words = _WORD_RE.findall((text or "").casefold())
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "big") % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def _corpus_files(corpus_dir):
+    files = {}
+    for root, _, names in os.walk(corpus_dir):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            s3_key = os.path.relpath(path, corpus_dir).replace(os.sep, "/")
+            if utils.allowed_file(name):
+                files[s3_key] = path
+    return files
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def _relevant_keys(expected, keys):
+    patterns = [pattern.casefold() for pattern in expected]
+    return {key for key in keys if any(fnmatch.fnmatch(key.casefold(), pattern) for pattern in patterns)}
+
+
+def _parse_configs(spec):
+    configs = []
+    for item in spec.split(","):
+        chunk_size, overlap, k = (int(part) for part in item.split(":"))
+        configs.append((chunk_size, overlap, k))
+    return configs
+
+
+def build_index(files, embeddings, chunk_size, overlap, work_dir):
+    """Builds a fresh index under `work_dir`. Returns (store, chunk_count, build_seconds)."""
+    if config.TEXT_SPLITTER == "structure":
+        config.CHUNK_TOKENS, config.CHUNK_OVERLAP_TOKENS = chunk_size, overlap
+    else:
+        config.CHUNK_SIZE, config.CHUNK_OVERLAP = chunk_size, overlap
+    vectorstore_handler.registry = content_registry.ContentRegistry(os.path.join(work_dir, "content_registry.sqlite3"))
+    vectorstore_handler.chunk_index = vectorstore_handler.ChunkKeyIndex()
+    store = shard_store.ShardedStore(embeddings, os.path.join(work_dir, "chroma"))
+    chunk_count = 0
+    start = time.perf_counter()
+    for s3_key, path in files.items():
+        chunks = vectorstore_handler._load_and_split_document(path, s3_key, None, None)
+        if chunks:
+            vectorstore_handler.add_chunks_deduplicated(store, chunks)
+            chunk_count += len(chunks)
+    return store, chunk_count, time.perf_counter() - start
+
+
+def evaluate(store, golden, keys, k):
+    """Runs the golden questions through the chat retriever. Returns (recall@k, MRR, latencies_ms, questions)."""
+    retriever = vectorstore_handler.build_retriever(store, config.DEFAULT_LLM_MODEL, k=k, use_query_cache=False,
+                                                   use_result_cache=False)
+    recalls, reciprocal_ranks, latencies = [], [], []
+    for item in golden:
+        relevant = _relevant_keys(item["expected"], keys)
+        if not relevant:
+            continue
+        start = time.perf_counter()
+        docs = retriever.invoke(item["question"])
+        latencies.append((time.perf_counter() - start) * 1000)
+        chunk_ids = [doc.metadata[config.CHUNK_ID_METADATA_KEY] for doc in docs]
+        keys_by_id = vectorstore_handler.registry.keys_for_chunks(chunk_ids)
+        ranked_keys = [set(keys_by_id.get(chunk_id) or []) for chunk_id in chunk_ids]
+        found = set().union(*ranked_keys) & relevant if ranked_keys else set()
+        recalls.append(len(found) / min(len(relevant), k))
+        first = next((rank for rank, hit_keys in enumerate(ranked_keys, 1) if hit_keys & relevant), None)
+        reciprocal_ranks.append(1 / first if first else 0.0)
+    return (statistics.fmean(recalls) if recalls else 0.0,
+            statistics.fmean(reciprocal_ranks) if reciprocal_ranks else 0.0,
+            sorted(latencies), len(recalls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus_dir", help="Directory of PDF/PPT/PPTX files (keys are paths relative to it)")
+    parser.add_argument("--golden", default=DEFAULT_GOLDEN, help="Golden question set (JSON)")
+    parser.add_argument("--configs", help="Comma-separated size:overlap:k configurations (default: current config)")
+    parser.add_argument("--splitter", choices=["structure", "recursive"], default=config.TEXT_SPLITTER)
+    parser.add_argument("--embeddings", default="hashing", help="'hashing' (deterministic stand-in) or 'ollama[:model]'")
+    parser.add_argument("--keep", action="store_true", help="Keep the built indexes (their paths are printed)")
+    args = parser.parse_args()
+    config.TEXT_SPLITTER = args.splitter
+    if not args.configs:
+        if args.splitter == "structure":
+            args.configs = f"{config.CHUNK_TOKENS}:{config.CHUNK_OVERLAP_TOKENS}:{config.RETRIEVER_K}"
+        else:
+            args.configs = f"{config.CHUNK_SIZE}:{config.CHUNK_OVERLAP}:{config.RETRIEVER_K}"
+
+    files = _corpus_files(args.corpus_dir)
+    if not files:
+        print(f"No supported files under {args.corpus_dir}.")
+        return 1
+    with open(args.golden, encoding="utf-8") as f:
+        golden = json.load(f)
+    if args.embeddings == "hashing":
+        embeddings = HashingEmbeddings()
+    else:
+        _, _, model = args.embeddings.partition(":")
+        embeddings = vectorstore_handler.get_embeddings_for_model(model or config.EMBEDDING_MODEL)
+        if embeddings is None:
+            return 1
+    config.PARSE_CACHE_ENABLED = False  # Every configuration parses from scratch, as a first build would
+
+    header = (f"{'size:overlap:k':<16} {'chunks':>7} {'index MB':>9} {'build s':>8} {'recall@k':>9} {'MRR':>6} "
+              f"{'p50 ms':>8} {'p99 ms':>8}")
+    rows = []
+    for chunk_size, overlap, k in _parse_configs(args.configs):
+        work_dir = tempfile.mkdtemp(prefix="eval_index_")
+        print(f"\nBuilding {chunk_size}:{overlap} over {len(files)} files with '{embeddings.model}'...")
+        store, chunk_count, build_seconds = build_index(files, embeddings, chunk_size, overlap, work_dir)
+        recall, mrr, latencies, questions = evaluate(store, golden, files.keys(), k)
+        p50 = statistics.median(latencies) if latencies else 0.0
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0
+        rows.append(f"{f'{chunk_size}:{overlap}:{k}':<16} {chunk_count:>7} {_dir_size(work_dir) / 1e6:>9.1f} "
+                    f"{build_seconds:>8.1f} {recall:>9.3f} {mrr:>6.3f} {p50:>8.1f} {p99:>8.1f}")
+        vectorstore_handler.registry.close()
+        if args.keep:
+            print(f"  Index kept at {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"\n{questions} of {len(golden)} golden questions have relevant files in the corpus; "
+          f"embeddings: {embeddings.model}, splitter: {args.splitter}")
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(row)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
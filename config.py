@@ -3,35 +3,181 @@ import os
 
 # --- Core Paths and Settings ---
 CHROMA_PATH = "chroma_db"
+# Local app state kept beside (not inside) CHROMA_PATH: never copied into published snapshots, kept across rebuilds
+DATA_DIR = os.path.join(os.path.dirname(CHROMA_PATH), "data")
 ALLOWED_EXTENSIONS = {'pdf', 'ppt', 'pptx'}
 MAX_CONTENT_LENGTH = 25 * 1024 * 1024  # 25 MB limit
+MAX_BATCH_CONTENT_LENGTH = 500 * 1024 * 1024  # Whole-request limit for /upload_files (each file still capped above)
 APP_SECRET_KEY = os.environ.get('FLASK_SECRET_KEY', 'dev-secret-key-change-for-prod') # Use env var
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '') # Required in the X-Admin-Token header of /admin routes; unset disables them
+
+# --- Deployment Role ---
+# 'standalone': a single process reads and writes CHROMA_PATH (default).
+# 'writer': the only process that ingests (uploads, S3 sync); publishes an index snapshot after every write.
+# 'reader': read-only serving worker; loads the newest published snapshot and hot-swaps to newer ones.
+INDEX_ROLE = os.environ.get('INDEX_ROLE', 'standalone').lower()
+INDEX_PUBLISH_DIR = os.environ.get('INDEX_PUBLISH_DIR', 'index_versions') # Shared by the writer and all readers
+INDEX_POLL_INTERVAL = 10  # Seconds between readers' checks for a newly published version
+# The writer prunes a published snapshot only once it is not current, older than the grace period and not
+# leased by a reader (readers refresh their lease every poll; a lease older than INDEX_LEASE_TTL is dead)
+INDEX_VERSION_GRACE_SECONDS = 300
+INDEX_LEASE_TTL = 6 * INDEX_POLL_INTERVAL
+# Every publication copies the whole working index; writes within this many seconds share one publication
+INDEX_PUBLISH_DEBOUNCE_SECONDS = 5
 
 # --- Model Names ---
 DEFAULT_LLM_MODEL ="qwen2.5:7b"
 REASONING_LLM_MODEL ="deepseek-r1:7b"
-EMBEDDING_MODEL = "nomic-embed-text"
+EMBEDDING_MODEL = "nomic-embed-text"  # Used for new builds; an existing index keeps the model it records (see below)
+
+# --- Embedding Model Migration ---
+# CHROMA_PATH records which model the index was embedded with; switch models with POST /admin/embedding_migration
+EMBEDDING_STATE_FILE = "embedding_state.json"
+MIGRATION_PAGE_SIZE = 256       # Stored chunks read per back-fill step
+MIGRATION_COMPARE_QUERIES = 50  # Sampled queries in the old-vs-new retrieval comparison
+MIGRATION_RETIRE_DELAY = 120    # Seconds the old model's collections are kept after the switch (in-flight chats)
+MIGRATION_REPORT_PATH = os.path.join(DATA_DIR, "embedding_migration_report.json")
 
 # --- Text Splitting ---
+# "structure": page/slide-bounded chunks cut at headings, bullets and paragraphs, sized in tokens
+# (structure_splitter.py); "recursive": the original RecursiveCharacterTextSplitter (CHUNK_SIZE/CHUNK_OVERLAP chars)
+TEXT_SPLITTER = os.environ.get('TEXT_SPLITTER', 'structure')
+CHUNK_TOKENS = 300
+CHUNK_OVERLAP_TOKENS = 40  # Only applied where a chunk boundary falls inside a paragraph
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 
+# --- Parsed Text Cache ---
+# Extracted page/slide text per (s3_key, VersionId), so re-chunking/re-embedding skips download + parse
+PARSE_CACHE_ENABLED = os.environ.get('PARSE_CACHE_ENABLED', 'True').lower() in ['true', '1', 'yes']
+PARSE_CACHE_DIR = "parse_cache"
+# Optional S3 mirror (e.g. "_parse_cache/"); keys under it are never listed as documents
+PARSE_CACHE_S3_PREFIX = os.environ.get('PARSE_CACHE_S3_PREFIX', '')
+
+# --- Ingestion Batching ---
+EMBED_BATCH_SIZE = 64     # Chunks per embedding call / collection upsert
+EMBED_MAX_WORKERS = 4     # Embedding batches in flight against Ollama (pair with OLLAMA_NUM_PARALLEL)
+PARSE_MAX_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # Worker processes for document parsing
+MAX_FILES_PER_BATCH_UPLOAD = 50
+BUILD_BATCH_CHUNKS = 512  # Full build: chunks buffered before each embed/write/persist/checkpoint step
+# Completed keys of an in-progress full build; a restart resumes from it
+BUILD_CHECKPOINT_PATH = os.path.join(CHROMA_PATH, "build_checkpoint.json")
+# Write-ahead log of pending index updates (uploads, S3 sync), replayed on startup
+INGEST_LOG_DIR = os.path.join(CHROMA_PATH, "ingest_log")
+
+# --- Large PDF Extraction ---
+# PDFs with at least this many pages are extracted as page ranges in parallel worker processes;
+# a single upload is embedded range by range, so it becomes searchable before the whole file is parsed
+PDF_PARALLEL_MIN_PAGES = 40
+PDF_PAGES_PER_TASK = 16
+# Memory budget for page-range tasks in flight at once; each is estimated at
+# PDF_TASK_MEMORY_MB plus the file size (every worker opens the whole file)
+PDF_EXTRACT_MEMORY_CAP_MB = int(os.environ.get('PDF_EXTRACT_MEMORY_CAP_MB', '2048'))
+PDF_TASK_MEMORY_MB = 150
+
+# --- Retrieval ---
+RETRIEVER_K = 5
+RETRIEVER_FETCH_K = 20  # Candidates fetched before scope post-filtering and near-duplicate collapsing
+NEAR_DUPLICATE_THRESHOLD = 0.9  # Word-shingle Jaccard similarity at which two hits count as the same chunk
+# Two-stage retrieval: the closest N documents (per-key mean vectors) are picked first and only their
+# chunks are searched. 0 searches all chunks directly.
+DOC_RETRIEVAL_TOP_N = 8
+# Diversity re-ranking: a pool of MMR_FETCH_K candidates (with their vectors) is re-ranked by maximal
+# marginal relevance, keeping at most MMR_MAX_PER_SOURCE chunks per S3 key (0 = no cap).
+# MMR_LAMBDA weighs relevance against novelty: 1.0 is pure similarity order.
+MMR_LAMBDA = 0.7
+MMR_FETCH_K = 50
+MMR_MAX_PER_SOURCE = 2
+# Per-LLM overrides of "lambda" / "fetch_k" / "max_per_source", e.g. a wider, more diverse pool for reasoning
+MMR_SETTINGS_BY_MODEL = {
+    REASONING_LLM_MODEL: {"lambda": 0.6, "fetch_k": 80},
+}
+
+# --- Query Embedding Cache ---
+QUERY_EMBEDDING_CACHE_SIZE = 2048  # Cached question vectors (LRU, keyed on normalized text + model); 0 disables
+QUERY_EMBEDDING_BATCH_WINDOW_MS = 5  # Misses within this window go to Ollama as one /api/embed request; 0 disables
+
+# --- Retrieval Result Cache ---
+# Final retriever results (chunk IDs, distances, source URLs) per quantized question vector, k, scope and
+# retrieval settings. Entries are tied to the corpus version, so every index write invalidates them.
+RETRIEVAL_CACHE_ENABLED = os.environ.get('RETRIEVAL_CACHE_ENABLED', 'True').lower() in ['true', '1', 'yes']
+RETRIEVAL_CACHE_MAX_MB = 16
+
+# --- Sharding ---
+# 'none': one collection; 'prefix': one per leading S3 folder (SHARD_PREFIX_DEPTH levels, e.g. per course);
+# 'hash': keys spread over SHARD_COUNT collections. Changing it on an existing DB requires a rebuild.
+SHARD_STRATEGY = os.environ.get('SHARD_STRATEGY', 'none').lower()
+SHARD_PREFIX_DEPTH = 1
+SHARD_COUNT = 4
+SEARCH_FANOUT_WORKERS = 8  # Shards searched in parallel per query
+
+# --- Deduplication ---
+# Records which S3 keys reference each content-addressed chunk (lives inside the Chroma directory)
+CONTENT_REGISTRY_PATH = os.path.join(CHROMA_PATH, "content_registry.sqlite3")
+
 # --- AWS S3 Configuration ---
 S3_BUCKET_NAME =  "mycnsbucket"
 S3_PREFIX = ""
 AWS_REGION = "ap-south-1"
 S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com"
 
+# --- S3 Transfer Tuning ---
+S3_MAX_POOL_CONNECTIONS = 64   # botocore HTTP connection pool (default is 10)
+S3_MAX_ATTEMPTS = 8            # Retries use botocore's 'adaptive' mode
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+S3_TRANSFER_MAX_CONCURRENCY = 8  # Threads per single multipart transfer
+S3_BULK_DOWNLOAD_WORKERS = 8     # Objects downloaded in parallel by bulk downloads
+
+# --- S3 Listing Catalog ---
+# Local key -> (VersionId, ETag, LastModified, Size) catalog: syncs list current objects with list_objects_v2
+# and fetch VersionIds (head_object) only for keys whose ETag/LastModified/Size changed
+S3_CATALOG_ENABLED = os.environ.get('S3_CATALOG_ENABLED', 'True').lower() in ['true', '1', 'yes']
+S3_CATALOG_PATH = os.path.join(DATA_DIR, "s3_catalog.json")
+S3_CATALOG_MAX_HEADS = 500  # More changed keys than this: one full list_object_versions pass instead
+
 # --- Metadata Keys ---
 S3_VERSION_ID_METADATA_KEY = "s3_version_id"
 S3_KEY_METADATA_KEY = "s3_key"
 S3_URL_METADATA_KEY = "s3_url"
 SOURCE_METADATA_KEY = "source"
 LAST_MODIFIED_S3_METADATA_KEY = "last_modified_s3"
+SLIDE_NUMBER_METADATA_KEY = "slide_number"
+CONTENT_HASH_METADATA_KEY = "content_sha256"  # Fingerprint of the whole file's extracted text
+# Stored chunk metadata is the owner S3 key (the document ID) plus these position fields; the per-document
+# fields above (URL, version, last modified, fingerprint) live in the content registry and are joined on read
+CHUNK_POSITION_METADATA_KEYS = ("page", "page_number", SLIDE_NUMBER_METADATA_KEY, "start_index")
+# Added to retrieved documents only (never stored)
+CHUNK_ID_METADATA_KEY = "chunk_id"
+SOURCE_URLS_METADATA_KEY = "source_urls"
+
+# --- Prompt Sizing ---
+TOKENIZER_ENCODING = "cl100k_base"  # tiktoken encoding used to count prompt tokens (approximates the Ollama models)
+# num_ctx values requests are rounded up to; few distinct sizes, since Ollama reloads a model when num_ctx changes
+NUM_CTX_BUCKETS = [4096, 8192, 16384, 32768]
+NUM_PREDICT_RESERVE = 1024  # Tokens kept free for the answer (plus THINKING_TOKEN_BUDGET for the reasoning model)
+
+# --- Chat History Compaction ---
+# Past this many history tokens, older turns are folded into a running summary in the background
+HISTORY_SUMMARY_TRIGGER_TOKENS = 1500
+HISTORY_KEEP_RECENT_TURNS = 2        # Question/answer pairs always sent verbatim after the summary
+HISTORY_SUMMARY_MODEL = DEFAULT_LLM_MODEL
+HISTORY_SUMMARY_MAX_SESSIONS = 1000  # Summaries kept in memory (least recently used are dropped)
+
+# --- Request Profiling ---
+# Admin requests (X-Admin-Token) with header "X-Profile: 1" are always profiled; this flag profiles every
+# /chat and /upload_file request. Profiles are folded stacks + stage timings written to PROFILE_DIR.
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', 'False').lower() in ['true', '1', 'yes']
+PROFILE_DIR = "profiles"
+PROFILE_SAMPLE_INTERVAL_MS = 5
+PROFILE_MAX_KEPT = 50  # Oldest profiles beyond this are deleted
 
 # --- Streaming Markers ---
-THINKING_START_MARKER = "<<<THINKING_START>>>"
-THINKING_END_MARKER = "<<<THINKING_END>>>"
+# Tags the reasoning model wraps its thinking in; /chat streams that text as a separate 'thinking' event
+THINKING_START_MARKER = "<think>"
+THINKING_END_MARKER = "</think>"
+# Max tokens the reasoning model may spend thinking before it is cut off and forced to answer (0 disables)
+THINKING_TOKEN_BUDGET = int(os.environ.get('THINKING_TOKEN_BUDGET', 1024))
 
 # --- Function to check secret key ---
 def check_secret_key():
@@ -0,0 +1,282 @@
+# content_registry.py
+"""
+Content-addressed bookkeeping for the vector store.
+
+Chunk IDs in the Chroma collection are the SHA-256 of the chunk's text after
+Unicode and whitespace normalization, so identical text is embedded and
+stored once no matter how many S3 keys contain it. Case is kept: the one
+stored copy is served for every key, so "AES" and "aes" must stay distinct
+chunks. The stored copy carries the metadata of one "owner" key; this
+registry (a small SQLite file next to the Chroma DB) records every key that
+references each chunk, plus a fingerprint of each file's extracted text so
+whole-file copies are recognised.
+
+Tables:
+  files  (s3_key, version_id, last_modified, content_sha256)
+  chunks (chunk_id, owner_key)
+  refs   (chunk_id, s3_key)
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import unicodedata
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    s3_key TEXT PRIMARY KEY,
+    version_id TEXT,
+    last_modified TEXT,
+    content_sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS files_by_content ON files (content_sha256);
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_id TEXT PRIMARY KEY,
+    owner_key TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    chunk_id TEXT NOT NULL,
+    s3_key TEXT NOT NULL,
+    PRIMARY KEY (chunk_id, s3_key)
+);
+CREATE INDEX IF NOT EXISTS refs_by_key ON refs (s3_key);
+"""
+
+# SQLite's default limit on host parameters per statement is 999 on older builds
+_SQL_BATCH = 500
+
+
+def normalize_content(text):
+    """Unicode-normalizes and collapses whitespace, keeping case, so trivially different copies of stored text hash alike."""
+    text = unicodedata.normalize("NFKC", text or "")
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def normalize_text(text):
+    """normalize_content plus case folding, for matching questions (never for stored content)."""
+    return normalize_content(text).casefold()
+
+
+def chunk_content_id(text):
+    """Content-addressed chunk ID: SHA-256 of the normalized (case-preserved) chunk text."""
+    return hashlib.sha256(normalize_content(text).encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(docs):
+    """Fingerprint of a whole file: SHA-256 over the normalized (case-preserved) text of its loaded pages/slides, in order."""
+    digest = hashlib.sha256()
+    for doc in docs:
+        digest.update(normalize_content(doc.page_content).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _batches(items):
+    items = list(items)
+    for start in range(0, len(items), _SQL_BATCH):
+        yield items[start:start + _SQL_BATCH]
+
+
+class ContentRegistry:
+    """Thread-safe registry of files, stored chunks and the keys referencing them."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Queries ---
+    def is_empty(self):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+
+    def file_versions(self):
+        """Returns {s3_key: version_id} for every registered file."""
+        with self._lock:
+            return dict(self._conn.execute("SELECT s3_key, version_id FROM files"))
+
+    def file_info(self, s3_key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version_id, last_modified, content_sha256 FROM files WHERE s3_key = ?", (s3_key,)
+            ).fetchone()
+        if not row:
+            return None
+        return {"version_id": row[0], "last_modified": row[1], "content_sha256": row[2]}
+
+    def file_infos(self, s3_keys):
+        """Returns {s3_key: {'version_id', 'last_modified', 'content_sha256'}} for the registered keys among `s3_keys`."""
+        infos = {}
+        with self._lock:
+            for batch in _batches(set(s3_keys)):
+                placeholders = ",".join("?" * len(batch))
+                for s3_key, version_id, last_modified, content_sha256 in self._conn.execute(
+                        f"SELECT s3_key, version_id, last_modified, content_sha256 FROM files WHERE s3_key IN ({placeholders})",
+                        batch):
+                    infos[s3_key] = {"version_id": version_id, "last_modified": last_modified,
+                                     "content_sha256": content_sha256}
+        return infos
+
+    def find_file_by_fingerprint(self, content_sha256, exclude_keys=()):
+        """Returns another registered key whose extracted text is identical, or None."""
+        if not content_sha256:
+            return None
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT s3_key FROM files WHERE content_sha256 = ? ORDER BY s3_key", (content_sha256,)
+            ).fetchall()
+        for (s3_key,) in rows:
+            if s3_key not in exclude_keys:
+                return s3_key
+        return None
+
+    def existing_chunk_ids(self, chunk_ids):
+        """Subset of `chunk_ids` already stored in the collection."""
+        found = set()
+        with self._lock:
+            for batch in _batches(set(chunk_ids)):
+                placeholders = ",".join("?" * len(batch))
+                found.update(row[0] for row in self._conn.execute(
+                    f"SELECT chunk_id FROM chunks WHERE chunk_id IN ({placeholders})", batch))
+        return found
+
+    def keys_for_chunks(self, chunk_ids):
+        """Returns {chunk_id: [s3_key, ...]} with the owner key first."""
+        keys = {}
+        with self._lock:
+            for batch in _batches(set(chunk_ids)):
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT r.chunk_id, r.s3_key, c.owner_key FROM refs r JOIN chunks c ON c.chunk_id = r.chunk_id "
+                    f"WHERE r.chunk_id IN ({placeholders}) ORDER BY r.s3_key", batch)
+                for chunk_id, s3_key, owner_key in rows:
+                    key_list = keys.setdefault(chunk_id, [])
+                    if s3_key == owner_key:
+                        key_list.insert(0, s3_key)
+                    else:
+                        key_list.append(s3_key)
+        return keys
+
+    def chunk_owners(self, chunk_ids):
+        """Returns {chunk_id: owner_key} for the stored chunks among `chunk_ids`."""
+        owners = {}
+        with self._lock:
+            for batch in _batches(set(chunk_ids)):
+                placeholders = ",".join("?" * len(batch))
+                owners.update(self._conn.execute(
+                    f"SELECT chunk_id, owner_key FROM chunks WHERE chunk_id IN ({placeholders})", batch))
+        return owners
+
+    def owner_keys_for(self, s3_keys):
+        """Owner keys of all chunks referenced by `s3_keys` (what a metadata filter must match)."""
+        owners = set()
+        with self._lock:
+            for batch in _batches(s3_keys):
+                placeholders = ",".join("?" * len(batch))
+                owners.update(row[0] for row in self._conn.execute(
+                    f"SELECT DISTINCT c.owner_key FROM refs r JOIN chunks c ON c.chunk_id = r.chunk_id "
+                    f"WHERE r.s3_key IN ({placeholders})", batch))
+        return owners
+
+    def all_refs(self):
+        """Returns every (chunk_id, s3_key) reference."""
+        with self._lock:
+            return self._conn.execute("SELECT chunk_id, s3_key FROM refs").fetchall()
+
+    # --- Updates ---
+    def register_file(self, s3_key, version_id, last_modified, content_sha256, chunk_ids, new_chunk_ids=()):
+        """
+        Records a file and its chunk references. `new_chunk_ids` are chunks this
+        file just added to the collection, so it becomes their owner.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (s3_key, version_id, last_modified, content_sha256) VALUES (?, ?, ?, ?)",
+                (s3_key, version_id, last_modified, content_sha256))
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO chunks (chunk_id, owner_key) VALUES (?, ?)",
+                [(chunk_id, s3_key) for chunk_id in new_chunk_ids])
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO refs (chunk_id, s3_key) VALUES (?, ?)",
+                [(chunk_id, s3_key) for chunk_id in set(chunk_ids)])
+
+    def remove_keys(self, s3_keys, keep=None):
+        """
+        Drops the given keys and their references. `keep` ({s3_key: chunk_ids})
+        narrows this for keys being replaced: only their references outside
+        the kept IDs are dropped, and their file records stay.
+        Returns (orphaned, new_owners): {chunk_id: owner_key} for chunks no key
+        references any more (delete them from the collection), and
+        {chunk_id: (old_owner_key, new_owner_key)} for still-shared chunks whose
+        owner was removed (rewrite their metadata).
+        """
+        s3_keys = set(s3_keys)
+        keep = keep or {}
+        orphaned, new_owners = {}, {}
+        if not s3_keys:
+            return orphaned, new_owners
+        with self._lock, self._conn:
+            affected = set()
+            for batch in _batches(s3_keys - keep.keys()):
+                placeholders = ",".join("?" * len(batch))
+                affected.update(row[0] for row in self._conn.execute(
+                    f"SELECT chunk_id FROM refs WHERE s3_key IN ({placeholders})", batch))
+                self._conn.execute(f"DELETE FROM refs WHERE s3_key IN ({placeholders})", batch)
+                self._conn.execute(f"DELETE FROM files WHERE s3_key IN ({placeholders})", batch)
+            for s3_key in s3_keys & keep.keys():
+                stale = [row[0] for row in self._conn.execute("SELECT chunk_id FROM refs WHERE s3_key = ?", (s3_key,))
+                         if row[0] not in keep[s3_key]]
+                affected.update(stale)
+                self._conn.executemany("DELETE FROM refs WHERE chunk_id = ? AND s3_key = ?",
+                                       [(chunk_id, s3_key) for chunk_id in stale])
+            for chunk_id in affected:
+                owner = self._conn.execute(
+                    "SELECT owner_key FROM chunks WHERE chunk_id = ?", (chunk_id,)
+                ).fetchone()
+                owner_key = owner[0] if owner else None
+                remaining = self._conn.execute(
+                    "SELECT s3_key FROM refs WHERE chunk_id = ? ORDER BY s3_key LIMIT 1", (chunk_id,)
+                ).fetchone()
+                if remaining is None:
+                    orphaned[chunk_id] = owner_key
+                    self._conn.execute("DELETE FROM chunks WHERE chunk_id = ?", (chunk_id,))
+                    continue
+                if owner_key is None or (owner_key in s3_keys and chunk_id not in keep.get(owner_key, ())):
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO chunks (chunk_id, owner_key) VALUES (?, ?)", (chunk_id, remaining[0]))
+                    new_owners[chunk_id] = (owner_key, remaining[0])
+        return orphaned, new_owners
+
+    def invalidate_file(self, s3_key):
+        """Forgets the indexed version of a key (its references stay), so the next S3 sync re-indexes it."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE files SET version_id = NULL WHERE s3_key = ?", (s3_key,))
+
+    def bootstrap(self, ids, metadatas, key_field, version_field, last_modified_field, content_field):
+        """
+        Populates an empty registry from an existing collection's metadata
+        (databases built before deduplication). Existing chunk IDs are kept as-is.
+        """
+        files = {}
+        with self._lock, self._conn:
+            for chunk_id, metadata in zip(ids, metadatas):
+                metadata = metadata or {}
+                s3_key = metadata.get(key_field)
+                if not s3_key:
+                    continue
+                files[s3_key] = (metadata.get(version_field), metadata.get(last_modified_field),
+                                 metadata.get(content_field))
+                self._conn.execute("INSERT OR IGNORE INTO chunks (chunk_id, owner_key) VALUES (?, ?)", (chunk_id, s3_key))
+                self._conn.execute("INSERT OR IGNORE INTO refs (chunk_id, s3_key) VALUES (?, ?)", (chunk_id, s3_key))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files (s3_key, version_id, last_modified, content_sha256) VALUES (?, ?, ?, ?)",
+                [(s3_key,) + info for s3_key, info in files.items()])
+        return len(files)
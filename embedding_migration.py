@@ -0,0 +1,275 @@
+# embedding_migration.py
+"""
+Zero-downtime switch to a different embedding model.
+
+A migration runs in a background thread of the indexing process:
+  1. creates a second set of shard collections for the target model next to
+     the live ones (same directory, names suffixed per model),
+  2. back-fills them from the chunk text already stored in the live
+     collections (no S3 download, no re-parse) while every upload, sync or
+     delete is also applied to them (dual writes),
+  3. compares retrieval latency and top-k overlap between the two models on
+     a sample of stored chunks (saved to config.MIGRATION_REPORT_PATH),
+  4. reconciles the two sets under the write lock and switches retrieval
+     over in one step.
+
+The service keeps answering from the old collections until the switch.
+"""
+import json
+import os
+import random
+import statistics
+import threading
+import time
+import traceback
+
+from langchain_core.documents import Document
+
+import config
+import shard_store
+import vectorstore_handler
+
+_QUERY_CHARS = 200  # Leading characters of a sampled chunk used as its comparison query
+
+_current = None
+_current_lock = threading.Lock()
+
+
+def get_migration():
+    """The running or most recent migration of this process, or None."""
+    return _current
+
+
+def start_migration(target_model, on_switch=None):
+    """
+    Starts a migration to `target_model` in the background.
+    `on_switch(new_store)` is called after retrieval has switched over.
+    Returns (migration, error_message).
+    """
+    global _current
+    with _current_lock:
+        if _current is not None and _current.is_running():
+            return None, f"A migration to '{_current.target_model}' is already running."
+        state = vectorstore_handler.embedding_state or {}
+        if target_model == state.get("model"):
+            return None, f"'{target_model}' is already the active embedding model."
+        _current = EmbeddingMigration(target_model, on_switch)
+        _current.start()
+        return _current, None
+
+
+class EmbeddingMigration:
+    """One background re-embedding run and its progress."""
+
+    def __init__(self, target_model, on_switch=None):
+        self.target_model = target_model
+        self.on_switch = on_switch
+        self.status = "pending"
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.chunks_reused = 0
+        self.report = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def to_dict(self):
+        return {
+            "target_model": self.target_model,
+            "status": self.status,
+            "chunks_total": self.chunks_total,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_reused": self.chunks_reused,
+            "report": self.report,
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="embedding-migration", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        self.started_at = time.time()
+        print(f"\n--- Embedding migration to '{self.target_model}' started ---")
+        try:
+            source = vectorstore_handler.get_vector_store()
+            target_embeddings = vectorstore_handler.get_embeddings_for_model(self.target_model)
+            if source is None or target_embeddings is None:
+                raise RuntimeError("vector store or target embeddings model unavailable")
+            target = shard_store.ShardedStore(
+                target_embeddings, source.persist_directory,
+                collection_suffix=shard_store.collection_suffix_for_model(self.target_model),
+            )
+            # Mirror writes first, so nothing written during the back-fill is missed
+            vectorstore_handler.begin_migration_writes(target)
+
+            self.status = "backfilling"
+            self.chunks_total = source.count()
+            for shard_name in source.shard_names():
+                self._backfill_shard(source, target, shard_name)
+            # Document vectors are means of chunk vectors, so they are recomputed in the new space
+            vectorstore_handler.ensure_document_index(target)
+
+            self.status = "comparing"
+            self.report = compare_retrieval(source, target)
+            _save_report(self.report)
+
+            self.status = "switching"
+            with vectorstore_handler.write_lock:
+                # Writes are blocked now: fix whatever raced with the back-fill, then switch
+                reconcile(source, target)
+                vectorstore_handler.ensure_document_index(target)
+                vectorstore_handler.switch_embedding_model(target)
+            if self.on_switch:
+                self.on_switch(target)
+            self.status = "complete"
+            print(f"--- Embedding migration to '{self.target_model}' complete ---")
+        except Exception as e:
+            vectorstore_handler.end_migration_writes()
+            self.status = "failed"
+            self.error = str(e)
+            print(f"  ERROR: Embedding migration to '{self.target_model}' failed: {e}. "
+                  "The active model is unchanged; start the migration again to resume.")
+            traceback.print_exc()
+        finally:
+            self.finished_at = time.time()
+
+    def _backfill_shard(self, source, target, shard_name):
+        """Embeds one shard's stored chunk text with the target model, page by page."""
+        source_collection = source.shard(shard_name)._collection
+        target_shard = target.shard(shard_name)
+        print(f"  Back-filling shard '{shard_name}' ({source_collection.count()} chunks)...")
+        offset = 0
+        while True:
+            page = source_collection.get(include=["documents", "metadatas"],
+                                         limit=config.MIGRATION_PAGE_SIZE, offset=offset)
+            ids = page.get("ids") or []
+            if not ids:
+                break
+            offset += len(ids)
+            # Chunks from an earlier, interrupted run or from dual writes are already there
+            present = set(target_shard._collection.get(ids=ids, include=[]).get("ids") or [])
+            todo = [(chunk_id, text, metadata)
+                    for chunk_id, text, metadata in zip(ids, page["documents"], page["metadatas"])
+                    if chunk_id not in present]
+            self.chunks_reused += len(ids) - len(todo)
+            if todo:
+                vectorstore_handler.add_chunks_in_batches(
+                    target_shard,
+                    [Document(page_content=text or "", metadata=metadata or {}) for _, text, metadata in todo],
+                    [chunk_id for chunk_id, _, _ in todo],
+                )
+                self.chunks_embedded += len(todo)
+
+
+def reconcile(source, target):
+    """
+    Makes the target hold exactly the source's chunks and metadata: deletes,
+    owner changes or writes that raced with the back-fill are applied again.
+    The caller holds the write lock.
+    """
+    for shard_name in sorted(set(source.shard_names()) | set(target.shard_names())):
+        source_collection = source.shard(shard_name)._collection
+        target_collection = target.shard(shard_name)._collection
+        source_data = source_collection.get(include=["metadatas"])
+        target_data = target_collection.get(include=["metadatas"])
+        # Compared in stored (compact) form; the target is always written compact
+        compact = vectorstore_handler.compact_chunk_metadata
+        source_metadata = {i: compact(md) for i, md in zip(source_data["ids"], source_data["metadatas"])}
+        target_metadata = {i: compact(md) for i, md in zip(target_data["ids"], target_data["metadatas"])}
+
+        extra = [chunk_id for chunk_id in target_metadata if chunk_id not in source_metadata]
+        if extra:
+            target_collection.delete(ids=extra)
+        missing = [chunk_id for chunk_id in source_metadata if chunk_id not in target_metadata]
+        if missing:
+            rows = source_collection.get(ids=missing, include=["documents", "metadatas"])
+            vectorstore_handler.add_chunks_in_batches(
+                target.shard(shard_name),
+                [Document(page_content=text or "", metadata=md or {}) for text, md in zip(rows["documents"], rows["metadatas"])],
+                rows["ids"],
+            )
+        stale = [chunk_id for chunk_id, md in source_metadata.items()
+                 if chunk_id in target_metadata and target_metadata[chunk_id] != md]
+        if stale:
+            target_collection.update(ids=stale, metadatas=[source_metadata[chunk_id] for chunk_id in stale])
+        if extra or missing or stale:
+            print(f"  Reconciled shard '{shard_name}': {len(extra)} removed, {len(missing)} added, "
+                  f"{len(stale)} metadata updates.")
+
+
+def _timed_search(store, query, k):
+    start = time.perf_counter()
+    hits = store.query(store.embeddings.embed_query(query), n_results=k)
+    return (time.perf_counter() - start) * 1000, [hit[0] for hit in hits]
+
+
+def _latency_summary(samples_ms):
+    if not samples_ms:
+        return {}
+    ordered = sorted(samples_ms)
+    return {
+        "mean": round(statistics.fmean(ordered), 2),
+        "p50": round(ordered[len(ordered) // 2], 2),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+    }
+
+
+def compare_retrieval(source, target, sample_size=None, k=None):
+    """
+    Runs the same queries against both stores: the leading text of randomly
+    sampled chunks. Reports query latency (embedding + search), the mean
+    overlap of the two top-k lists, and how often each model ranks the
+    sampled chunk itself in its top k.
+    """
+    sample_size = sample_size or config.MIGRATION_COMPARE_QUERIES
+    k = k or config.RETRIEVER_K
+    all_ids = source.get(include=[])["ids"]
+    sample_ids = random.Random(0).sample(all_ids, min(sample_size, len(all_ids)))
+    sampled = source.get(include=["documents"], ids=sample_ids) if sample_ids else {"ids": [], "documents": []}
+
+    old_ms, new_ms, overlaps, old_found, new_found = [], [], [], 0, 0
+    for chunk_id, text in zip(sampled["ids"], sampled["documents"]):
+        query = " ".join((text or "").split())[:_QUERY_CHARS]
+        if not query:
+            continue
+        elapsed_old, old_hits = _timed_search(source, query, k)
+        elapsed_new, new_hits = _timed_search(target, query, k)
+        old_ms.append(elapsed_old)
+        new_ms.append(elapsed_new)
+        overlaps.append(len(set(old_hits) & set(new_hits)) / k)
+        old_found += chunk_id in old_hits
+        new_found += chunk_id in new_hits
+
+    queries = len(overlaps)
+    report = {
+        "old_model": source.embeddings.model,
+        "new_model": target.embeddings.model,
+        "queries": queries,
+        "k": k,
+        "old_latency_ms": _latency_summary(old_ms),
+        "new_latency_ms": _latency_summary(new_ms),
+        "mean_top_k_overlap": round(statistics.fmean(overlaps), 3) if overlaps else None,
+        "old_self_recall": round(old_found / queries, 3) if queries else None,
+        "new_self_recall": round(new_found / queries, 3) if queries else None,
+    }
+    print(f"  Retrieval comparison over {queries} sampled queries (k={k}):")
+    print(f"    {report['old_model']}: latency {report['old_latency_ms']}, self-recall {report['old_self_recall']}")
+    print(f"    {report['new_model']}: latency {report['new_latency_ms']}, self-recall {report['new_self_recall']}")
+    print(f"    Mean top-{k} overlap: {report['mean_top_k_overlap']}")
+    return report
+
+
+def _save_report(report):
+    try:
+        os.makedirs(os.path.dirname(config.MIGRATION_REPORT_PATH) or ".", exist_ok=True)
+        with open(config.MIGRATION_REPORT_PATH, "w", encoding="utf-8") as f:
+            json.dump(dict(report, generated_at=time.time()), f, indent=2)
+    except Exception as e:
+        print(f"  WARNING: Could not save the migration report: {e}")
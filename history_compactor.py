@@ -0,0 +1,166 @@
+# history_compactor.py
+"""
+Keeps the {chat_history} block of the chat prompts bounded.
+
+Once a session's history grows past config.HISTORY_SUMMARY_TRIGGER_TOKENS,
+its older turns are folded into a running summary by a background LLM call
+made after the answer has finished streaming. Prompts then carry only that
+summary plus the last config.HISTORY_KEEP_RECENT_TURNS turns.
+
+Summaries are cached in memory per session_id together with a digest of the
+messages they cover, so a summary is only used for the history it was made
+from. A process that has no summary for a long history (e.g. after a
+restart) sends just the recent turns and schedules one.
+"""
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_community.chat_models import ChatOllama
+from langchain_core.messages import SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain.prompts import PromptTemplate
+
+import config
+import token_counter
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+_SUMMARY_PROMPT = PromptTemplate.from_template(
+    """Progressively summarize the conversation between a user and a cryptography assistant, adding onto the previous summary and returning a new summary.
+Keep the topics, definitions, documents and conclusions the user may refer back to. Be concise.
+
+Previous summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
+)
+
+_summary_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+
+
+def estimate_tokens(text):
+    """Token count used for the compaction threshold."""
+    return token_counter.count_tokens(text)
+
+
+def _messages_tokens(messages):
+    return sum(estimate_tokens(message.content) for message in messages)
+
+
+def _digest(messages):
+    digest = hashlib.sha1()
+    for message in messages:
+        digest.update(message.type.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update((message.content or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _format_lines(messages):
+    return "\n".join(f"{'User' if message.type == 'human' else 'Assistant'}: {message.content}" for message in messages)
+
+
+def format_chat_history(chat_history):
+    """`get_chat_history` for the chat chain: renders the summary message and the kept turns."""
+    lines = []
+    for message in chat_history:
+        if message.type == "system":
+            lines.append(message.content)
+        else:
+            lines.append(f"{'Human' if message.type == 'human' else 'Assistant'}: {message.content}")
+    return "\n".join(lines)
+
+
+class HistoryCompactor:
+    """Per-session running summaries (bounded LRU) and the background jobs that update them."""
+
+    def __init__(self, max_sessions=None):
+        self.max_sessions = max_sessions or config.HISTORY_SUMMARY_MAX_SESSIONS
+        self._lock = threading.Lock()
+        self._summaries = OrderedDict()  # session_id -> (summary, covered_count, covered_digest)
+        self._pending = set()
+
+    def _valid_summary(self, session_id, messages):
+        with self._lock:
+            entry = self._summaries.get(session_id)
+            if entry is not None:
+                self._summaries.move_to_end(session_id)
+        if entry is None:
+            return None
+        summary, covered, covered_digest = entry
+        if covered > len(messages) or _digest(messages[:covered]) != covered_digest:
+            return None  # History changed under the summary (e.g. a diverged cookie); don't use it
+        return summary, covered
+
+    def compact(self, session_id, messages):
+        """
+        The messages to put into prompts for this turn: the running summary (as
+        a system message) plus the turns after it, or the full history while it
+        is still short.
+        """
+        keep = config.HISTORY_KEEP_RECENT_TURNS * 2
+        cached = self._valid_summary(session_id, messages)
+        if cached:
+            summary, covered = cached
+            return [SystemMessage(content=SUMMARY_PREFIX + summary)] + list(messages[covered:])
+        if len(messages) > keep and _messages_tokens(messages) > config.HISTORY_SUMMARY_TRIGGER_TOKENS:
+            # No summary yet for a long history: send the recent turns now and build one for next time
+            self.schedule(session_id, messages)
+            return list(messages[-keep:])
+        return list(messages)
+
+    def schedule(self, session_id, messages):
+        """
+        Called once a turn has been answered: if the history outside the kept
+        recent turns is over the threshold, folds it into the summary in the
+        background. Returns True if a summary job was queued.
+        """
+        if not session_id or session_id == "N/A":
+            return False
+        keep = config.HISTORY_KEEP_RECENT_TURNS * 2
+        cached = self._valid_summary(session_id, messages)
+        summary, covered = cached or ("", 0)
+        prompt_tokens = estimate_tokens(summary) + _messages_tokens(messages[covered:])
+        if len(messages) - covered <= keep or prompt_tokens <= config.HISTORY_SUMMARY_TRIGGER_TOKENS:
+            return False
+        with self._lock:
+            if session_id in self._pending:
+                return False
+            self._pending.add(session_id)
+        _summary_pool.submit(self._summarize, session_id, list(messages), summary, covered, len(messages) - keep)
+        return True
+
+    def _summarize(self, session_id, messages, summary, covered, fold_to):
+        try:
+            print(f"  Session {session_id}: Summarizing history messages {covered}-{fold_to} in the background...")
+            inputs = {"summary": summary or "(none)", "new_lines": _format_lines(messages[covered:fold_to])}
+            num_ctx = token_counter.num_ctx_for(
+                config.HISTORY_SUMMARY_MODEL, token_counter.count_tokens(_SUMMARY_PROMPT.format(**inputs)))
+            llm = ChatOllama(model=config.HISTORY_SUMMARY_MODEL, temperature=0, num_ctx=num_ctx)
+            new_summary = (_SUMMARY_PROMPT | llm | StrOutputParser()).invoke(inputs).strip()
+            if not new_summary:
+                return
+            with self._lock:
+                self._summaries[session_id] = (new_summary, fold_to, _digest(messages[:fold_to]))
+                self._summaries.move_to_end(session_id)
+                while len(self._summaries) > self.max_sessions:
+                    self._summaries.popitem(last=False)
+            print(f"  Session {session_id}: History summary updated ({estimate_tokens(new_summary)} tokens, "
+                  f"covers {fold_to} messages).")
+        except Exception as e:
+            print(f"  Session {session_id}: WARNING: History summarization failed: {e}")
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._pending.discard(session_id)
+
+    def forget(self, session_id):
+        with self._lock:
+            self._summaries.pop(session_id, None)
@@ -0,0 +1,157 @@
+# index_publisher.py
+"""
+Atomic publication of index snapshots for multi-process deployments.
+
+The writer process (config.INDEX_ROLE = "writer") owns config.CHROMA_PATH.
+After each write it copies the directory to a new version folder under
+config.INDEX_PUBLISH_DIR and then repoints the CURRENT file at that folder
+with an atomic rename. Read-only replicas (INDEX_ROLE = "reader") only ever
+open complete version folders and switch when CURRENT changes.
+
+    index_versions/
+      CURRENT              -> "v20260101T120000-000003"
+      v20260101T115500-000002/
+      v20260101T120000-000003/
+      leases/<reader id>.json  -> versions that reader still has open
+
+A version is only pruned once it is not current, older than
+config.INDEX_VERSION_GRACE_SECONDS and not named by any reader lease
+refreshed within config.INDEX_LEASE_TTL, so no reader loses a version it is
+still serving (in-flight chats included).
+"""
+import os
+import json
+import shutil
+import socket
+import tempfile
+import itertools
+import time
+from datetime import datetime, timezone
+
+import config
+
+_CURRENT_FILE = "CURRENT"
+_LEASES_DIR = "leases"
+_sequence = itertools.count(1)
+
+
+def current_version():
+    """Name of the currently published version, or None if nothing is published yet."""
+    try:
+        with open(os.path.join(config.INDEX_PUBLISH_DIR, _CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def version_path(version):
+    return os.path.join(config.INDEX_PUBLISH_DIR, version)
+
+
+def _list_versions():
+    if not os.path.isdir(config.INDEX_PUBLISH_DIR):
+        return []
+    return sorted(
+        name for name in os.listdir(config.INDEX_PUBLISH_DIR)
+        if name.startswith("v") and os.path.isdir(version_path(name))
+    )
+
+
+def publish(source_dir):
+    """
+    Copies `source_dir` (the writer's working index) into a new version folder
+    and makes it current. The caller must hold the write lock so the copy is a
+    consistent snapshot. Returns the new version name.
+    """
+    os.makedirs(config.INDEX_PUBLISH_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    version = f"v{stamp}-{os.getpid()}-{next(_sequence):06d}"
+
+    # Copy under a temporary name first so a half-copied folder is never visible as a version
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=config.INDEX_PUBLISH_DIR)
+    try:
+        shutil.copytree(source_dir, staging_dir, dirs_exist_ok=True,
+                        ignore=shutil.ignore_patterns("*.tmp", os.path.basename(config.BUILD_CHECKPOINT_PATH),
+                                                      os.path.basename(config.INGEST_LOG_DIR)))
+        os.replace(staging_dir, version_path(version))
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=config.INDEX_PUBLISH_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(config.INDEX_PUBLISH_DIR, _CURRENT_FILE)) # Atomic switch for readers
+
+    prune()
+    return version
+
+
+def prune():
+    """Deletes versions that are not current, past the grace period and not leased by any reader."""
+    current = current_version()
+    leased = _leased_versions()
+    cutoff = time.time() - config.INDEX_VERSION_GRACE_SECONDS
+    for version in _list_versions():
+        if version == current or version in leased:
+            continue
+        try:
+            if os.path.getmtime(version_path(version)) > cutoff:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(version_path(version), ignore_errors=True)
+
+
+# --- Reader leases ---
+
+def reader_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _lease_path(reader):
+    return os.path.join(config.INDEX_PUBLISH_DIR, _LEASES_DIR, f"{reader}.json")
+
+
+def write_lease(reader, versions):
+    """Records (and refreshes) the versions a reader has open. Readers call this on every poll."""
+    path = _lease_path(reader)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"versions": sorted(set(versions))}, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def remove_lease(reader):
+    try:
+        os.remove(_lease_path(reader))
+    except FileNotFoundError:
+        pass
+
+
+def _leased_versions():
+    """Versions named by fresh leases; leases older than config.INDEX_LEASE_TTL (dead readers) are removed."""
+    leases_dir = os.path.join(config.INDEX_PUBLISH_DIR, _LEASES_DIR)
+    if not os.path.isdir(leases_dir):
+        return set()
+    leased = set()
+    cutoff = time.time() - config.INDEX_LEASE_TTL
+    for name in os.listdir(leases_dir):
+        path = os.path.join(leases_dir, name)
+        if not name.endswith(".json"):
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                leased.update(json.load(f).get("versions", []))
+        except (OSError, ValueError):
+            continue
+    return leased
@@ -0,0 +1,111 @@
+# ingest_log.py
+"""
+Write-ahead log of index updates.
+
+Before the writer changes the index it records the intended update as one
+file in config.INGEST_LOG_DIR, and removes the file once the update is
+persisted. A record holds:
+
+  kind          "replace": release `keys` and add `chunks` (uploads, S3 sync)
+                "progressive": a large PDF indexed page range by page range
+  keys          S3 keys whose current chunk references the update replaces
+  targets       {s3_key: version_id} the update moves each key to
+  chunks        the new chunks (text + metadata) of a "replace" record, so
+                it can be applied again without S3 or a re-parse
+
+Applying an update is idempotent: chunk IDs are content-addressed, the
+collections are upserted and registry writes are INSERT OR IGNORE/REPLACE.
+Every record still present at startup is therefore simply applied again,
+oldest first, so recovery reads the pending records and never the corpus.
+Records are written to a temp file, fsynced and renamed into place: a crash
+leaves either the whole record or none of it.
+"""
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from langchain_core.documents import Document
+
+import config
+
+_FORMAT_VERSION = 1
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # Not supported on this platform (e.g. Windows); the rename is still atomic
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def begin(kind, keys, chunks=(), targets=None):
+    """Durably records an update before it is applied. Returns the record path (pass it to complete)."""
+    os.makedirs(config.INGEST_LOG_DIR, exist_ok=True)
+    op_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"  # Names sort in write order
+    record = {
+        "format": _FORMAT_VERSION,
+        "op_id": op_id,
+        "kind": kind,
+        "keys": sorted(keys),
+        "targets": targets or {},
+        "chunks": [{"text": chunk.page_content, "metadata": chunk.metadata or {}} for chunk in chunks],
+    }
+    path = os.path.join(config.INGEST_LOG_DIR, f"{op_id}.json")
+    fd, tmp_path = tempfile.mkstemp(dir=config.INGEST_LOG_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(record, f, separators=(",", ":"), ensure_ascii=False, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(config.INGEST_LOG_DIR)
+    return path
+
+
+def complete(path):
+    """Drops the record of an update that is fully applied and persisted."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    _fsync_dir(os.path.dirname(path))
+
+
+def pending():
+    """[(path, record)] of every update not yet completed, oldest first. Leftover temp files are removed."""
+    if not os.path.isdir(config.INGEST_LOG_DIR):
+        return []
+    records = []
+    for name in sorted(os.listdir(config.INGEST_LOG_DIR)):
+        path = os.path.join(config.INGEST_LOG_DIR, name)
+        if name.endswith(".tmp"):
+            os.remove(path)  # A record that was never fully written: its update never started
+            continue
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(path, encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"  WARNING: Unreadable ingestion log record '{path}': {e}. Skipping it.")
+            continue
+        if record.get("format") != _FORMAT_VERSION:
+            print(f"  WARNING: Ingestion log record '{path}' has an unknown format. Skipping it.")
+            continue
+        records.append((path, record))
+    return records
+
+
+def record_chunks(record):
+    """The new chunks of a "replace" record as Documents."""
+    return [Document(page_content=c["text"], metadata=c.get("metadata") or {}) for c in record.get("chunks", [])]
@@ -0,0 +1,59 @@
+# manage_shards.py
+"""
+Per-shard maintenance for the vector store (see config.SHARD_STRATEGY).
+
+Usage (from the project root, with the Flask app stopped):
+    python manage_shards.py list
+    python manage_shards.py sync <shard>
+    python manage_shards.py rebuild <shard>
+"""
+import sys
+import argparse
+
+import config
+import s3_handler
+import shard_store
+import vectorstore_handler
+
+
+def _open_store():
+    vectorstore_handler.open_content_registry()
+    vs, _ = vectorstore_handler.open_sharded_store(config.CHROMA_PATH)
+    return vs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["list", "sync", "rebuild"])
+    parser.add_argument("shard", nargs="?", help="Shard (collection) name, as shown by 'list'")
+    args = parser.parse_args()
+
+    vs = _open_store()
+    if vs is None:
+        print("Could not initialize the embeddings model.")
+        return 1
+
+    if args.command == "list":
+        keys_by_shard = {}
+        for s3_key in vectorstore_handler.registry.file_versions():
+            keys_by_shard.setdefault(shard_store.shard_for_key(s3_key), []).append(s3_key)
+        print(f"Sharding strategy: {config.SHARD_STRATEGY}")
+        for name in vs.shard_names():
+            print(f"  {name:<60} {vs.count([name]):>8} chunks {len(keys_by_shard.get(name, [])):>6} files")
+        return 0
+
+    if not args.shard:
+        parser.error(f"'{args.command}' needs a shard name")
+    s3_client = s3_handler.get_s3_client()
+    if not s3_client:
+        print("Could not initialize the S3 client.")
+        return 1
+    if args.command == "sync":
+        vectorstore_handler.sync_with_s3(vs, s3_client, shard_name=args.shard)
+    else:
+        vectorstore_handler.rebuild_shard(vs, s3_client, args.shard)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# migrate_metadata.py
+"""
+Rewrites the chunk metadata of an existing vector store in place to the
+compact schema (see vectorstore_handler.compact_chunk_metadata): each chunk
+keeps its owner S3 key and position fields, while URLs, version IDs,
+timestamps and fingerprints are read from the content registry instead of
+being repeated on every chunk. No chunk is re-embedded.
+
+Usage (from the project root, with the Flask app stopped):
+    python migrate_metadata.py [--dry-run] [--queries 50]
+
+Prints the on-disk size, metadata bytes, full metadata scan time and query
+latency before and after the rewrite.
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import statistics
+
+import config
+import vectorstore_handler
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def _measure(vs, query_vectors):
+    """Storage size, metadata volume, full metadata scan time and query latency of the store."""
+    start = time.perf_counter()
+    metadatas = vs.get(include=["metadatas"]).get("metadatas") or []
+    scan_seconds = time.perf_counter() - start
+    latencies = []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        vs.query(vector, n_results=config.RETRIEVER_K)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    sqlite_path = os.path.join(vs.persist_directory, "chroma.sqlite3")
+    return {
+        "chunks": len(metadatas),
+        "dir_mb": _dir_size(vs.persist_directory) / 1e6,
+        "sqlite_mb": os.path.getsize(sqlite_path) / 1e6 if os.path.exists(sqlite_path) else 0.0,
+        "metadata_kb": sum(len(json.dumps(md or {})) for md in metadatas) / 1e3,
+        "scan_s": scan_seconds,
+        "query_p50_ms": statistics.median(latencies) if latencies else 0.0,
+        "query_p95_ms": _percentile(latencies, 0.95),
+    }
+
+
+def _sample_query_vectors(vs, count):
+    """Stored chunk vectors used as queries, so latency is measured without the embeddings server."""
+    ids = vs.get(include=[]).get("ids") or []
+    sample_ids = random.Random(0).sample(ids, min(count, len(ids)))
+    if not sample_ids:
+        return []
+    return [list(vector) for vector in vs.get(include=["embeddings"], ids=sample_ids)["embeddings"]]
+
+
+def compact_shard(store, shard_name, dry_run=False):
+    """Rewrites one shard's metadata page by page. Returns the number of chunks changed."""
+    collection = store.shard(shard_name)._collection
+    changed = 0
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=config.MIGRATION_PAGE_SIZE, offset=offset)
+        ids = page.get("ids") or []
+        if not ids:
+            break
+        offset += len(ids)
+        update_ids, update_metadatas = [], []
+        for chunk_id, metadata in zip(ids, page["metadatas"]):
+            metadata = metadata or {}
+            compact = vectorstore_handler.compact_chunk_metadata(metadata)
+            if compact == metadata:
+                continue
+            # Chroma merges metadata on update; a None value removes the key
+            removed = {key: None for key in metadata if key not in compact}
+            update_ids.append(chunk_id)
+            update_metadatas.append({**removed, **compact})
+        if update_ids and not dry_run:
+            collection.update(ids=update_ids, metadatas=update_metadatas)
+        changed += len(update_ids)
+    return changed
+
+
+def _vacuum(persist_directory):
+    sqlite_path = os.path.join(persist_directory, "chroma.sqlite3")
+    if not os.path.exists(sqlite_path):
+        return
+    conn = sqlite3.connect(sqlite_path)
+    try:
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="Count the chunks that would change; write nothing")
+    parser.add_argument("--queries", type=int, default=50, help="Sampled queries for the latency measurement")
+    args = parser.parse_args()
+
+    vectorstore_handler.open_content_registry()
+    vs, _ = vectorstore_handler.open_sharded_store(config.CHROMA_PATH)
+    if vs is None:
+        print("Could not initialize the embeddings model.")
+        return 1
+    if vs.count() == 0:
+        print("The vector store is empty; nothing to migrate.")
+        return 0
+
+    # The registry must hold every file's details before they are stripped from the chunks
+    vectorstore_handler.get_processed_files_from_db(vs)
+
+    query_vectors = _sample_query_vectors(vs, args.queries)
+    before = _measure(vs, query_vectors)
+
+    print(f"Compacting chunk metadata in '{config.CHROMA_PATH}'{' (dry run)' if args.dry_run else ''}...")
+    changed = 0
+    for shard_name in vs.shard_names():
+        shard_changed = compact_shard(vs, shard_name, dry_run=args.dry_run)
+        print(f"  {shard_name:<60} {shard_changed:>8} chunks rewritten")
+        changed += shard_changed
+    if args.dry_run:
+        print(f"{changed} of {before['chunks']} chunks would be rewritten.")
+        return 0
+    print("  Reclaiming free space (VACUUM)...")
+    _vacuum(vs.persist_directory)
+
+    after = _measure(vs, query_vectors)
+    rows = [
+        ("Directory size (MB)", "dir_mb", "{:.1f}"),
+        ("chroma.sqlite3 (MB)", "sqlite_mb", "{:.1f}"),
+        ("Metadata JSON (KB)", "metadata_kb", "{:.1f}"),
+        ("Full metadata scan (s)", "scan_s", "{:.3f}"),
+        ("Query p50 (ms)", "query_p50_ms", "{:.2f}"),
+        ("Query p95 (ms)", "query_p95_ms", "{:.2f}"),
+    ]
+    header = f"{'':<24} {'before':>10} {'after':>10}"
+    print(f"\n{changed} of {before['chunks']} chunks rewritten, {len(query_vectors)} sampled queries.")
+    print(header)
+    print("-" * len(header))
+    for label, field, fmt in rows:
+        print(f"{label:<24} {fmt.format(before[field]):>10} {fmt.format(after[field]):>10}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+# parse_cache.py
+"""
+Cache of extracted document text, keyed by (s3_key, VersionId).
+
+An S3 object version never changes, so the loader output for it can be reused
+forever: re-chunking with new CHUNK_SIZE/CHUNK_OVERLAP or re-embedding with a
+new model skips both the S3 download and the (slow) PDF/PPTX parse.
+
+Entries are gzip-compressed JSON stored under config.PARSE_CACHE_DIR and,
+when config.PARSE_CACHE_S3_PREFIX is set, mirrored to that S3 prefix so new
+nodes can start warm.
+"""
+import io
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+
+from botocore.exceptions import ClientError
+from langchain_core.documents import Document
+
+import config
+
+_FORMAT_VERSION = 1
+
+
+def _entry_name(s3_key, version_id):
+    digest = hashlib.sha256(f"{s3_key}\0{version_id}".encode("utf-8")).hexdigest()
+    return f"{digest}.json.gz"
+
+
+def _local_path(s3_key, version_id):
+    return os.path.join(config.PARSE_CACHE_DIR, _entry_name(s3_key, version_id))
+
+
+def _s3_mirror_key(s3_key, version_id):
+    return f"{config.PARSE_CACHE_S3_PREFIX.rstrip('/')}/{_entry_name(s3_key, version_id)}"
+
+
+def _encode(s3_key, version_id, docs):
+    payload = {
+        "format": _FORMAT_VERSION,
+        "s3_key": s3_key,
+        "version_id": version_id,
+        "docs": [{"text": doc.page_content, "metadata": doc.metadata or {}} for doc in docs],
+    }
+    raw = json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+    return gzip.compress(raw, compresslevel=6)
+
+
+def _decode(blob, s3_key, version_id):
+    payload = json.loads(gzip.decompress(blob).decode("utf-8"))
+    if payload.get("format") != _FORMAT_VERSION or payload.get("s3_key") != s3_key \
+            or payload.get("version_id") != version_id:
+        return None
+    return [Document(page_content=d["text"], metadata=d.get("metadata") or {}) for d in payload["docs"]]
+
+
+def _write_local(path, blob):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+        os.replace(tmp_path, path) # Atomic: readers never see a partial entry
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def is_enabled():
+    return config.PARSE_CACHE_ENABLED
+
+
+def get(s3_key, version_id, s3_client=None):
+    """
+    Returns the cached loader output (list of Documents) for this object version,
+    or None on a miss. Falls back to the S3 mirror when the local entry is missing.
+    """
+    if not is_enabled() or not version_id:
+        return None
+    path = _local_path(s3_key, version_id)
+    try:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                docs = _decode(f.read(), s3_key, version_id)
+            if docs is not None:
+                print(f"    Parse cache hit (local) for {s3_key} @ {version_id}")
+                return docs
+
+        if s3_client and config.PARSE_CACHE_S3_PREFIX:
+            buffer = io.BytesIO()
+            s3_client.download_fileobj(config.S3_BUCKET_NAME, _s3_mirror_key(s3_key, version_id), buffer)
+            blob = buffer.getvalue()
+            docs = _decode(blob, s3_key, version_id)
+            if docs is not None:
+                _write_local(path, blob)
+                print(f"    Parse cache hit (S3 mirror) for {s3_key} @ {version_id}")
+                return docs
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+            print(f"    WARNING: Parse cache S3 mirror read failed for {s3_key}: {e}")
+    except Exception as e:
+        print(f"    WARNING: Ignoring unreadable parse cache entry for {s3_key}: {e}")
+    return None
+
+
+def put(s3_key, version_id, docs, s3_client=None):
+    """Stores the loader output for this object version locally (and in the S3 mirror if configured)."""
+    if not is_enabled() or not version_id or not docs:
+        return
+    try:
+        blob = _encode(s3_key, version_id, docs)
+        _write_local(_local_path(s3_key, version_id), blob)
+        if s3_client and config.PARSE_CACHE_S3_PREFIX:
+            s3_client.upload_fileobj(io.BytesIO(blob), config.S3_BUCKET_NAME, _s3_mirror_key(s3_key, version_id))
+        print(f"    Cached parsed text for {s3_key} @ {version_id} ({len(docs)} docs, {len(blob)} bytes compressed)")
+    except Exception as e:
+        print(f"    WARNING: Failed to write parse cache entry for {s3_key}: {e}")
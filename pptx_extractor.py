@@ -0,0 +1,125 @@
+# pptx_extractor.py
+"""
+Fast text extraction for .pptx decks.
+
+Reads the Office Open XML parts directly (zipfile + ElementTree) instead of
+going through Unstructured, and produces one Document per slide with the
+slide's text and speaker notes aggregated.
+"""
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+
+from langchain_core.documents import Document
+
+import config
+
+# --- OOXML Namespaces ---
+_NS = {
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+    "p": "http://schemas.openxmlformats.org/presentationml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+_A_P = f"{{{_NS['a']}}}p"
+_A_T = f"{{{_NS['a']}}}t"
+_A_BR = f"{{{_NS['a']}}}br"
+_P_SP = f"{{{_NS['p']}}}sp"
+_R_ID = f"{{{_NS['r']}}}id"
+_NOTES_SLIDE_REL_TYPE = "/notesSlide"
+
+# Placeholder types whose text is boilerplate (slide numbers, dates, footers)
+_SKIPPED_PLACEHOLDER_TYPES = {"sldNum", "dt", "ftr", "sldImg"}
+
+
+def _read_rels(zf, part_name):
+    """Returns {rId: (type, absolute target part)} for a package part."""
+    folder, filename = posixpath.split(part_name)
+    rels_name = posixpath.join(folder, "_rels", f"{filename}.rels")
+    if rels_name not in zf.namelist():
+        return {}
+    rels = {}
+    root = ET.fromstring(zf.read(rels_name))
+    for rel in root.findall("rel:Relationship", _NS):
+        if rel.get("TargetMode") == "External":
+            continue
+        target = posixpath.normpath(posixpath.join(folder, rel.get("Target", "")))
+        rels[rel.get("Id")] = (rel.get("Type", ""), target)
+    return rels
+
+
+def _placeholder_type(shape):
+    ph = shape.find("p:nvSpPr/p:nvPr/p:ph", _NS)
+    return ph.get("type") if ph is not None else None
+
+
+def _collect_paragraphs(element, paragraphs):
+    """Walks the shape tree collecting paragraph text, skipping boilerplate placeholders."""
+    for child in element:
+        if child.tag == _P_SP and _placeholder_type(child) in _SKIPPED_PLACEHOLDER_TYPES:
+            continue
+        if child.tag == _A_P:
+            parts = []
+            for node in child.iter():
+                if node.tag == _A_T and node.text:
+                    parts.append(node.text)
+                elif node.tag == _A_BR:
+                    parts.append("\n")
+            text = "".join(parts).strip()
+            if text:
+                paragraphs.append(text)
+            continue
+        _collect_paragraphs(child, paragraphs)
+
+
+def _part_text(zf, part_name):
+    paragraphs = []
+    _collect_paragraphs(ET.fromstring(zf.read(part_name)), paragraphs)
+    return "\n".join(paragraphs)
+
+
+def _ordered_slide_parts(zf):
+    """Slide part names in presentation order (as listed in presentation.xml)."""
+    presentation_part = "ppt/presentation.xml"
+    rels = _read_rels(zf, presentation_part)
+    root = ET.fromstring(zf.read(presentation_part))
+    slide_parts = []
+    for sld_id in root.findall("p:sldIdLst/p:sldId", _NS):
+        rel = rels.get(sld_id.get(_R_ID))
+        if rel and rel[1] in zf.namelist():
+            slide_parts.append(rel[1])
+    return slide_parts
+
+
+def extract_slides(file_path):
+    """
+    Returns a list of (slide_number, slide_text, notes_text) tuples for a .pptx file.
+    Raises zipfile.BadZipFile / KeyError / ET.ParseError for files that are not valid .pptx.
+    """
+    slides = []
+    with zipfile.ZipFile(file_path) as zf:
+        for slide_number, slide_part in enumerate(_ordered_slide_parts(zf), start=1):
+            slide_text = _part_text(zf, slide_part)
+            notes_text = ""
+            for rel_type, target in _read_rels(zf, slide_part).values():
+                if rel_type.endswith(_NOTES_SLIDE_REL_TYPE) and target in zf.namelist():
+                    notes_text = _part_text(zf, target)
+                    break
+            slides.append((slide_number, slide_text, notes_text))
+    return slides
+
+
+def load_pptx(file_path):
+    """Loads a .pptx file into one Document per non-empty slide (slide text followed by notes)."""
+    docs = []
+    for slide_number, slide_text, notes_text in extract_slides(file_path):
+        content = slide_text
+        if notes_text:
+            content = f"{content}\n\nSpeaker Notes:\n{notes_text}" if content else f"Speaker Notes:\n{notes_text}"
+        if not content.strip():
+            continue
+        docs.append(Document(
+            page_content=content,
+            metadata={"source": file_path, config.SLIDE_NUMBER_METADATA_KEY: slide_number},
+        ))
+    return docs
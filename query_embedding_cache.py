@@ -0,0 +1,189 @@
+# query_embedding_cache.py
+"""
+LRU cache of query embeddings in front of the chat retriever.
+
+Entries are keyed on the embedding model and the normalized question text
+(content_registry.normalize_text: Unicode-normalized, case-folded,
+whitespace-collapsed), so repeated questions skip the round trip to Ollama.
+The cache only ever holds vectors of one model: the first lookup with a
+different model (after an embedding migration or a published switch) drops
+every entry.
+
+Misses that arrive within config.QUERY_EMBEDDING_BATCH_WINDOW_MS of each
+other are embedded together: the first miss waits out the window, then
+sends every text queued meanwhile for that model as one Ollama /api/embed
+request (the langchain OllamaEmbeddings client posts one /api/embeddings
+request per text). /api/embed returns unit-length vectors while the chunks
+were embedded through /api/embeddings, and Chroma ranks by L2 distance, so
+the first batch of each model is checked against embed_query: batching
+stays on only if both return the same vector, otherwise that model falls
+back to one embed_query call per miss. A miss for a text that is already
+queued or being embedded under the same model waits for that result.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import ollama
+
+import config
+import content_registry
+
+# embed_query and /api/embed agree if their vectors differ by less than this (relative L2 norm)
+_BATCH_MATCH_TOLERANCE = 1e-3
+
+
+def _relative_difference(vector, reference):
+    norm = math.sqrt(sum(x * x for x in reference)) or 1.0
+    return math.sqrt(sum((a - b) ** 2 for a, b in zip(vector, reference))) / norm
+
+
+def _embed_batch(embeddings, texts):
+    """Query vectors for `texts` from one Ollama /api/embed request, with embed_query's instruction prefix."""
+    client = ollama.Client(host=getattr(embeddings, "base_url", None))
+    instruction = getattr(embeddings, "query_instruction", None) or ""
+    options = {name: value for name, value in (getattr(embeddings, "_default_params", {}).get("options") or {}).items()
+               if value is not None}
+    response = client.embed(model=embeddings.model, input=[f"{instruction}{text}" for text in texts],
+                            options=options or None)
+    vectors = [list(vector) for vector in response["embeddings"]]
+    if len(vectors) != len(texts):
+        raise ValueError(f"/api/embed returned {len(vectors)} vectors for {len(texts)} inputs")
+    return vectors
+
+
+class QueryEmbeddingCache:
+    """Thread-safe LRU of query vectors with micro-batched, coalesced misses and hit-rate counters."""
+
+    def __init__(self, max_entries=None, batch_window_ms=None):
+        self.max_entries = config.QUERY_EMBEDDING_CACHE_SIZE if max_entries is None else max_entries
+        self.batch_window = (config.QUERY_EMBEDDING_BATCH_WINDOW_MS if batch_window_ms is None else batch_window_ms) / 1000
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # normalized text -> vector
+        self._model = None
+        self._in_flight = {}  # (model, normalized text) -> Future, queued or being embedded
+        self._queues = {}  # model -> [(normalized text, text, future)] waiting for that model's next batch
+        self._batch_ok = {}  # model -> whether /api/embed matches embed_query (unknown until its first batch)
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._batches = 0
+        self._batched_texts = 0
+
+    def embed_query(self, embeddings, text):
+        """The query vector of `text` under `embeddings`, from the cache when possible."""
+        model = getattr(embeddings, "model", None)
+        key = content_registry.normalize_text(text)
+        with self._lock:
+            if model != self._model:
+                if self._entries:
+                    print(f"  Query embedding cache: model changed to '{model}', dropping {len(self._entries)} entries.")
+                self._entries.clear()
+                self._model = model
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return vector
+            self._misses += 1
+            future = self._in_flight.get((model, key))
+            if future is not None:
+                self._coalesced += 1
+                leader = batched = False
+            else:
+                future = Future()
+                self._in_flight[(model, key)] = future
+                batched = (self.batch_window > 0 and self._batch_ok.get(model) is not False
+                           and hasattr(embeddings, "base_url"))  # Only Ollama embeddings have a batch endpoint
+                if batched:
+                    queue = self._queues.setdefault(model, [])
+                    queue.append((key, text, future))
+                    leader = len(queue) == 1  # The first miss of a window runs the batch
+                else:
+                    leader = True
+        if leader and batched:
+            self._run_batch(embeddings, model)
+        elif leader:
+            self._finish(model, [(key, text, future)], embeddings.embed_query, None)
+        return future.result()
+
+    def _run_batch(self, embeddings, model):
+        time.sleep(self.batch_window)
+        with self._lock:
+            batch = self._queues.pop(model, [])
+        texts = [text for _, text, _ in batch]
+        try:
+            vectors = _embed_batch(embeddings, texts)
+            if self._batch_ok.get(model) is None:
+                vectors = self._check_batch_endpoint(embeddings, model, texts, vectors)
+        except Exception as e:
+            print(f"  Query embedding cache: batch embedding failed for '{model}' ({e}); embedding these queries one at a time.")
+            if getattr(e, "status_code", None) == 404:  # Ollama server without /api/embed
+                with self._lock:
+                    self._batch_ok[model] = False
+            vectors = None
+        if vectors is None:
+            self._finish(model, batch, embeddings.embed_query, None)
+            return
+        with self._lock:
+            self._batches += 1
+            self._batched_texts += len(batch)
+        self._finish(model, batch, None, vectors)
+
+    def _check_batch_endpoint(self, embeddings, model, texts, vectors):
+        """Compares the first batch of a model with embed_query; returns the vectors, or None if they differ."""
+        reference = embeddings.embed_query(texts[0])
+        matches = len(reference) == len(vectors[0]) and _relative_difference(vectors[0], reference) < _BATCH_MATCH_TOLERANCE
+        with self._lock:
+            self._batch_ok[model] = matches
+        if not matches:
+            print(f"  Query embedding cache: /api/embed vectors of '{model}' differ from embed_query "
+                  "(normalization); embedding one query at a time.")
+            return None
+        return vectors
+
+    def _finish(self, model, batch, embed_one, vectors):
+        """Resolves the futures of `batch` with `vectors`, or with embed_one(text) per text."""
+        for index, (key, text, future) in enumerate(batch):
+            try:
+                vector = vectors[index] if vectors is not None else embed_one(text)
+            except Exception as e:
+                with self._lock:
+                    self._in_flight.pop((model, key), None)
+                future.set_exception(e)
+                continue
+            with self._lock:
+                self._in_flight.pop((model, key), None)
+                if model == self._model and self.max_entries > 0:  # Not stored if the model changed meanwhile
+                    self._entries[key] = vector
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            future.set_result(vector)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "model": self._model,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else None,
+                "coalesced_misses": self._coalesced,
+                "batch_window_ms": round(self.batch_window * 1000, 3),
+                "batching": self._batch_ok.get(self._model),
+                "embedding_batches": self._batches,
+                "mean_batch_size": round(self._batched_texts / self._batches, 2) if self._batches else None,
+            }
+
+
+# Shared by every chat chain of this process
+query_cache = QueryEmbeddingCache()
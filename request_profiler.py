@@ -0,0 +1,194 @@
+# request_profiler.py
+"""
+Opt-in per-request profiling for the chat and upload routes.
+
+A RequestProfile samples the Python stacks of the threads serving one
+request (the request thread plus any worker it registers, e.g. the chain
+thread of a chat) every config.PROFILE_SAMPLE_INTERVAL_MS using
+sys._current_frames(), and records named stage timings and request details
+(retrieved chunk IDs, prompt token counts, ...). When the request finishes
+two files are written to config.PROFILE_DIR:
+
+  <name>.collapsed  folded stacks ("thread;outer;...;inner count" per line),
+                    the input format of flamegraph.pl and speedscope
+  <name>.json       stages, details and sampling statistics
+
+Only the newest config.PROFILE_MAX_KEPT profiles are kept. When profiling
+is off no profile object exists and nothing here runs.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from contextlib import nullcontext
+
+import config
+
+_retention_lock = threading.Lock()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _folded_stack(thread_name, frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ";".join(reversed(labels))
+
+
+class RequestProfile:
+    """Sampling profiler and stage recorder for one request."""
+
+    def __init__(self, kind, label=""):
+        self.kind = kind
+        self.label = label
+        self.profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}_{kind}_{uuid.uuid4().hex[:8]}"
+        self.interval = config.PROFILE_SAMPLE_INTERVAL_MS / 1000
+        self.details = {}
+        self._stages = {}  # name -> [start offset, duration] in seconds
+        self._marks = {}  # name -> offset from the start in seconds
+        self._threads = {}  # ident -> name
+        self._samples = Counter()
+        self._sample_count = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._started = None
+        self._finished = False
+
+    # --- Lifecycle ---
+    def start(self):
+        self._started = time.perf_counter()
+        self.track(threading.current_thread())
+        self._sampler = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+        self._sampler.start()
+        return self
+
+    def track(self, thread):
+        """Adds a thread (e.g. a worker running part of this request) to the sampled set."""
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = dict(self._threads)
+            for ident, name in threads.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._samples[_folded_stack(name, frame)] += 1
+            self._sample_count += 1
+
+    def finish(self, **details):
+        """Stops sampling and writes the profile files. Safe to call more than once (and if never started)."""
+        if self._finished:
+            return None
+        self._finished = True
+        if self._started is None:
+            return None
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join(timeout=1)
+        self.details.update(details)
+        try:
+            return self._save()
+        except Exception as e:
+            print(f"  WARNING: Could not save request profile {self.profile_id}: {e}")
+            traceback.print_exc()
+            return None
+
+    # --- Recording ---
+    def stage(self, name):
+        """Context manager timing one named stage."""
+        return _Stage(self, name)
+
+    def mark(self, name):
+        """Records when `name` first happened, as an offset from the start of the request."""
+        if name not in self._marks:
+            self._marks[name] = time.perf_counter() - self._started
+
+    def record(self, **details):
+        self.details.update(details)
+
+    # --- Output ---
+    def _save(self):
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        base = os.path.join(config.PROFILE_DIR, self.profile_id)
+        with open(base + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, count in self._samples.most_common():
+                f.write(f"{stack} {count}\n")
+        summary = {
+            "profile_id": self.profile_id,
+            "kind": self.kind,
+            "label": self.label,
+            "wall_ms": round((time.perf_counter() - self._started) * 1000, 1),
+            "sample_interval_ms": config.PROFILE_SAMPLE_INTERVAL_MS,
+            "samples": self._sample_count,
+            "stages_ms": {name: {"start": round(start * 1000, 1), "duration": round(duration * 1000, 1)}
+                          for name, (start, duration) in self._stages.items()},
+            "marks_ms": {name: round(offset * 1000, 1) for name, offset in self._marks.items()},
+            "details": self.details,
+        }
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, default=str)
+        _enforce_retention()
+        print(f"  Request profile saved: {base}.collapsed ({self._sample_count} samples, {summary['wall_ms']} ms)")
+        return base
+
+
+class _Stage:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.profile._stages[self.name] = [self.start - self.profile._started, end - self.start]
+        return False
+
+
+def stage(profile, name):
+    """`profile.stage(name)`, or a no-op context when the request is not profiled."""
+    return profile.stage(name) if profile else nullcontext()
+
+
+def profiled_stream(profile, stream):
+    """
+    Wraps an SSE generator so sampling starts on the thread iterating it, when
+    the first event is requested, and the profile is written when the stream
+    ends (also when the client leaves). Pass an unstarted profile; a response
+    that is never iterated then never starts a sampler thread.
+    """
+    profile.start()
+    try:
+        yield from stream
+    finally:
+        profile.finish()
+
+
+def _enforce_retention():
+    """Deletes the oldest profiles beyond config.PROFILE_MAX_KEPT."""
+    with _retention_lock:
+        try:
+            names = sorted(name[:-len(".json")] for name in os.listdir(config.PROFILE_DIR) if name.endswith(".json"))
+        except FileNotFoundError:
+            return
+        for name in names[:max(0, len(names) - config.PROFILE_MAX_KEPT)]:
+            for suffix in (".json", ".collapsed"):
+                path = os.path.join(config.PROFILE_DIR, name + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
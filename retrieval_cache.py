@@ -0,0 +1,134 @@
+# retrieval_cache.py
+"""
+LRU cache of final retriever results.
+
+Many chat turns condense to the same standalone question and would search
+Chroma again for the same top k. An entry is keyed on the embedding model,
+the question vector quantized to float16 (so vectors that differ only in
+float noise share an entry), and a signature of the retrieval settings (k,
+fetch_k, scope filter, document stage, MMR). It stores what the retriever
+returned: per chunk its ID, owner key, distance and source URLs.
+
+Entries belong to the corpus version they were computed for
+(vectorstore_handler.corpus_version, bumped by every index write, snapshot
+swap and model switch), so a stale result is never served: the first lookup
+under a newer version drops every entry. A retriever records the version it
+was built at and only uses the cache while that is still the live version,
+so results from a superseded store are never filed under a newer one. Memory is bounded by config.RETRIEVAL_CACHE_MAX_MB (estimated
+entry sizes), evicting least recently used entries first.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+import config
+
+# One cached hit, in returned order
+CachedHit = namedtuple("CachedHit", "chunk_id s3_key distance source_urls")
+
+_ENTRY_OVERHEAD_BYTES = 256
+_HIT_OVERHEAD_BYTES = 200
+
+
+def _json_default(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+
+def cache_key(model, embedding, settings):
+    """Digest of the model, the float16-quantized query vector and the retrieval settings."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(model).encode("utf-8"))
+    digest.update(np.asarray(embedding, dtype=np.float16).tobytes())
+    digest.update(json.dumps(settings, sort_keys=True, default=_json_default).encode("utf-8"))
+    return digest.digest()
+
+
+def _entry_size(hits):
+    return _ENTRY_OVERHEAD_BYTES + sum(
+        _HIT_OVERHEAD_BYTES + len(hit.chunk_id) + len(hit.s3_key or "") + sum(len(url or "") for url in hit.source_urls)
+        for hit in hits)
+
+
+class RetrievalResultCache:
+    """Thread-safe, memory-bounded LRU of retriever results tied to one corpus version."""
+
+    def __init__(self, max_mb=None):
+        self.max_bytes = int((config.RETRIEVAL_CACHE_MAX_MB if max_mb is None else max_mb) * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (hits, size)
+        self._bytes = 0
+        self._corpus_version = None
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._evictions = 0
+
+    def _sync_version(self, corpus_version):
+        # Called with the lock held; entries of an older corpus can never be served again
+        if corpus_version == self._corpus_version:
+            return
+        if self._corpus_version is not None and corpus_version < self._corpus_version:
+            return  # A lookup that read the version before a concurrent write: it just misses
+        if self._entries:
+            self._invalidations += 1
+        self._entries.clear()
+        self._bytes = 0
+        self._corpus_version = corpus_version
+
+    def get(self, key, corpus_version):
+        """The cached hits for `key` under `corpus_version`, or None."""
+        with self._lock:
+            self._sync_version(corpus_version)
+            entry = self._entries.get(key) if corpus_version == self._corpus_version else None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key, corpus_version, hits):
+        hits = list(hits)
+        size = _entry_size(hits)
+        with self._lock:
+            self._sync_version(corpus_version)
+            if corpus_version != self._corpus_version or size > self.max_bytes:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (hits, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "corpus_version": self._corpus_version,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else None,
+                "invalidations": self._invalidations,
+                "evictions": self._evictions,
+            }
+
+
+# Shared by every chat chain of this process
+result_cache = RetrievalResultCache()
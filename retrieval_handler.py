@@ -0,0 +1,272 @@
+# retrieval_handler.py
+"""
+Retriever used by the chat chain.
+
+Queries the sharded Chroma store directly (fanning out to the relevant shards)
+so every hit keeps its chunk ID. With a document stage enabled it first picks
+the closest documents from the per-key document index and searches only their
+chunks. Then it:
+  - drops hits outside an allowed chunk set (scoped retrieval over shared chunks),
+  - attaches every S3 key that references each chunk (deduplicated storage),
+  - collapses near-duplicate hits so the context is not filled with copies,
+  - re-ranks the remaining pool by maximal marginal relevance with a cap on
+    chunks per source file, so the top k are not consecutive pages of one PDF.
+With a result cache, a repeated question (same vector, settings and corpus
+version) skips all of this and fetches its cached chunks by ID.
+"""
+import re
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import config
+import retrieval_cache
+import s3_handler
+import shard_store
+
+_WORD_RE = re.compile(r"\w+")
+_SHINGLE_SIZE = 3
+
+
+def _shingles(text):
+    words = _WORD_RE.findall((text or "").casefold())
+    if len(words) <= _SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + _SHINGLE_SIZE]) for i in range(len(words) - _SHINGLE_SIZE + 1)}
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def collapse_near_duplicates(docs, threshold):
+    """
+    Keeps the best-ranked document of each group of near-duplicates (word-shingle
+    Jaccard similarity >= threshold). Source URLs of dropped copies are merged
+    into the kept document so citations still list every file.
+    """
+    kept, kept_shingles = [], []
+    for doc in docs:
+        shingles = _shingles(doc.page_content)
+        match = next((i for i, other in enumerate(kept_shingles) if _jaccard(shingles, other) >= threshold), None)
+        if match is None:
+            kept.append(doc)
+            kept_shingles.append(shingles)
+            continue
+        urls = kept[match].metadata.setdefault(config.SOURCE_URLS_METADATA_KEY, [])
+        for url in doc.metadata.get(config.SOURCE_URLS_METADATA_KEY) or [doc.metadata.get(config.S3_URL_METADATA_KEY)]:
+            if url and url not in urls:
+                urls.append(url)
+    return kept
+
+
+def mmr_select(query_embedding, candidate_embeddings, k, lambda_mult=0.7, source_ids=None, max_per_source=0):
+    """
+    Indices of up to `k` candidates chosen by maximal marginal relevance:
+    each pick maximizes lambda * sim(query) - (1 - lambda) * max sim(picked),
+    using cosine similarity. Candidates are in relevance order. With
+    `max_per_source`, a source (e.g. S3 key) that already has that many picks
+    is skipped while other sources have candidates left (so a single-document
+    pool still yields k). One similarity matrix is computed for the whole pool; each of
+    the k steps is a few vector operations over it.
+    """
+    vectors = np.asarray(candidate_embeddings, dtype=np.float32)
+    if vectors.ndim != 2 or not len(vectors) or k <= 0:
+        return []
+    query = np.asarray(query_embedding, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+
+    n = len(vectors)
+    available = np.ones(n, dtype=bool)
+    capped = np.zeros(n, dtype=bool)
+    redundancy = np.full(n, -np.inf, dtype=np.float32)  # Max similarity to anything picked so far
+    if max_per_source and source_ids is not None:
+        _, source_index = np.unique(np.asarray(source_ids, dtype=object).astype(str), return_inverse=True)
+        source_counts = np.zeros(source_index.max() + 1, dtype=np.int32)
+    else:
+        source_index = None
+
+    picked = []
+    while len(picked) < k and available.any():
+        if picked:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        else:
+            scores = relevance.copy()
+        eligible = available & ~capped
+        scores[~(eligible if eligible.any() else available)] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+        if source_index is not None:
+            source = source_index[best]
+            source_counts[source] += 1
+            if source_counts[source] >= max_per_source:
+                capped[source_index == source] = True
+    return picked
+
+
+class CorpusRetriever(BaseRetriever):
+    """Similarity retriever over the sharded store with scope post-filtering and duplicate collapsing."""
+
+    vectorstore: Any  # shard_store.ShardedStore
+    k: int = config.RETRIEVER_K
+    fetch_k: int = config.RETRIEVER_FETCH_K
+    where: Optional[dict] = None
+    shard_names: Optional[list] = None  # None searches every shard
+    allowed_ids: Optional[set] = None
+    source_keys_for: Optional[Callable] = None  # chunk_ids -> {chunk_id: [s3_key, ...]}
+    near_duplicate_threshold: float = config.NEAR_DUPLICATE_THRESHOLD
+    document_top_n: int = 0  # Coarse stage size; 0 disables it
+    document_where: Optional[dict] = None  # Scope filter for the document index
+    search_filter_for: Optional[Callable] = None  # s3_keys -> {'where', 'shard_names', 'allowed_ids', ...}
+    expand_metadata: Optional[Callable] = None  # Joins per-document fields onto compact stored metadata (in place)
+    mmr_lambda: float = 1.0  # Below 1.0 the candidate pool is re-ranked by MMR
+    max_per_source: int = 0  # Cap on returned chunks per owner S3 key; 0 = no cap
+    embed_query: Optional[Callable] = None  # (embeddings, text) -> query vector, e.g. a cache; default embeds directly
+    result_cache: Any = None  # retrieval_cache.RetrievalResultCache; None disables result caching
+    corpus_version: Optional[int] = None  # Corpus version when the retriever (and its store) was built
+    current_corpus_version: Optional[Callable] = None  # () -> live corpus version; the cache is used only while equal
+
+    def _search_filter(self, embedding):
+        """Chunk search arguments: narrowed to the top documents when the document stage finds any."""
+        search_filter = {'where': self.where, 'shard_names': self.shard_names, 'allowed_ids': self.allowed_ids}
+        if not self.document_top_n or not self.search_filter_for:
+            return search_filter
+        doc_keys = self.vectorstore.query_documents(embedding, self.document_top_n, where=self.document_where)
+        if doc_keys:
+            # The document stage already applied the scope, so its keys replace the scope filter
+            search_filter.update(self.search_filter_for(doc_keys))
+        return search_filter
+
+    def _reranks(self):
+        return self.mmr_lambda < 1.0 or self.max_per_source > 0
+
+    def _embed(self, query):
+        if self.embed_query:
+            return self.embed_query(self.vectorstore.embeddings, query)
+        return self.vectorstore.embeddings.embed_query(query)
+
+    def _query(self, embedding):
+        """Candidate documents in relevance order, their vectors (re-ranking only) and distances by chunk ID."""
+        search_filter = self._search_filter(embedding)
+        allowed_ids = search_filter['allowed_ids']
+        hits = self.vectorstore.query(
+            embedding,
+            n_results=max(self.k, self.fetch_k),
+            where=search_filter['where'],
+            shard_names=search_filter['shard_names'],
+            include_embeddings=self._reranks(),
+        )
+        docs, vectors_by_id, distances_by_id = [], {}, {}
+        for chunk_id, text, metadata, distance, *vector in hits:
+            if allowed_ids is not None and chunk_id not in allowed_ids:
+                continue
+            metadata = dict(metadata or {})
+            metadata[config.CHUNK_ID_METADATA_KEY] = chunk_id
+            docs.append(Document(page_content=text or "", metadata=metadata))
+            distances_by_id[chunk_id] = distance
+            if vector:
+                vectors_by_id[chunk_id] = vector[0]
+        if self.expand_metadata and docs:
+            self.expand_metadata([doc.metadata for doc in docs])
+        return docs, vectors_by_id, distances_by_id
+
+    def _rerank(self, docs, vectors_by_id, embedding):
+        """The top k of the pool by MMR with the per-source cap."""
+        if not self._reranks() or len(docs) <= 1 or any(
+                doc.metadata[config.CHUNK_ID_METADATA_KEY] not in vectors_by_id for doc in docs):
+            return docs[:self.k]
+        picked = mmr_select(
+            embedding,
+            [vectors_by_id[doc.metadata[config.CHUNK_ID_METADATA_KEY]] for doc in docs],
+            self.k,
+            lambda_mult=self.mmr_lambda,
+            source_ids=[doc.metadata.get(config.S3_KEY_METADATA_KEY) or "" for doc in docs],
+            max_per_source=self.max_per_source,
+        )
+        return [docs[i] for i in picked]
+
+    def _attach_sources(self, docs):
+        keys_by_id = {}
+        if self.source_keys_for and docs:
+            keys_by_id = self.source_keys_for([doc.metadata[config.CHUNK_ID_METADATA_KEY] for doc in docs])
+        for doc in docs:
+            keys = keys_by_id.get(doc.metadata[config.CHUNK_ID_METADATA_KEY])
+            if keys:
+                doc.metadata[config.SOURCE_URLS_METADATA_KEY] = [s3_handler.construct_public_s3_url(k) for k in keys]
+            else:
+                doc.metadata[config.SOURCE_URLS_METADATA_KEY] = [doc.metadata.get(config.S3_URL_METADATA_KEY)]
+
+    # --- Result Cache ---
+    def _cache_settings(self):
+        """Everything besides the query vector that decides the result."""
+        return {
+            "k": self.k, "fetch_k": self.fetch_k, "where": self.where, "shard_names": self.shard_names,
+            "allowed_ids": self.allowed_ids, "document_top_n": self.document_top_n,
+            "document_where": self.document_where, "near_duplicate_threshold": self.near_duplicate_threshold,
+            "mmr_lambda": self.mmr_lambda, "max_per_source": self.max_per_source,
+        }
+
+    def _cached_documents(self, hits):
+        """Rebuilds cached results from the store by chunk ID; None if any chunk is gone."""
+        if not hits:
+            return []
+        ids = [hit.chunk_id for hit in hits]
+        # Chunks live in their owner key's shard
+        shard_names = sorted({shard_store.shard_for_key(hit.s3_key or "") for hit in hits}
+                             & set(self.vectorstore.shard_names())) or None
+        rows = self.vectorstore.get(include=["documents", "metadatas"], ids=ids, shard_names=shard_names)
+        found = {chunk_id: (text, metadata) for chunk_id, text, metadata in
+                 zip(rows["ids"], rows.get("documents") or [], rows.get("metadatas") or [])}
+        if any(chunk_id not in found for chunk_id in ids):
+            return None
+        docs = []
+        for hit in hits:
+            text, metadata = found[hit.chunk_id]
+            metadata = dict(metadata or {})
+            metadata[config.CHUNK_ID_METADATA_KEY] = hit.chunk_id
+            docs.append(Document(page_content=text or "", metadata=metadata))
+        if self.expand_metadata:
+            self.expand_metadata([doc.metadata for doc in docs])
+        for doc, hit in zip(docs, hits):
+            doc.metadata[config.SOURCE_URLS_METADATA_KEY] = list(hit.source_urls)
+        return docs
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = self._embed(query)
+        key = None
+        corpus_version = self.corpus_version
+        # A write, snapshot swap or model switch since this retriever was built means its store may not
+        # match the live corpus: bypass the cache rather than file old results under the new version
+        if (self.result_cache is not None and corpus_version is not None and self.current_corpus_version
+                and self.current_corpus_version() == corpus_version):
+            key = retrieval_cache.cache_key(getattr(self.vectorstore.embeddings, "model", None), embedding,
+                                            self._cache_settings())
+            hits = self.result_cache.get(key, corpus_version)
+            if hits is not None:
+                docs = self._cached_documents(hits)
+                if docs is not None:
+                    return docs
+
+        docs, vectors_by_id, distances_by_id = self._query(embedding)
+        self._attach_sources(docs)
+        docs = collapse_near_duplicates(docs, self.near_duplicate_threshold)
+        docs = self._rerank(docs, vectors_by_id, embedding)
+        if key is not None:
+            self.result_cache.put(key, corpus_version, [
+                retrieval_cache.CachedHit(
+                    doc.metadata[config.CHUNK_ID_METADATA_KEY], doc.metadata.get(config.S3_KEY_METADATA_KEY),
+                    distances_by_id.get(doc.metadata[config.CHUNK_ID_METADATA_KEY]),
+                    tuple(doc.metadata.get(config.SOURCE_URLS_METADATA_KEY) or ()))
+                for doc in docs])
+        return docs
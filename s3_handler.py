@@ -1,10 +1,30 @@
+import io
 import os
+import json
+import tempfile
+import threading
+from datetime import datetime
 import boto3
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import NoCredentialsError, ClientError, PartialCredentialsError
 import config 
 
 s3_client = None
 
+# Shared transfer settings for all managed uploads/downloads (multipart + per-transfer threads)
+transfer_config = TransferConfig(
+    multipart_threshold=config.S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=config.S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=config.S3_TRANSFER_MAX_CONCURRENCY,
+    use_threads=True,
+)
+
+def get_transfer_config():
+    """Returns the TransferConfig used for S3 uploads and downloads."""
+    return transfer_config
+
 def get_s3_client():
     """Initializes and returns an S3 client, caching it globally within this module."""
     global s3_client
@@ -12,7 +32,12 @@ def get_s3_client():
         return s3_client
     try:
         print("  Initializing Boto3 S3 Client...")
-        client = boto3.client('s3', region_name=config.AWS_REGION)
+        # Connection pool sized for concurrent transfers; adaptive retries back off on throttling
+        client_config = BotoConfig(
+            max_pool_connections=config.S3_MAX_POOL_CONNECTIONS,
+            retries={'max_attempts': config.S3_MAX_ATTEMPTS, 'mode': 'adaptive'},
+        )
+        client = boto3.client('s3', region_name=config.AWS_REGION, config=client_config)
         client.head_bucket(Bucket=config.S3_BUCKET_NAME)
         print(f"  S3 Client connected successfully to bucket '{config.S3_BUCKET_NAME}' in region '{config.AWS_REGION}'.")
         s3_client = client
@@ -34,44 +59,175 @@ def get_s3_client():
         return None 
 
 
-def list_s3_objects_versions(client, bucket_name, prefix):
-    """Lists latest versions of objects in S3, handling pagination and delete markers."""
-    if not client:
-         print("  ERROR: S3 client not initialized in list_s3_objects_versions.")
-         return {}
+def is_internal_key(key):
+    """True for keys the app writes for itself (e.g. the parse cache mirror), which are not documents."""
+    cache_prefix = config.PARSE_CACHE_S3_PREFIX
+    return bool(cache_prefix) and key.startswith(cache_prefix)
 
+
+def _is_listed_key(key, size, prefix):
+    """False for folder placeholders, the prefix itself and the app's own objects."""
+    if key == prefix and prefix != "":
+        return False
+    if key.endswith('/') and (size or 0) == 0:
+        return False
+    return not is_internal_key(key)
+
+def _list_latest_versions(client, bucket_name, prefix):
+    """
+    Latest version of every object via list_object_versions, which pages
+    through every historical version too. Returns ({key: entry}, requests),
+    or (None, requests) on error.
+    """
     objects_info = {}
+    requests = 0
     paginator = client.get_paginator('list_object_versions')
     print(f"  Listing objects/versions in s3://{bucket_name}/{prefix}...")
-    object_count = 0
     try:
         page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
         for page in page_iterator:
+            requests += 1
             # Process Versions
             for version in page.get('Versions', []):
                 key = version['Key']
-                
-                if key == prefix and prefix != "": continue
-                if key.endswith('/') and version.get('Size', 0) == 0: continue
+                if not _is_listed_key(key, version.get('Size', 0), prefix): continue
                 if version['IsLatest']:
-                    objects_info[key] = {'VersionId': version['VersionId'], 'LastModified': version['LastModified']}
-                    object_count += 1
+                    objects_info[key] = {'VersionId': version['VersionId'], 'LastModified': version['LastModified'],
+                                         'ETag': version.get('ETag'), 'Size': version.get('Size')}
 
             # Process Delete Markers 
             for marker in page.get('DeleteMarkers', []):
                 key = marker['Key']
                 if marker['IsLatest'] and key in objects_info:
                     del objects_info[key] # Remove the object if the latest action was a delete
-                    object_count -=1 # Decrement count
-
-        print(f"  Found {len(objects_info)} current object keys.")
-        return objects_info
+        return objects_info, requests
     except ClientError as e:
         print(f"  ERROR listing S3 objects: {e}")
-        return {} 
+        return None, requests
     except Exception as e:
         print(f"  Unexpected ERROR listing S3 objects: {e}")
+        return None, requests
+
+# --- S3 Listing Catalog ---
+
+_catalog_lock = threading.Lock()
+
+def _load_catalog(bucket_name, prefix):
+    """{key: entry} from the persisted catalog of this bucket/prefix ({} if there is none)."""
+    try:
+        with open(config.S3_CATALOG_PATH, encoding="utf-8") as f:
+            catalog = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"  WARNING: Unreadable S3 catalog '{config.S3_CATALOG_PATH}': {e}. Listing all versions.")
         return {}
+    if catalog.get("bucket") != bucket_name or catalog.get("prefix") != prefix:
+        return {}
+    objects = catalog.get("objects", {})
+    for entry in objects.values():
+        entry['LastModified'] = datetime.fromisoformat(entry['LastModified']) if entry.get('LastModified') else None
+    return objects
+
+def _save_catalog(bucket_name, prefix, objects):
+    serializable = {
+        key: dict(entry, LastModified=entry['LastModified'].isoformat() if entry.get('LastModified') else None)
+        for key, entry in objects.items()
+    }
+    directory = os.path.dirname(config.S3_CATALOG_PATH) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"bucket": bucket_name, "prefix": prefix, "objects": serializable}, f)
+        os.replace(tmp_path, config.S3_CATALOG_PATH) # Atomic: a crash leaves the previous catalog
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _list_current_objects(client, bucket_name, prefix):
+    """Current objects via list_objects_v2: ({key: {'ETag', 'LastModified', 'Size'}}, requests)."""
+    objects = {}
+    requests = 0
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        requests += 1
+        for item in page.get('Contents', []):
+            key = item['Key']
+            if _is_listed_key(key, item.get('Size', 0), prefix):
+                objects[key] = {'ETag': item.get('ETag'), 'LastModified': item.get('LastModified'), 'Size': item.get('Size')}
+    return objects, requests
+
+def _head_version_id(client, bucket_name, key):
+    # Unversioned buckets: list_object_versions reports 'null', head_object reports nothing
+    return client.head_object(Bucket=bucket_name, Key=key).get('VersionId') or 'null'
+
+def _is_unchanged(entry, item):
+    return entry is not None and all(entry.get(field) == item.get(field) for field in ('ETag', 'LastModified', 'Size'))
+
+def list_s3_objects_versions(client, bucket_name, prefix):
+    """
+    Lists latest versions of objects in S3: {key: {'VersionId', 'LastModified'}}.
+    With the S3 catalog (config.S3_CATALOG_ENABLED) the current objects are
+    listed with list_objects_v2 and compared with the persisted catalog by
+    ETag, LastModified and Size; only new or changed keys get a head_object
+    for their VersionId. Without a catalog, or when more than
+    config.S3_CATALOG_MAX_HEADS keys changed, all versions are listed once
+    (list_object_versions, delete markers handled) and the catalog rebuilt.
+    """
+    if not client:
+         print("  ERROR: S3 client not initialized in list_s3_objects_versions.")
+         return {}
+
+    if not config.S3_CATALOG_ENABLED:
+        objects_info, requests = _list_latest_versions(client, bucket_name, prefix)
+        if objects_info is None:
+            return {}
+        print(f"  Found {len(objects_info)} current object keys ({requests} list requests).")
+        return {key: {'VersionId': e['VersionId'], 'LastModified': e['LastModified']} for key, e in objects_info.items()}
+
+    with _catalog_lock:
+        catalog = _load_catalog(bucket_name, prefix)
+        print(f"  Listing current objects in s3://{bucket_name}/{prefix} ({len(catalog)} keys in the S3 catalog)...")
+        try:
+            current, list_requests = _list_current_objects(client, bucket_name, prefix)
+        except ClientError as e:
+            print(f"  ERROR listing S3 objects: {e}")
+            return {}
+        except Exception as e:
+            print(f"  Unexpected ERROR listing S3 objects: {e}")
+            return {}
+        changed = [key for key, item in current.items() if not _is_unchanged(catalog.get(key), item)]
+        head_requests = 0
+        if not catalog or len(changed) > config.S3_CATALOG_MAX_HEADS:
+            print(f"  {len(changed)} new/changed keys: listing all versions once to rebuild the S3 catalog.")
+            objects_info, version_requests = _list_latest_versions(client, bucket_name, prefix)
+            if objects_info is None:
+                return {}
+            list_requests += version_requests
+        else:
+            objects_info = {key: catalog[key] for key in current if key in catalog} # Deleted keys drop out
+            if changed:
+                workers = min(config.S3_BULK_DOWNLOAD_WORKERS, len(changed))
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="s3-head") as executor:
+                    futures = {executor.submit(_head_version_id, client, bucket_name, key): key for key in changed}
+                    for future in as_completed(futures):
+                        key = futures[future]
+                        head_requests += 1
+                        try:
+                            # Listed ETag/LastModified/Size: what the next listing is compared with
+                            objects_info[key] = dict(current[key], VersionId=future.result())
+                        except Exception as e:
+                            # Gone since the listing (or unreadable): keep what the catalog knew, if anything
+                            print(f"    WARNING: Could not get the version of {key}: {e}")
+        try:
+            _save_catalog(bucket_name, prefix, objects_info)
+        except Exception as e:
+            print(f"  WARNING: Could not save the S3 catalog to '{config.S3_CATALOG_PATH}': {e}")
+    print(f"  Found {len(objects_info)} current object keys ({list_requests} list + {head_requests} head requests, "
+          f"{len(changed)} new/changed since the last listing).")
+    return {key: {'VersionId': e['VersionId'], 'LastModified': e['LastModified']} for key, e in objects_info.items()}
 
 def list_s3_objects_for_display(client, bucket_name, prefix):
     """Lists objects using list_objects_v2 for frontend display (simpler)."""
@@ -94,6 +250,9 @@ def list_s3_objects_for_display(client, bucket_name, prefix):
                     # Skip if the key IS the prefix itself (representing the folder)
                     if key == prefix and prefix != "":
                         continue
+                    # Skip objects the app stores for itself
+                    if is_internal_key(key):
+                        continue
 
                     files_list.append({
                         'key': key,
@@ -120,14 +279,25 @@ def construct_public_s3_url(s3_key):
     s3_key = s3_key.lstrip('/')
     return f"{config.S3_BASE_URL}/{s3_key}"
 
-def download_s3_object(client, bucket_name, s3_key, local_path):
-    """Downloads a specific S3 object to a local path."""
+def _version_args(version_id):
+    """ExtraArgs pinning a download to `version_id` (none for unversioned objects)."""
+    if not version_id or version_id == 'null':
+        return None
+    return {'VersionId': version_id}
+
+def download_s3_object(client, bucket_name, s3_key, local_path, version_id=None):
+    """
+    Downloads a specific S3 object to a local path. With `version_id` that
+    version is fetched, so the bytes match the version they are indexed under
+    even if the key was overwritten since it was listed.
+    """
     if not client:
          print(f"  ERROR: S3 client not initialized. Cannot download {s3_key}.")
          return False
     try:
         print(f"    Downloading s3://{bucket_name}/{s3_key} to {local_path}...")
-        client.download_file(bucket_name, s3_key, local_path)
+        client.download_file(bucket_name, s3_key, local_path,
+                             ExtraArgs=_version_args(version_id), Config=transfer_config)
         print(f"    Download successful.")
         return True
     except ClientError as e:
@@ -137,6 +307,62 @@ def download_s3_object(client, bucket_name, s3_key, local_path):
         print(f"    Unexpected ERROR downloading S3 object {s3_key}: {e}")
         return False
 
+def _safe_local_filename(s3_key, index):
+    """Filesystem-safe, collision-free local name for a downloaded key."""
+    base = "".join(c if c.isalnum() or c in ('_', '-', '.') else '_' for c in os.path.basename(s3_key))
+    return f"{index:05d}_{base or 's3_object'}"
+
+def _download_one(client, bucket_name, s3_key, local_path, version_id=None):
+    """Downloads one key (pinned to `version_id`) to `local_path`, or into memory when `local_path` is None."""
+    if local_path:
+        client.download_file(bucket_name, s3_key, local_path,
+                             ExtraArgs=_version_args(version_id), Config=transfer_config)
+        return local_path
+    buffer = io.BytesIO()
+    client.download_fileobj(bucket_name, s3_key, buffer,
+                            ExtraArgs=_version_args(version_id), Config=transfer_config)
+    return buffer.getvalue()
+
+def download_s3_objects_concurrently(client, bucket_name, s3_keys, dest_dir=None, max_workers=None, version_ids=None):
+    """
+    Downloads many keys concurrently and yields (s3_key, result, ok) as each one completes.
+    `result` is the local file path when `dest_dir` is given, otherwise the object's bytes.
+    `version_ids` ({s3_key: VersionId}) pins each download to the listed version.
+    At most `max_workers` downloads are in flight, so results waiting to be consumed stay bounded.
+    """
+    if not client:
+        print("  ERROR: S3 client not initialized. Cannot run bulk download.")
+        for s3_key in s3_keys:
+            yield s3_key, None, False
+        return
+
+    max_workers = max_workers or config.S3_BULK_DOWNLOAD_WORKERS
+    version_ids = version_ids or {}
+    pending_keys = list(enumerate(s3_keys))
+    print(f"  Bulk downloading {len(pending_keys)} objects from s3://{bucket_name} with {max_workers} workers...")
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3-download") as executor:
+        in_flight = {}
+
+        def submit_next():
+            index, s3_key = pending_keys.pop(0)
+            local_path = os.path.join(dest_dir, _safe_local_filename(s3_key, index)) if dest_dir else None
+            in_flight[executor.submit(_download_one, client, bucket_name, s3_key, local_path,
+                                      version_ids.get(s3_key))] = s3_key
+
+        while pending_keys and len(in_flight) < max_workers:
+            submit_next()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                s3_key = in_flight.pop(future)
+                try:
+                    yield s3_key, future.result(), True
+                except Exception as e:
+                    print(f"    ERROR downloading S3 object {s3_key}: {e}")
+                    yield s3_key, None, False
+                if pending_keys:
+                    submit_next()
+
 def upload_to_s3(client, file_obj, bucket_name, s3_key):
     """Uploads a file object to S3."""
     if not client:
@@ -146,7 +372,7 @@ def upload_to_s3(client, file_obj, bucket_name, s3_key):
         
         file_obj.seek(0)
         print(f"  Uploading to s3://{bucket_name}/{s3_key}...")
-        client.upload_fileobj(file_obj, bucket_name, s3_key)
+        client.upload_fileobj(file_obj, bucket_name, s3_key, Config=transfer_config)
         print(f"  Upload successful.")
         return True
     except ClientError as e:
@@ -156,6 +382,34 @@ def upload_to_s3(client, file_obj, bucket_name, s3_key):
         print(f"  Unexpected ERROR uploading to S3 ({s3_key}): {e}")
         return False
 
+def _upload_and_describe(client, bucket_name, s3_key, local_path):
+    with open(local_path, 'rb') as f:
+        if not upload_to_s3(client, f, bucket_name, s3_key):
+            return False, None, None
+    version_id, last_modified = get_s3_object_metadata(client, bucket_name, s3_key)
+    return True, version_id, last_modified
+
+def upload_s3_objects_concurrently(client, bucket_name, uploads, max_workers=None):
+    """
+    Uploads local files ({s3_key: local_path}) in parallel and yields
+    (s3_key, ok, version_id, last_modified) as each upload completes.
+    """
+    max_workers = max_workers or config.S3_BULK_DOWNLOAD_WORKERS
+    print(f"  Uploading {len(uploads)} files to s3://{bucket_name} with {max_workers} workers...")
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3-upload") as executor:
+        futures = {
+            executor.submit(_upload_and_describe, client, bucket_name, s3_key, local_path): s3_key
+            for s3_key, local_path in uploads.items()
+        }
+        for future in as_completed(futures):
+            s3_key = futures[future]
+            try:
+                ok, version_id, last_modified = future.result()
+            except Exception as e:
+                print(f"  Unexpected ERROR uploading to S3 ({s3_key}): {e}")
+                ok, version_id, last_modified = False, None, None
+            yield s3_key, ok, version_id, last_modified
+
 def get_s3_object_metadata(client, bucket_name, s3_key):
     """Retrieves metadata (VersionId, LastModified) for an S3 object."""
     if not client:
@@ -0,0 +1,230 @@
+# shard_store.py
+"""
+Vector storage split across several Chroma collections ("shards") that share
+one persist directory.
+
+config.SHARD_STRATEGY picks the layout:
+  none   - one collection (the layout used before sharding)
+  prefix - one collection per leading S3 key folder (e.g. one per course)
+  hash   - keys spread over config.SHARD_COUNT collections by a stable hash
+
+A chunk is always stored in the shard of its owner key. Searches fan out to
+the relevant shards on a thread pool and the hits are merged by distance.
+Changing the strategy on an existing DB requires a rebuild.
+
+A small "document_index" collection next to the shards holds one vector per
+S3 key (the mean of its chunk vectors) for coarse-to-fine retrieval.
+
+Collections embedded with a model other than the original one carry a
+per-model suffix (see collection_suffix_for_model), so an embedding
+migration can build a complete second set next to the live one.
+"""
+import hashlib
+import re
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import chromadb
+from langchain_community.vectorstores import Chroma
+
+import config
+
+DEFAULT_COLLECTION_NAME = "langchain" # langchain_community's Chroma default, used by unsharded DBs
+DOCUMENT_INDEX_NAME = "document_index" # One vector per S3 key; never a shard
+_INVALID_NAME_CHARS_RE = re.compile(r"[^a-zA-Z0-9_-]+")
+_MODEL_SUFFIX_RE = re.compile(r"__e[0-9a-f]{6}$")
+
+_search_pool = ThreadPoolExecutor(max_workers=config.SEARCH_FANOUT_WORKERS, thread_name_prefix="shard-search")
+
+
+def collection_suffix_for_model(model_name):
+    """Collection-name suffix for shards embedded with `model_name` (8 chars, keeps names <= 63)."""
+    return f"__e{hashlib.sha1(model_name.encode('utf-8')).hexdigest()[:6]}"
+
+
+def shard_for_key(s3_key):
+    """Name of the collection that stores chunks owned by `s3_key`."""
+    if config.SHARD_STRATEGY == "prefix":
+        folders = s3_key.split("/")[:-1][:config.SHARD_PREFIX_DEPTH]
+        prefix = "/".join(folders)
+        if not prefix:
+            return "shard_root"
+        # Collection names allow [a-zA-Z0-9._-]; the digest keeps sanitized prefixes distinct
+        slug = _INVALID_NAME_CHARS_RE.sub("-", prefix).strip("-_")[:40] or "folder"
+        digest = hashlib.sha1(prefix.encode("utf-8")).hexdigest()[:8]
+        return f"shard_{slug}_{digest}"
+    if config.SHARD_STRATEGY == "hash":
+        digest = hashlib.sha1(s3_key.encode("utf-8")).digest()
+        return f"shard_{int.from_bytes(digest[:4], 'big') % config.SHARD_COUNT:03d}"
+    return DEFAULT_COLLECTION_NAME
+
+
+class ShardedStore:
+    """Routes writes to per-shard Chroma collections and fans reads out across them."""
+
+    def __init__(self, embedding_function, persist_directory, collection_suffix=""):
+        self.embeddings = embedding_function
+        self.persist_directory = persist_directory
+        self.collection_suffix = collection_suffix
+        self.client = chromadb.PersistentClient(path=persist_directory)
+        self._lock = threading.Lock()
+        self._shards = {}
+        self._document_index = None
+        for collection_name in self._collection_names():
+            name = self._shard_name(collection_name)
+            if name is not None:
+                self.shard(name)
+
+    def _collection_names(self):
+        # chromadb < 0.6 returns Collection objects, later versions return names
+        return [getattr(collection, "name", collection) for collection in self.client.list_collections()]
+
+    def _shard_name(self, collection_name):
+        """Shard name of a collection embedded with this store's model, else None."""
+        if self.collection_suffix:
+            if not collection_name.endswith(self.collection_suffix):
+                return None
+            name = collection_name[:-len(self.collection_suffix)]
+        else:
+            name = None if _MODEL_SUFFIX_RE.search(collection_name) else collection_name
+        return None if name == DOCUMENT_INDEX_NAME else name
+
+    def foreign_collections(self):
+        """Collections in the same directory that belong to other embedding models."""
+        own_document_index = DOCUMENT_INDEX_NAME + self.collection_suffix
+        return [name for name in self._collection_names()
+                if self._shard_name(name) is None and name != own_document_index]
+
+    # --- Shard access ---
+    def shard(self, name):
+        """The Chroma wrapper for a shard, creating its collection on first use."""
+        with self._lock:
+            store = self._shards.get(name)
+            if store is None:
+                store = Chroma(
+                    client=self.client,
+                    collection_name=name + self.collection_suffix,
+                    embedding_function=self.embeddings,
+                    persist_directory=self.persist_directory,
+                )
+                self._shards[name] = store
+            return store
+
+    def shard_for_key(self, s3_key):
+        return self.shard(shard_for_key(s3_key))
+
+    def shard_names(self):
+        with self._lock:
+            return sorted(self._shards)
+
+    def drop_shard(self, name):
+        """Deletes a shard's collection (used by per-shard rebuilds)."""
+        with self._lock:
+            self._shards.pop(name, None)
+        try:
+            self.client.delete_collection(name + self.collection_suffix)
+        except Exception as e:
+            print(f"    WARNING: Could not delete collection '{name + self.collection_suffix}': {e}")
+
+    def close(self):
+        """Stops this store's Chroma client (a superseded published version nobody uses any more)."""
+        with self._lock:
+            self._shards.clear()
+            self._document_index = None
+        try:
+            self.client._system.stop()
+            # PersistentClient shares one system per path; drop it so the path can be deleted and reopened
+            shared = getattr(type(self.client), "_identifer_to_system", None)
+            if shared is not None:
+                shared.pop(getattr(self.client, "_identifier", None), None)
+        except Exception as e:
+            print(f"    WARNING: Could not close the Chroma client at '{self.persist_directory}': {e}")
+
+    # --- Whole-store operations ---
+    def count(self, shard_names=None):
+        return sum(self.shard(name)._collection.count() for name in (shard_names or self.shard_names()))
+
+    def get(self, include, shard_names=None, **kwargs):
+        """Like Chroma.get, merged across shards."""
+        merged = {"ids": []}
+        for name in shard_names or self.shard_names():
+            result = self.shard(name).get(include=include, **kwargs) or {}
+            merged["ids"].extend(result.get("ids") or [])
+            for field in include:
+                values = result.get(field) # Embeddings come back as a numpy array
+                merged.setdefault(field, []).extend(list(values) if values is not None else [])
+        return merged
+
+    def persist(self):
+        for name in self.shard_names():
+            self.shard(name).persist()
+
+    def query(self, embedding, n_results, where=None, shard_names=None, include_embeddings=False):
+        """
+        Nearest-neighbour search over the given shards (all by default), in
+        parallel. Returns up to `n_results` (id, text, metadata, distance) tuples
+        ordered by distance; with `include_embeddings` each tuple also ends with
+        the chunk's stored vector.
+        """
+        shard_names = shard_names or self.shard_names()
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if include_embeddings else [])
+
+        def search(name):
+            try:
+                results = self.shard(name)._collection.query(
+                    query_embeddings=[embedding],
+                    n_results=n_results,
+                    where=where or None,
+                    include=include,
+                )
+            except Exception as e:
+                print(f"    WARNING: Search failed on shard '{name}': {e}")
+                traceback.print_exc()
+                return []
+            columns = [results["ids"][0], results["documents"][0], results["metadatas"][0], results["distances"][0]]
+            if include_embeddings:
+                columns.append(results["embeddings"][0])
+            return list(zip(*columns))
+
+        if len(shard_names) == 1:
+            hits = search(shard_names[0])
+        else:
+            hits = [hit for shard_hits in _search_pool.map(search, shard_names) for hit in shard_hits]
+        hits.sort(key=lambda hit: hit[3])
+        return hits[:n_results]
+
+    # --- Document-level index ---
+    def document_index(self):
+        """Raw Chroma collection of per-key document vectors (cosine space; vectors are supplied, not embedded)."""
+        with self._lock:
+            if self._document_index is None:
+                self._document_index = self.client.get_or_create_collection(
+                    DOCUMENT_INDEX_NAME + self.collection_suffix, metadata={"hnsw:space": "cosine"})
+            return self._document_index
+
+    def drop_document_index(self):
+        with self._lock:
+            self._document_index = None
+        try:
+            self.client.delete_collection(DOCUMENT_INDEX_NAME + self.collection_suffix)
+        except Exception as e:
+            print(f"    WARNING: Could not delete the document index: {e}")
+
+    def query_documents(self, embedding, n_results, where=None):
+        """S3 keys of the `n_results` documents closest to `embedding`, best first."""
+        collection = self.document_index()
+        if collection.count() == 0:
+            return []
+        try:
+            results = collection.query(
+                query_embeddings=[embedding],
+                n_results=min(n_results, collection.count()),
+                where=where or None,
+                include=[],
+            )
+        except Exception as e:
+            print(f"    WARNING: Document index search failed: {e}")
+            traceback.print_exc()
+            return []
+        return results["ids"][0]
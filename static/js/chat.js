@@ -38,12 +38,16 @@ document.addEventListener("DOMContentLoaded", () => {
     
     const uploadFileBtn = document.getElementById('uploadFileBtn');
     const fileUploadInput = document.getElementById('fileUploadInput');
+    const scopeChip = document.getElementById('scopeChip');
+    const scopeChipLabel = document.getElementById('scopeChipLabel');
+    const clearScopeBtn = document.getElementById('clearScopeBtn');
     // --- Current State ---
     let currentChatMode = 'normal';
     let isDarkMode = localStorage.getItem('darkMode') === 'true';
     let allFetchedFiles = []; 
     let currentSessionStartTime = new Date();
     let eventSource = null; // For SSE connection
+    let currentScope = null; // { key, filename } when asking about a single document
 
     // ***Initialize markdown-it ***
     const md = window.markdownit({
@@ -128,6 +132,21 @@ document.addEventListener("DOMContentLoaded", () => {
         if (fileUploadInput) {
             fileUploadInput.addEventListener('change', handleFileUpload); // Handle file selection
         }
+
+        // "Ask about this document" buttons (delegated, file lists are re-rendered)
+        [sidebarDocsContainer, modalDocsContainer].forEach(container => {
+            if (!container) return;
+            container.addEventListener('click', (e) => {
+                const askBtn = e.target.closest('.ask-doc-btn');
+                if (!askBtn) return;
+                e.preventDefault();
+                e.stopPropagation();
+                setScope({ key: askBtn.dataset.key, filename: askBtn.dataset.filename });
+                documentViewerModal?.classList.add('hidden');
+                messageInput?.focus();
+            });
+        });
+        if (clearScopeBtn) clearScopeBtn.addEventListener('click', () => setScope(null));
     }
 
     // --- Core Backend Interaction (sendMessage) ---
@@ -167,7 +186,8 @@ document.addEventListener("DOMContentLoaded", () => {
 
         // --- Start EventSource connection ---
         const encodedMessage = encodeURIComponent(messageToSend);
-        const streamUrl = `/chat?message=${encodedMessage}&use_reasoning=${useReasoning}`;
+        let streamUrl = `/chat?message=${encodedMessage}&use_reasoning=${useReasoning}`;
+        if (currentScope) streamUrl += `&scope_key=${encodeURIComponent(currentScope.key)}`;
         console.log("Connecting to EventSource:", streamUrl);
 
         eventSource = new EventSource(streamUrl);
@@ -176,18 +196,45 @@ document.addEventListener("DOMContentLoaded", () => {
         let sourcesData = [];
         let modelUsed = '';
         let firstChunkReceived = false;
-        let thinkingContent = null; 
-        let finalAnswerContent = ''; 
+        let thinkingContent = ''; // Streamed separately via 'thinking' events
+        let thinkingTruncated = false;
 
-
-        // --- Event Listener for messages (data chunks) ---
-        eventSource.onmessage = function(event) {
-             // ... (clear placeholder logic) ...
-             if (!firstChunkReceived && botContentArea) { 
+        // Clear the placeholder on the first streamed chunk of any kind
+        function clearPlaceholderOnce() {
+            if (!firstChunkReceived && botContentArea) {
                 botContentArea.innerHTML = ''; // Clear placeholder
                 firstChunkReceived = true;
                 hideLoading(); // Hide global indicator if it was shown as fallback
-              }
+            }
+        }
+
+        // --- Render thinking block + final answer (markdown and math) ---
+        function renderBotContent() {
+            if (!botContentArea) return;
+            let thinkingHtml = '';
+            if (thinkingContent.trim()) {
+                const truncatedNote = thinkingTruncated ? ' <span class="italic">(cut off at thinking budget)</span>' : '';
+                thinkingHtml = `<div class="thinking-block mb-2 pb-2 border-b border-gray-200 dark:border-gray-600"><span class="text-xs font-semibold text-gray-500 dark:text-gray-400 block mb-1">Thinking Process:${truncatedNote}</span><p class="whitespace-pre-wrap text-sm text-gray-600 dark:text-gray-300">${formatBotMessage(thinkingContent.trim())}</p></div>`; // Keep thinking as plain text
+            }
+            // Render final answer using markdown-it
+            const finalAnswerHtml = md.render(accumulatedAnswerContent.trim() || ''); // Render markdown
+
+            // Set combined HTML
+            botContentArea.innerHTML = `${thinkingHtml}<div class="final-answer">${finalAnswerHtml}</div>`; // Wrap final answer
+            const finalAnswerElement = botContentArea.querySelector('.final-answer');
+            if (finalAnswerElement && window.MathJax && window.MathJax.typesetPromise) {
+                window.MathJax.typesetPromise([finalAnswerElement])
+                    .then(() => messagesContainer.scrollTo({ top: messagesContainer.scrollHeight, behavior: 'auto' }))
+                    .catch((err) => console.error('MathJax typesetting failed:', err)); // Log errors
+            } else {
+                messagesContainer.scrollTo({ top: messagesContainer.scrollHeight, behavior: 'smooth' });
+            }
+        }
+
+
+        // --- Event Listener for messages (answer chunks) ---
+        eventSource.onmessage = function(event) {
+            clearPlaceholderOnce();
 
             try {
                 const data = JSON.parse(event.data);
@@ -202,95 +249,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
                 if (data.chunk) {
                     accumulatedAnswerContent += data.chunk;
-
-                    // === START DEBUG LOGGING ===
-                    console.log("--- Chunk Received ---");
-                    console.log("Chunk:", data.chunk);
-                    console.log("Accumulated Raw:", JSON.stringify(accumulatedAnswerContent)); // Show raw with newlines
-                    // === END DEBUG LOGGING ===
-
-                    // --- Re-parse and Re-render on each chunk ---
-                    if (botContentArea) {
-                         thinkingContent = null;
-                         finalAnswerContent = accumulatedAnswerContent;
-
-                         const thinkStartTag = "<think>";
-                         const thinkEndTag = "</think>";
-                         const startIdx = finalAnswerContent.toLowerCase().indexOf(thinkStartTag); // Case-insensitive search
-                         const endIdx = finalAnswerContent.toLowerCase().indexOf(thinkEndTag);
-
-                         // === START DEBUG LOGGING (Optional) ===
-                         console.log(`Indices - Start: ${startIdx}, End: ${endIdx}`);
-                         // === END DEBUG LOGGING ===
-
-                         if (startIdx !== -1) {
-                              if (endIdx !== -1 && endIdx > startIdx) {
-                                  // Both tags found in correct order
-                                  thinkingContent = finalAnswerContent.substring(startIdx + thinkStartTag.length, endIdx).trim();
-                                  // Answer is everything *after* the end tag
-                                  finalAnswerContent = finalAnswerContent.substring(endIdx + thinkEndTag.length).trim();
-                                  // === START DEBUG LOGGING (Optional) ===
-                                   console.log("Parsed Thinking:", JSON.stringify(thinkingContent));
-                                   console.log("Parsed Answer:", JSON.stringify(finalAnswerContent));
-                                  // === END DEBUG LOGGING ===
-                              } else {
-                                  // Start tag found, but no end tag yet (or it's before start)
-                                  // Assume everything after start tag is thinking for now
-                                  thinkingContent = finalAnswerContent.substring(startIdx + thinkStartTag.length).trim();
-                                  finalAnswerContent = ""; // No final answer part yet
-                                  // === START DEBUG LOGGING (Optional) ===
-                                   console.log("Parsed Thinking (incomplete):", JSON.stringify(thinkingContent));
-                                  // === END DEBUG LOGGING ===
-                              }
-                         } else {
-                            // No <think> start tag found, treat all as answer
-                            // Clean up potential </think> tag if it somehow appears alone
-                            finalAnswerContent = finalAnswerContent.replace(/<\/think>/gi, '').trim();
-                            thinkingContent = null;
-                             // === START DEBUG LOGGING (Optional) ===
-                             console.log("No valid <think> tags found, treating all as answer.");
-                             // === END DEBUG LOGGING ===
-                         }
-                         // --- ** END OF NEW PARSING LOGIC ** ---
-
-
-                         // --- *** RENDER MARKDOWN AND MATH *** ---
-                        let thinkingHtml = '';
-                        if (thinkingContent) {
-                            // Render thinking as plain text for now, or optionally markdown+math too
-                             thinkingHtml = `<div class="thinking-block mb-2 pb-2 border-b border-gray-200 dark:border-gray-600"><span class="text-xs font-semibold text-gray-500 dark:text-gray-400 block mb-1">Thinking Process:</span><p class="whitespace-pre-wrap text-sm text-gray-600 dark:text-gray-300">${formatBotMessage(thinkingContent)}</p></div>`; // Keep thinking as plain text
-                        }
-                        // Render final answer using markdown-it
-                        const finalAnswerHtml = md.render(finalAnswerContent || ''); // Render markdown
-
-                        // Set combined HTML
-                        botContentArea.innerHTML = `${thinkingHtml}<div class="final-answer">${finalAnswerHtml}</div>`; // Wrap final answer
-                        const finalAnswerElement = botContentArea.querySelector('.final-answer');
-                        if (finalAnswerElement) {
-                            console.log("Element to typeset:", finalAnswerElement); // Log the element
-                            console.log("Content BEFORE typesetting:", finalAnswerElement.innerHTML.substring(0, 100) + "..."); // Log content
-
-                            if (window.MathJax && window.MathJax.typesetPromise) {
-                                console.log("Calling MathJax.typesetPromise..."); // Log before call
-                                window.MathJax.typesetPromise([finalAnswerElement])
-                                    .then(() => {
-                                        console.log("MathJax typesetting finished."); // Log on success
-                                        // Optional: Log content AFTER typesetting to compare
-                                        // console.log("Content AFTER typesetting:", finalAnswerElement.innerHTML.substring(0, 100) + "...");
-                                        messagesContainer.scrollTo({ top: messagesContainer.scrollHeight, behavior: 'auto' });
-                                    })
-                                    .catch((err) => console.error('MathJax typesetting failed:', err)); // Log errors
-                            } else {
-                                console.warn("MathJax or typesetPromise not ready yet.");
-                                messagesContainer.scrollTo({ top: messagesContainer.scrollHeight, behavior: 'smooth' });
-                            }
-                        } else {
-                            console.error("Could not find .final-answer element!");
-                        }
-
-                        // Don't scroll here anymore, scrolling happens after typesetting
-                        // messagesContainer.scrollTo({ top: messagesContainer.scrollHeight, behavior: 'smooth' });
-                    }
+                    renderBotContent();
                 }
             } catch (e) {
                 console.error("Error parsing SSE data:", e, "Raw data:", event.data);
@@ -298,6 +257,27 @@ document.addEventListener("DOMContentLoaded", () => {
             }
         };
 
+        // --- Event Listeners for the reasoning model's thinking stream ---
+        eventSource.addEventListener('thinking', function(event) {
+            clearPlaceholderOnce();
+            try {
+                const data = JSON.parse(event.data);
+                if (data.chunk) {
+                    thinkingContent += data.chunk;
+                    renderBotContent();
+                }
+            } catch (e) { console.error("Error parsing thinking data:", e); }
+        });
+
+        eventSource.addEventListener('thinking_end', function(event) {
+            try {
+                const data = JSON.parse(event.data);
+                thinkingTruncated = !!data.truncated;
+                console.log(`Thinking finished after ${data.tokens} tokens${thinkingTruncated ? ' (truncated)' : ''}.`);
+                renderBotContent();
+            } catch (e) { console.error("Error parsing thinking_end data:", e); }
+        });
+
         // --- Event Listener for custom 'sources' event ---
         eventSource.addEventListener('sources', function(event) {
              try {
@@ -353,6 +333,18 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
+    // --- Retrieval Scope ("Ask about this document") ---
+    function setScope(scope) {
+        currentScope = scope && scope.key ? scope : null;
+        if (!scopeChip) return;
+        if (currentScope) {
+            if (scopeChipLabel) scopeChipLabel.textContent = currentScope.filename || currentScope.key;
+            scopeChip.classList.remove('hidden');
+        } else {
+            scopeChip.classList.add('hidden');
+        }
+    }
+
     // --- Add Message to Chat UI (Handles thinking/answer split, sources) ---
     function addMessageToChat(sender, message, modeOrModel = null, sources = [], thinking = null, messageId = null) {
         if (!messagesContainer) return;
@@ -465,35 +457,65 @@ document.addEventListener("DOMContentLoaded", () => {
             return; // No file chosen
         }
 
-        const file = event.target.files[0];
         const allowedTypes = ['application/pdf', 'application/vnd.ms-powerpoint', 'application/vnd.openxmlformats-officedocument.presentationml.presentation'];
         const maxFileSize = 25 * 1024 * 1024; // Example: 25 MB limit
+        const files = Array.from(event.target.files);
 
         // Basic Validation
-        if (!allowedTypes.includes(file.type)) {
-            showNotification(`Invalid file type. Please upload PDF or PPTX/PPT files.`);
-            event.target.value = null; // Reset input
-            return;
-        }
-        if (file.size > maxFileSize) {
-             showNotification(`File size exceeds limit (${(maxFileSize / (1024*1024)).toFixed(0)} MB).`);
-             event.target.value = null; // Reset input
-             return;
+        for (const file of files) {
+            if (!allowedTypes.includes(file.type)) {
+                showNotification(`Invalid file type (${file.name}). Please upload PDF or PPTX/PPT files.`);
+                event.target.value = null; // Reset input
+                return;
+            }
+            if (file.size > maxFileSize) {
+                 showNotification(`${file.name} exceeds the size limit (${(maxFileSize / (1024*1024)).toFixed(0)} MB).`);
+                 event.target.value = null; // Reset input
+                 return;
+            }
+            console.log(`File selected: ${file.name}, Type: ${file.type}, Size: ${file.size}`);
         }
 
-        console.log(`File selected: ${file.name}, Type: ${file.type}, Size: ${file.size}`);
-
         // Prepare data for upload
         const formData = new FormData();
-        formData.append('file', file); // Key 'file' must match backend request.files lookup
-
-        // Call the upload function
-        uploadFileToS3(formData);
+        if (files.length === 1) {
+            formData.append('file', files[0]); // Key 'file' must match backend request.files lookup
+            uploadFileToS3(formData);
+        } else {
+            files.forEach(file => formData.append('files', file)); // Batch endpoint reads 'files'
+            uploadFilesBatch(formData);
+        }
 
         // Reset the input value so the 'change' event fires even if the same file is selected again
         event.target.value = null;
     }
 
+    async function uploadFilesBatch(formData) {
+        console.log("Attempting batch upload...");
+        showLoading();
+        try {
+            const response = await fetch("/upload_files", { method: "POST", body: formData });
+            hideLoading();
+            let data = null;
+            try { data = await response.json(); } catch (e) { /* Ignore if response not JSON */ }
+            if (!data || !data.files) {
+                showNotification(`Upload failed: ${data?.error || response.statusText}`);
+                return;
+            }
+            console.log("Batch upload result:", data);
+            const failed = data.files.filter(f => f.status !== 'ok');
+            failed.forEach(f => console.error(`Upload failed for ${f.filename}: ${f.error}`));
+            showNotification(failed.length === 0
+                ? data.message
+                : `${data.message} Failed: ${failed.map(f => f.filename).join(', ')}`);
+            if (data.succeeded > 0) fetchAndDisplayReferenceFiles();
+        } catch (error) {
+            hideLoading();
+            console.error("Network error during batch upload:", error);
+            showNotification("Network error during upload. Please try again.");
+        }
+    }
+
     async function uploadFileToS3(formData) {
         console.log("Attempting to upload file...");
         showLoading(); // Show general loading indicator
@@ -588,12 +610,16 @@ document.addEventListener("DOMContentLoaded", () => {
          const contentContainerClass = isModal ? 'flex-1 min-w-0' : 'min-w-0'; // Allow text truncation
 
          // Action buttons (only in modal)
+         const askButtonHtml = `<button class="ask-doc-btn text-primary-600 dark:text-primary-400 hover:underline text-sm font-medium transition-colors" data-key="${escapeHtml(file.key || '')}" data-filename="${filename}" title="Ask about this document"><i class="fas fa-comment-dots text-xs mr-1"></i>${isModal ? 'Ask' : ''}</button>`;
          const actionsHtml = isModal ? `
              <div class="flex justify-between items-center mt-3">
                  <span class="text-xs text-gray-500 dark:text-gray-400">${fileExtension.toUpperCase()} • ${sizeFormatted}</span>
-                 <a href="${url}" target="_blank" rel="noopener noreferrer" class="text-primary-600 dark:text-primary-400 hover:underline text-sm font-medium transition-colors">
-                     Open <i class="fas fa-external-link-alt text-xs ml-1"></i>
-                 </a>
+                 <span class="space-x-3">
+                     ${askButtonHtml}
+                     <a href="${url}" target="_blank" rel="noopener noreferrer" class="text-primary-600 dark:text-primary-400 hover:underline text-sm font-medium transition-colors">
+                         Open <i class="fas fa-external-link-alt text-xs ml-1"></i>
+                     </a>
+                 </span>
              </div>
          ` : '';
 
@@ -608,7 +634,7 @@ document.addEventListener("DOMContentLoaded", () => {
                     </div>
                     <div class="${contentContainerClass}">
                         <h3 class="font-medium text-sm truncate" title="${filename}">${filename}</h3>
-                        ${isModal ? descriptionHtml : `<p class="text-xs text-gray-500 dark:text-gray-400">${sizeFormatted}</p>`}
+                        ${isModal ? descriptionHtml : `<p class="text-xs text-gray-500 dark:text-gray-400">${sizeFormatted} ${askButtonHtml}</p>`}
                         ${actionsHtml}
                     </div>
                 </div>
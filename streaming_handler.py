@@ -0,0 +1,332 @@
+# streaming_handler.py
+import re
+import threading
+import traceback
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_community.chat_models import ChatOllama
+from langchain_core.messages import AIMessage
+
+import config
+import content_registry # Text normalization shared with chunk deduplication
+
+# Tag attached to the LLM that produces the final answer, so the stream handler
+# can tell its tokens apart from the condense-question LLM's tokens.
+ANSWER_LLM_TAG = "answer_llm"
+
+_THINKING_BLOCK_RE = re.compile(
+    re.escape(config.THINKING_START_MARKER) + r".*?(" + re.escape(config.THINKING_END_MARKER) + r"|$)",
+    re.DOTALL | re.IGNORECASE,
+)
+
+
+class ThinkingBudgetExceeded(Exception):
+    """Raised from the token callback to stop a reasoning block that ran over budget."""
+
+
+class GenerationCancelled(Exception):
+    """Raised from the token callback once the client has gone away."""
+
+
+def strip_thinking(text):
+    """Removes reasoning blocks (including an unterminated trailing one) from model output."""
+    if not text:
+        return text
+    return _THINKING_BLOCK_RE.sub("", text).strip()
+
+
+def _partial_tag_suffix_len(text, tag):
+    """Length of the longest suffix of `text` that is a proper prefix of `tag` (case-insensitive)."""
+    text_lower = text.lower()
+    tag_lower = tag.lower()
+    for size in range(min(len(text), len(tag) - 1), 0, -1):
+        if text_lower.endswith(tag_lower[:size]):
+            return size
+    return 0
+
+
+class ThinkingStreamParser:
+    """
+    Incrementally splits a token stream into 'thinking' and 'answer' segments.
+    Tags may be split across tokens; a possible partial tag is held back until
+    the next token decides it.
+    """
+
+    def __init__(self, start_tag=config.THINKING_START_MARKER, end_tag=config.THINKING_END_MARKER):
+        self.start_tag = start_tag
+        self.end_tag = end_tag
+        self.in_thinking = False
+        self._buffer = ""
+
+    def feed(self, text):
+        """Feeds a token and returns a list of (kind, text) segments ready to emit."""
+        segments = []
+        self._buffer += text
+        while self._buffer:
+            kind = "thinking" if self.in_thinking else "answer"
+            tag = self.end_tag if self.in_thinking else self.start_tag
+            idx = self._buffer.lower().find(tag.lower())
+            if idx != -1:
+                if idx > 0:
+                    segments.append((kind, self._buffer[:idx]))
+                self._buffer = self._buffer[idx + len(tag):]
+                self.in_thinking = not self.in_thinking
+                continue
+            keep = _partial_tag_suffix_len(self._buffer, tag)
+            ready = self._buffer[:len(self._buffer) - keep]
+            if ready:
+                segments.append((kind, ready))
+            self._buffer = self._buffer[len(ready):]
+            break
+        return segments
+
+    def flush(self):
+        """Returns whatever is still buffered once the stream has ended."""
+        if not self._buffer:
+            return []
+        kind = "thinking" if self.in_thinking else "answer"
+        remaining, self._buffer = self._buffer, ""
+        return [(kind, remaining)]
+
+
+class EventBroadcast:
+    """
+    Append-only event log with any number of blocking readers. Used as the
+    handler's event queue so one generation can feed several SSE clients;
+    every reader starts from the first event, so late joiners replay the
+    already-streamed prefix before receiving live events.
+    """
+
+    def __init__(self):
+        self._events = []
+        self._cond = threading.Condition()
+        self.done = False
+
+    def put(self, event):
+        with self._cond:
+            self._events.append(event)
+            if event[0] == "done":
+                self.done = True
+            self._cond.notify_all()
+
+    def iter_events(self):
+        """Yields (kind, payload) events from the beginning until 'done'."""
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self._events):
+                    self._cond.wait()
+                pending = self._events[index:]
+                index = len(self._events)
+            for kind, payload in pending:
+                yield kind, payload
+                if kind == "done":
+                    return
+
+
+class AnswerStreamHandler(BaseCallbackHandler):
+    """
+    Callback handler that forwards the answer LLM's tokens into a queue as
+    ('thinking', text) / ('answer', text) events, emits retrieved documents as a
+    ('sources', docs) event, and enforces the thinking-token budget.
+
+    Ollama streams one token per chunk, so every `on_llm_new_token` call counts
+    as one token against the budget.
+    """
+
+    raise_error = True  # Let budget/cancel exceptions abort the LLM stream
+
+    def __init__(self, event_queue, llm_model_name, thinking_budget=None):
+        self.event_queue = event_queue
+        self.llm_model_name = llm_model_name
+        self.thinking_budget = thinking_budget
+        self.num_ctx = None  # Context window of the chain's LLM calls (set by the leader); the forced answer reuses it
+        self.parser = ThinkingStreamParser()
+        self.thinking_tokens = 0
+        self.thinking_truncated = False
+        self.answer_prompt_messages = None
+        self.thinking_text = ""
+        self.answer_text = ""
+        self.cancelled = False
+        self._answer_run_id = None
+
+    def cancel(self):
+        """Marks the consumer as gone; the next token aborts generation."""
+        self.cancelled = True
+
+    # --- Callback hooks ---
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        if tags and ANSWER_LLM_TAG in tags:
+            self._answer_run_id = run_id
+            self.answer_prompt_messages = messages[0] if messages else []
+
+    def on_retriever_end(self, documents, **kwargs):
+        self.event_queue.put(("sources", documents))
+
+    def on_llm_new_token(self, token, *, run_id=None, **kwargs):
+        if run_id is None or run_id != self._answer_run_id:
+            return
+        if self.cancelled:
+            raise GenerationCancelled()
+        counted_as_thinking = self.parser.in_thinking
+        self.emit_segments(self.parser.feed(token))
+        counted_as_thinking = counted_as_thinking or self.parser.in_thinking
+        if counted_as_thinking:
+            self.thinking_tokens += 1
+            if self.thinking_budget and self.thinking_tokens >= self.thinking_budget and self.parser.in_thinking:
+                raise ThinkingBudgetExceeded()
+
+    # --- Helpers used by the background runner ---
+    def emit_segments(self, segments, allow_thinking=True):
+        for kind, text in segments:
+            if kind == "thinking":
+                if not allow_thinking:
+                    continue
+                self.thinking_text += text
+            else:
+                self.answer_text += text
+            self.event_queue.put((kind, text))
+
+    def finish(self):
+        self.emit_segments(self.parser.flush())
+
+
+def _stream_forced_answer(handler):
+    """
+    Closes a truncated reasoning block and asks the model to continue straight
+    into the final answer. The partial thinking is sent back as an assistant
+    prefix, which Ollama continues rather than starting a new turn.
+    """
+    if not handler.answer_prompt_messages:
+        print("    WARNING: Thinking budget hit but the answer prompt was not captured; cannot force an answer.")
+        return
+    forced_prefix = (
+        f"{config.THINKING_START_MARKER}\n{handler.thinking_text.strip()}\n"
+        f"{config.THINKING_END_MARKER}\n\n"
+    )
+    messages = list(handler.answer_prompt_messages) + [AIMessage(content=forced_prefix)]
+    # Same num_ctx as the chain's calls, so Ollama neither reloads the model nor truncates the prompt
+    llm = ChatOllama(model=handler.llm_model_name, temperature=0.2, num_ctx=handler.num_ctx)
+
+    # Anything after the forced prefix is answer text; drop any new reasoning block.
+    handler.parser = ThinkingStreamParser()
+    for chunk in llm.stream(messages):
+        if handler.cancelled:
+            raise GenerationCancelled()
+        handler.emit_segments(handler.parser.feed(chunk.content or ""), allow_thinking=False)
+    handler.emit_segments(handler.parser.flush(), allow_thinking=False)
+
+
+def run_chain_in_background(chain, inputs, handler):
+    """
+    Thread target: runs the chain with `handler` attached and reports progress
+    through the handler's queue. Always finishes with a ('done', result) event.
+    """
+    result = None
+    try:
+        result = chain.invoke(inputs, config={"callbacks": [handler]})
+        handler.finish()
+    except ThinkingBudgetExceeded:
+        print(f"    Thinking budget of {handler.thinking_budget} tokens reached. Forcing final answer...")
+        handler.thinking_truncated = True
+        handler.event_queue.put(("thinking_end", None))
+        try:
+            _stream_forced_answer(handler)
+        except GenerationCancelled:
+            print("    Client disconnected during forced answer. Generation stopped.")
+        except Exception as e:
+            print(f"    ERROR while forcing final answer after thinking budget: {e}")
+            traceback.print_exc()
+            handler.event_queue.put(("error", e))
+    except GenerationCancelled:
+        print("    Client disconnected. Generation stopped.")
+    except Exception as e:
+        print(f"    ERROR in background chain run: {e}")
+        traceback.print_exc()
+        handler.event_queue.put(("error", e))
+    finally:
+        handler.event_queue.put(("done", result))
+
+
+def iter_stream_events(handler):
+    """Yields (kind, payload) events from the handler's broadcast until 'done'."""
+    return handler.event_queue.iter_events()
+
+
+# --- Single-Flight Coalescing ---
+
+def flight_key(message, llm_model_name, corpus_version, scope_keys=None):
+    """
+    Key under which identical first-turn questions share one generation, or
+    None for requests that must run on their own.
+    """
+    normalized = content_registry.normalize_text(message)
+    if not normalized:
+        return None
+    return (normalized, llm_model_name, corpus_version, tuple(scope_keys or ()))
+
+
+class ChatFlight:
+    """One in-flight generation and the SSE clients listening to it."""
+
+    def __init__(self, key, handler):
+        self.key = key
+        self.handler = handler
+        self.listeners = 0
+
+    @property
+    def broadcast(self):
+        return self.handler.event_queue
+
+
+class SingleFlightRegistry:
+    """
+    Coalesces identical in-flight chat requests: the first request (leader)
+    runs the chain; later ones with the same key attach to its broadcast.
+    Generation is cancelled only when the last listener disconnects.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def join(self, key, llm_model_name, thinking_budget=None):
+        """Returns (flight, is_leader). A None key always starts a private flight."""
+        with self._lock:
+            flight = self._flights.get(key) if key is not None else None
+            if flight is not None:
+                flight.listeners += 1
+                return flight, False
+            handler = AnswerStreamHandler(EventBroadcast(), llm_model_name, thinking_budget)
+            flight = ChatFlight(key, handler)
+            flight.listeners = 1
+            if key is not None:
+                self._flights[key] = flight
+            return flight, True
+
+    def leave(self, flight):
+        """Detaches one listener; the last one to leave an unfinished flight cancels it."""
+        with self._lock:
+            flight.listeners -= 1
+            if flight.listeners > 0:
+                return
+            self._discard(flight)
+        if not flight.broadcast.done:
+            flight.handler.cancel()
+
+    def finish(self, flight):
+        """Stops new requests from joining a flight whose generation has ended."""
+        with self._lock:
+            self._discard(flight)
+
+    def _discard(self, flight):
+        if flight.key is not None and self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+
+def run_flight_in_background(registry, flight, chain, inputs):
+    """Thread target for a leader: runs the chain, then closes the flight to new joiners."""
+    try:
+        run_chain_in_background(chain, inputs, flight.handler)
+    finally:
+        registry.finish(flight)
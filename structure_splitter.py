@@ -0,0 +1,173 @@
+# structure_splitter.py
+"""
+Structure-aware chunking of loaded pages and slides.
+
+Each loaded Document (one PDF page or one slide) is chunked on its own, so
+chunks never straddle a page or slide boundary. Within a page the text is
+cut into blocks (headings, bullet items, paragraphs) and the blocks are
+packed into chunks of up to config.CHUNK_TOKENS tokens (token_counter):
+
+  - a heading always starts the chunk of the content under it,
+  - a bullet item or paragraph that fits is never cut,
+  - an oversized paragraph is cut between sentences, and only there (a cut
+    inside a paragraph) do chunks overlap, by up to
+    config.CHUNK_OVERLAP_TOKENS tokens of whole sentences.
+
+Chunk text is the original page text between the first and last block, and
+metadata carries `start_index` like RecursiveCharacterTextSplitter's.
+"""
+import re
+from collections import namedtuple
+
+from langchain_core.documents import Document
+
+import config
+import token_counter
+
+_BULLET_RE = re.compile(r"^\s*(?:[-*•▪●◦‣–·]|\(?\d{1,3}[.)]|\(?[a-zA-Z][.)])\s+")
+_NUMBERED_HEADING_RE = re.compile(r"^\s*\d+(?:\.\d+)*\.?\s+\S")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?;:])\s+")
+
+# One packable piece of a page: [start, end) in the page text
+_Unit = namedtuple("_Unit", "start end tokens block kind")
+
+
+def _is_heading(line, next_line):
+    text = line.strip()
+    if not text or len(text) > 80 or text[-1] in ".,;:!?":
+        return False
+    if text.startswith("#") or (text.isupper() and any(c.isalpha() for c in text)):
+        return True
+    if _NUMBERED_HEADING_RE.match(text) and len(text.split()) <= 10:
+        return True
+    # A short title-like line followed by a blank line or a list
+    return len(text.split()) <= 8 and text[0].isupper() and (not next_line.strip() or _BULLET_RE.match(next_line))
+
+
+def _blocks(text):
+    """(start, end, kind) of each heading, bullet item and paragraph in `text`."""
+    lines = []
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        lines.append((offset, line))
+        offset += len(line)
+    blocks = []
+    current = None  # [start, end, kind]
+    for index, (start, line) in enumerate(lines):
+        stripped = line.strip()
+        end = start + len(line.rstrip("\r\n"))
+        if not stripped:
+            current = None
+            continue
+        next_line = lines[index + 1][1] if index + 1 < len(lines) else ""
+        if _BULLET_RE.match(line):
+            current = [start, end, "bullet"]
+            blocks.append(current)
+        elif current is not None and current[2] == "bullet" and line[:1].isspace():
+            current[1] = end  # Indented continuation of a bullet item
+        elif _is_heading(line, next_line) and (current is None or current[2] != "paragraph"):
+            blocks.append([start, end, "heading"])
+            current = None
+        elif current is not None and current[2] == "paragraph":
+            current[1] = end
+        else:
+            current = [start, end, "paragraph"]
+            blocks.append(current)
+    return [tuple(block) for block in blocks]
+
+
+def _hard_split(text, start, end, max_tokens):
+    """Splits an oversized sentence into word runs of at most `max_tokens`."""
+    pieces = []
+    piece_start = None
+    piece_tokens = 0
+    previous_end = 0
+    for match in re.finditer(r"\S+", text[start:end]):
+        word_tokens = token_counter.count_tokens(match.group()) + 1
+        if piece_start is not None and piece_tokens + word_tokens > max_tokens:
+            pieces.append((piece_start, start + previous_end))
+            piece_start, piece_tokens = None, 0
+        if piece_start is None:
+            piece_start = start + match.start()
+        piece_tokens += word_tokens
+        previous_end = match.end()
+    if piece_start is not None:
+        pieces.append((piece_start, start + previous_end))
+    return pieces
+
+
+class StructureAwareSplitter:
+    """Token-sized, page-bounded chunking on heading / bullet / paragraph / sentence boundaries."""
+
+    def __init__(self, chunk_tokens=None, overlap_tokens=None):
+        self.chunk_tokens = chunk_tokens or config.CHUNK_TOKENS
+        self.overlap_tokens = config.CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+
+    def _units(self, text):
+        units = []
+        for block_index, (start, end, kind) in enumerate(_blocks(text)):
+            tokens = token_counter.count_tokens(text[start:end])
+            if tokens <= self.chunk_tokens:
+                units.append(_Unit(start, end, tokens, block_index, kind))
+                continue
+            # Oversized block: sentences (or word runs) of the same block, which may be cut apart
+            sentences = []
+            sentence_start = start
+            for match in _SENTENCE_END_RE.finditer(text, start, end):
+                sentences.append((sentence_start, match.start()))
+                sentence_start = match.end()
+            sentences.append((sentence_start, end))
+            for piece_start, piece_end in sentences:
+                piece_tokens = token_counter.count_tokens(text[piece_start:piece_end])
+                if piece_tokens <= self.chunk_tokens:
+                    units.append(_Unit(piece_start, piece_end, piece_tokens, block_index, "sentence"))
+                    continue
+                for word_start, word_end in _hard_split(text, piece_start, piece_end, self.chunk_tokens):
+                    units.append(_Unit(word_start, word_end, token_counter.count_tokens(text[word_start:word_end]),
+                                       block_index, "sentence"))
+        return units
+
+    def split_text(self, text):
+        """[(start_index, chunk_text)] for one page or slide."""
+        chunks = []
+        current, current_tokens = [], 0
+
+        def emit(units):
+            if units:
+                chunks.append((units[0].start, text[units[0].start:units[-1].end]))
+
+        for unit in self._units(text):
+            if current and current_tokens + unit.tokens > self.chunk_tokens:
+                carried = []
+                if current[-1].kind == "heading":
+                    # Never leave a heading at the end of a chunk: it moves to the chunk of its content
+                    carried = [current.pop()]
+                elif current[-1].block == unit.block:
+                    # Cut inside a paragraph: repeat its last sentences for context
+                    carried_tokens = 0
+                    for previous in reversed(current):
+                        if previous.block != unit.block or carried_tokens + previous.tokens > self.overlap_tokens:
+                            break
+                        carried.insert(0, previous)
+                        carried_tokens += previous.tokens
+                    if len(carried) == len(current) or sum(u.tokens for u in carried) + unit.tokens > self.chunk_tokens:
+                        carried = []
+                emit(current)
+                current = carried
+                current_tokens = sum(u.tokens for u in current)
+            current.append(unit)
+            current_tokens += unit.tokens
+        emit(current)
+        return chunks
+
+    def split_documents(self, documents):
+        chunks = []
+        for doc in documents:
+            text = doc.page_content or ""
+            for start, chunk_text in self.split_text(text):
+                if not chunk_text.strip():
+                    continue
+                metadata = dict(doc.metadata or {})
+                metadata["start_index"] = start
+                chunks.append(Document(page_content=chunk_text, metadata=metadata))
+        return chunks
@@ -0,0 +1,57 @@
+# tests/test_content_registry.py
+import pytest
+
+import content_registry
+
+
+@pytest.fixture
+def registry(tmp_path):
+    registry = content_registry.ContentRegistry(str(tmp_path / "registry.sqlite3"))
+    yield registry
+    registry.close()
+
+
+def refs(registry):
+    return sorted(registry.all_refs())
+
+
+def test_chunk_ids_ignore_whitespace_but_keep_case():
+    assert content_registry.chunk_content_id("AES  key\n") == content_registry.chunk_content_id("AES key")
+    assert content_registry.chunk_content_id("AES") != content_registry.chunk_content_id("aes")
+    assert content_registry.normalize_text("AES  Key") == "aes key"
+
+
+def test_removing_a_key_orphans_only_unshared_chunks(registry):
+    registry.register_file("a.pdf", "v1", None, "fa", ["c1", "c2"], new_chunk_ids=["c1", "c2"])
+    registry.register_file("b.pdf", "v1", None, "fb", ["c2"])
+
+    orphaned, new_owners = registry.remove_keys({"a.pdf"})
+
+    assert orphaned == {"c1": "a.pdf"}
+    assert new_owners == {"c2": ("a.pdf", "b.pdf")}
+    assert refs(registry) == [("c2", "b.pdf")]
+    assert registry.file_versions() == {"b.pdf": "v1"}
+
+
+def test_replacing_a_key_releases_only_what_the_new_version_does_not_hold(registry):
+    registry.register_file("a.pdf", "v1", None, "fa1", ["c1", "c2", "c3"], new_chunk_ids=["c1", "c2", "c3"])
+    registry.register_file("b.pdf", "v1", None, "fb", ["c2"])
+    # The new version of a.pdf is added before the old one is released
+    registry.register_file("a.pdf", "v2", None, "fa2", ["c1", "c4"], new_chunk_ids=["c4"])
+
+    orphaned, new_owners = registry.remove_keys({"a.pdf"}, keep={"a.pdf": {"c1", "c4"}})
+
+    assert orphaned == {"c3": "a.pdf"}
+    assert new_owners == {"c2": ("a.pdf", "b.pdf")}  # Still referenced by b.pdf, which now owns it
+    assert refs(registry) == [("c1", "a.pdf"), ("c2", "b.pdf"), ("c4", "a.pdf")]
+    assert registry.file_versions() == {"a.pdf": "v2", "b.pdf": "v1"}
+    assert registry.chunk_owners(["c1", "c2", "c4"]) == {"c1": "a.pdf", "c2": "b.pdf", "c4": "a.pdf"}
+
+
+def test_invalidated_file_keeps_its_references(registry):
+    registry.register_file("a.pdf", "v1", None, "fa", ["c1"], new_chunk_ids=["c1"])
+
+    registry.invalidate_file("a.pdf")
+
+    assert registry.file_versions() == {"a.pdf": None}
+    assert refs(registry) == [("c1", "a.pdf")]
@@ -0,0 +1,36 @@
+# tests/test_mmr_select.py
+import pytest
+
+pytest.importorskip("numpy")
+retrieval_handler = pytest.importorskip("retrieval_handler")  # Also needs langchain-core, boto3 and chromadb
+
+QUERY = [1.0, 0.0]
+# Three near-identical, highly relevant chunks of one file and one unrelated chunk of another
+CANDIDATES = [[1.0, 0.0], [0.99, 0.1], [0.98, 0.2], [0.0, 1.0]]
+SOURCES = ["a.pdf", "a.pdf", "a.pdf", "b.pdf"]
+
+
+def test_picks_most_relevant_first_without_cap():
+    picked = retrieval_handler.mmr_select(QUERY, CANDIDATES, k=2, lambda_mult=1.0)
+    assert picked == [0, 1]
+
+
+def test_source_cap_gives_other_sources_a_turn():
+    picked = retrieval_handler.mmr_select(QUERY, CANDIDATES, k=2, source_ids=SOURCES, max_per_source=1)
+    assert picked == [0, 3]
+
+
+def test_cap_is_relaxed_once_every_source_is_capped():
+    picked = retrieval_handler.mmr_select(QUERY, CANDIDATES, k=4, source_ids=SOURCES, max_per_source=1)
+    assert picked[:2] == [0, 3]
+    assert sorted(picked) == [0, 1, 2, 3]
+
+
+def test_single_source_pool_still_yields_k():
+    picked = retrieval_handler.mmr_select(QUERY, CANDIDATES[:3], k=3, source_ids=SOURCES[:3], max_per_source=1)
+    assert sorted(picked) == [0, 1, 2]
+
+
+def test_empty_pool_or_zero_k():
+    assert retrieval_handler.mmr_select(QUERY, [], k=3) == []
+    assert retrieval_handler.mmr_select(QUERY, CANDIDATES, k=0) == []
@@ -0,0 +1,72 @@
+# tests/test_structure_splitter.py
+import pytest
+
+pytest.importorskip("tiktoken")
+pytest.importorskip("langchain_core")
+
+import structure_splitter
+import token_counter
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    # One token per word keeps the packing arithmetic independent of the tiktoken encoding
+    monkeypatch.setattr(token_counter, "count_tokens", lambda text: len(text.split()))
+
+
+def chunk_texts(text, chunk_tokens, overlap_tokens):
+    splitter = structure_splitter.StructureAwareSplitter(chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens)
+    return [chunk for _, chunk in splitter.split_text(text)]
+
+
+def test_heading_moves_to_the_chunk_of_its_content():
+    text = "Intro paragraph has five words.\n\nHEADING ONE\n\nBody text under the heading here.\n"
+    assert chunk_texts(text, chunk_tokens=10, overlap_tokens=0) == [
+        "Intro paragraph has five words.",
+        "HEADING ONE\n\nBody text under the heading here.",
+    ]
+
+
+def test_no_overlap_between_paragraphs():
+    text = "Alpha beta gamma delta epsilon.\n\nZeta eta theta iota kappa.\n"
+    assert chunk_texts(text, chunk_tokens=8, overlap_tokens=3) == [
+        "Alpha beta gamma delta epsilon.",
+        "Zeta eta theta iota kappa.",
+    ]
+
+
+def test_overlap_when_a_paragraph_is_cut():
+    text = "One two three. Four five six. Seven eight nine. Ten eleven twelve."
+    assert chunk_texts(text, chunk_tokens=8, overlap_tokens=3) == [
+        "One two three. Four five six.",
+        "Four five six. Seven eight nine.",
+        "Seven eight nine. Ten eleven twelve.",
+    ]
+
+
+def test_overlap_never_repeats_the_whole_chunk():
+    text = "One two three four. Five six seven eight. Nine ten."
+    assert chunk_texts(text, chunk_tokens=8, overlap_tokens=8) == [
+        "One two three four. Five six seven eight.",
+        "Nine ten.",
+    ]
+
+
+def test_overlap_dropped_when_it_leaves_no_room_for_the_next_sentence():
+    text = "One two three four. Five six seven eight. Nine ten eleven twelve thirteen."
+    assert chunk_texts(text, chunk_tokens=8, overlap_tokens=4) == [
+        "One two three four. Five six seven eight.",
+        "Nine ten eleven twelve thirteen.",
+    ]
+
+
+def test_chunks_carry_start_index_per_page():
+    from langchain_core.documents import Document
+
+    splitter = structure_splitter.StructureAwareSplitter(chunk_tokens=10, overlap_tokens=0)
+    page = "Intro paragraph has five words.\n\nHEADING ONE\n\nBody text under the heading here.\n"
+    chunks = splitter.split_documents([Document(page_content=page, metadata={"page": 3})])
+    assert [chunk.metadata for chunk in chunks] == [
+        {"page": 3, "start_index": 0},
+        {"page": 3, "start_index": page.index("HEADING ONE")},
+    ]
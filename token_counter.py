@@ -0,0 +1,60 @@
+# token_counter.py
+"""
+Token counts and Ollama context-window (num_ctx) sizing for prompts. tiktoken's encoding (config.TOKENIZER_ENCODING)
+stands in for the Ollama models' own tokenizers, which are not exposed; it is
+close enough to size context windows and thresholds. If the encoding cannot be
+loaded (it is downloaded on first use) counts fall back to ~4 characters per
+token.
+"""
+import threading
+
+import tiktoken
+
+import config
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    with _encoding_lock:
+        if _encoding is None and not _encoding_failed:
+            try:
+                _encoding = tiktoken.get_encoding(config.TOKENIZER_ENCODING)
+            except Exception as e:
+                print(f"  WARNING: tiktoken encoding '{config.TOKENIZER_ENCODING}' unavailable ({e}). "
+                      "Estimating token counts from text length.")
+                _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Number of tokens in `text`."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+_num_ctx_high_water = {}
+_num_ctx_lock = threading.Lock()
+
+
+def num_ctx_for(model_name, prompt_tokens, reserve=None):
+    """
+    Context window (Ollama `num_ctx`) for a request: the smallest of
+    config.NUM_CTX_BUCKETS that holds the prompt plus `reserve` output tokens,
+    but never smaller than the size this model last ran with in this process.
+    A different num_ctx makes Ollama reload the model and lose its prompt
+    cache, so the size only ever steps up.
+    """
+    needed = prompt_tokens + (config.NUM_PREDICT_RESERVE if reserve is None else reserve)
+    size = next((bucket for bucket in config.NUM_CTX_BUCKETS if bucket >= needed), config.NUM_CTX_BUCKETS[-1])
+    with _num_ctx_lock:
+        size = max(size, _num_ctx_high_water.get(model_name, 0))
+        _num_ctx_high_water[model_name] = size
+    return size
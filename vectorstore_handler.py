@@ -1,16 +1,26 @@
 # vectorstore_handler.py
 import os
+import json
+import atexit
+import bisect
 import shutil
 import tempfile
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
 from datetime import datetime
 
+import numpy as np
+
 # Langchain and related imports
-from langchain_community.vectorstores import Chroma
 from langchain_community.chat_models import ChatOllama
 from langchain_community.embeddings import OllamaEmbeddings
 from langchain.schema.output_parser import StrOutputParser
 from langchain_community.document_loaders import PyPDFLoader, TextLoader, UnstructuredFileLoader
+from langchain_core.documents import Document
+from pypdf import PdfReader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema.runnable import RunnablePassthrough
 from langchain.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceholder
@@ -24,10 +34,129 @@ from langchain_core.messages import HumanMessage, AIMessage
 # Local imports
 import config # Import our configuration
 import s3_handler # Import S3 functions
+import streaming_handler # Tag for the answer LLM's token stream
+import pptx_extractor # Native per-slide PPTX text extraction
+import parse_cache # Parsed-text cache keyed by (s3_key, version_id)
+import content_registry # Content-addressed chunk IDs and key references
+import retrieval_handler # Retriever with scope post-filter and duplicate collapsing
+import shard_store # Chunks split across per-shard Chroma collections
+import index_publisher # Atomic index snapshots for writer/reader deployments
+import history_compactor # Renders the summarized chat history into the prompts
+import query_embedding_cache # Cached, micro-batched question embeddings for the retriever
+import retrieval_cache # Retriever results per question vector and corpus version
+import token_counter # Prompt token counts and num_ctx sizing
+import structure_splitter # Page/slide-bounded, token-sized chunking
+import ingest_log # Write-ahead log of index updates, replayed on startup
 
 # --- Module-level globals for shared resources ---
 vector_store = None
 embeddings = None
+registry = None # content_registry.ContentRegistry, opened with the vector store
+corpus_version = 0 # Bumped on every write, so results computed for an older corpus are not reused
+_corpus_version_lock = threading.Lock()
+write_lock = threading.RLock() # Serializes index writes (and snapshot publication) within the process
+active_index_version = None # Reader role: the published version currently served
+_retired_indexes = [] # Reader role: (version, store, registry) superseded while chains still used them
+_index_users = {} # id(store) -> chains currently running on it (see acquire_index)
+_index_users_lock = threading.Lock()
+_publish_timer = None # Writer role: pending debounced publication
+_publish_timer_lock = threading.Lock()
+embedding_state = None # {'model', 'suffix', 'migrating_to'} of the active index (see load_embedding_state)
+migration_target = None # Store being built by an embedding migration; every write is mirrored to it
+_embeddings_by_model = {}
+_embeddings_lock = threading.Lock()
+
+def bump_corpus_version():
+    global corpus_version
+    with _corpus_version_lock:
+        corpus_version += 1
+        return corpus_version
+
+
+# --- In-Memory Chunk Index (S3 key -> chunk IDs) ---
+
+class ChunkKeyIndex:
+    """
+    Maps each S3 key to the IDs of the chunks it references in ChromaDB
+    (a deduplicated chunk appears under every key that contains it).
+    Used to resolve a retrieval scope (explicit keys or a key prefix) to the
+    keys present in the index without touching the database.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids_by_key = {}
+        self._sorted_keys = []
+
+    def rebuild(self, refs):
+        """Rebuilds the index from (chunk_id, s3_key) references."""
+        ids_by_key = {}
+        for chunk_id, s3_key in refs:
+            if s3_key:
+                ids_by_key.setdefault(s3_key, set()).add(chunk_id)
+        with self._lock:
+            self._ids_by_key = ids_by_key
+            self._sorted_keys = sorted(ids_by_key)
+
+    def add_chunks(self, ids, chunks):
+        with self._lock:
+            for chunk_id, chunk in zip(ids, chunks):
+                s3_key = chunk.metadata.get(config.S3_KEY_METADATA_KEY)
+                if not s3_key:
+                    continue
+                if s3_key not in self._ids_by_key:
+                    self._ids_by_key[s3_key] = set()
+                    bisect.insort(self._sorted_keys, s3_key)
+                self._ids_by_key[s3_key].add(chunk_id)
+
+    def remove_keys(self, s3_keys):
+        with self._lock:
+            for s3_key in s3_keys:
+                if self._ids_by_key.pop(s3_key, None) is not None:
+                    idx = bisect.bisect_left(self._sorted_keys, s3_key)
+                    if idx < len(self._sorted_keys) and self._sorted_keys[idx] == s3_key:
+                        del self._sorted_keys[idx]
+
+    def retain(self, ids_by_key):
+        """Narrows each given key to the chunk IDs listed for it (the rest of its references were released)."""
+        with self._lock:
+            for s3_key, ids in ids_by_key.items():
+                if s3_key in self._ids_by_key:
+                    self._ids_by_key[s3_key] &= set(ids)
+
+    def keys_with_prefix(self, prefix):
+        with self._lock:
+            start = bisect.bisect_left(self._sorted_keys, prefix)
+            matched = []
+            for s3_key in self._sorted_keys[start:]:
+                if not s3_key.startswith(prefix):
+                    break
+                matched.append(s3_key)
+            return matched
+
+    def resolve_scope(self, s3_keys=None, key_prefix=None):
+        """Returns the sorted list of indexed keys matching explicit keys and/or a prefix."""
+        resolved = set()
+        if s3_keys:
+            with self._lock:
+                resolved.update(k for k in s3_keys if k in self._ids_by_key)
+        if key_prefix:
+            resolved.update(self.keys_with_prefix(key_prefix))
+        return sorted(resolved)
+
+    def chunk_count(self, s3_keys):
+        return len(self.chunk_ids(s3_keys))
+
+    def chunk_ids(self, s3_keys):
+        """Distinct chunk IDs referenced by any of the given keys."""
+        ids = set()
+        with self._lock:
+            for s3_key in s3_keys:
+                ids.update(self._ids_by_key.get(s3_key, ()))
+        return ids
+
+
+chunk_index = ChunkKeyIndex()
 
 # --- Initialization Functions ---
 
@@ -35,17 +164,78 @@ def get_embeddings_model():
     """Initializes and returns the embeddings model, caching it globally."""
     global embeddings
     if embeddings is None:
-        print("  Initializing Ollama embeddings model...")
-        try:
-            # Use model name from config
-            embeddings = OllamaEmbeddings(model=config.EMBEDDING_MODEL)
-            print(f"  Embeddings model '{config.EMBEDDING_MODEL}' initialized.")
-        except Exception as e:
-            print(f"  FATAL ERROR initializing embeddings model '{config.EMBEDDING_MODEL}': {e}")
-            traceback.print_exc()
-            return None # Return None on failure
+        # Use model name from config; an existing index may switch it (see open_sharded_store)
+        embeddings = get_embeddings_for_model(config.EMBEDDING_MODEL)
     return embeddings
 
+def get_embeddings_for_model(model_name):
+    """Returns a cached OllamaEmbeddings instance for `model_name`, or None on failure."""
+    with _embeddings_lock:
+        if model_name not in _embeddings_by_model:
+            print(f"  Initializing Ollama embeddings model '{model_name}'...")
+            try:
+                _embeddings_by_model[model_name] = OllamaEmbeddings(model=model_name)
+                print(f"  Embeddings model '{model_name}' initialized.")
+            except Exception as e:
+                print(f"  FATAL ERROR initializing embeddings model '{model_name}': {e}")
+                traceback.print_exc()
+                return None # Return None on failure
+        return _embeddings_by_model[model_name]
+
+def _write_json_atomic(path, data):
+    """Writes JSON via a temp file and rename so a crash never leaves a partial file."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def load_embedding_state(db_dir):
+    """
+    Which embedding model the index in `db_dir` was built with, and the
+    collection-name suffix of its shards. Databases without a state file
+    (built before migrations existed) use config.EMBEDDING_MODEL.
+    """
+    try:
+        with open(os.path.join(db_dir, config.EMBEDDING_STATE_FILE), "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {}
+    state.setdefault("model", config.EMBEDDING_MODEL)
+    state.setdefault("suffix", "")
+    state.setdefault("migrating_to", None)
+    return state
+
+def save_embedding_state(db_dir, state):
+    _write_json_atomic(os.path.join(db_dir, config.EMBEDDING_STATE_FILE), state)
+
+def open_sharded_store(db_dir):
+    """
+    Opens the sharded store in `db_dir` with the embedding model recorded in
+    its state file. Returns (store, state); the store is None if the model
+    cannot be initialized.
+    """
+    state = load_embedding_state(db_dir)
+    model_embeddings = get_embeddings_for_model(state["model"])
+    if model_embeddings is None:
+        return None, state
+    return shard_store.ShardedStore(model_embeddings, db_dir, collection_suffix=state["suffix"]), state
+
+def open_content_registry():
+    """Opens (creating if needed) the content registry inside the Chroma directory."""
+    global registry
+    if registry is not None:
+        registry.close()
+    os.makedirs(os.path.dirname(config.CONTENT_REGISTRY_PATH) or ".", exist_ok=True)
+    registry = content_registry.ContentRegistry(config.CONTENT_REGISTRY_PATH)
+    return registry
+
 def get_vector_store():
     """Returns the initialized vector store instance."""
     global vector_store
@@ -56,12 +246,13 @@ def get_vector_store():
 
 # --- Document Loading and Processing ---
 
-def _load_and_split_document(local_file_path, s3_key, version_id, last_modified):
+def _load_document(local_file_path, s3_key):
     """
-    Loads a document from a *local* file path, adds S3 metadata, and splits it into chunks.
-    Handles different file types (PDF, TXT, PPT/PPTX via Unstructured).
+    Loads a document from a *local* file path using the loader for its type.
+    Handles different file types (PDF, TXT, PPTX via the native slide extractor, PPT via Unstructured).
+    Returns the raw loader output (list of Documents), or an empty list on failure.
     """
-    docs = []
+    loaded_docs = None
     try:
         _, file_extension = os.path.splitext(s3_key)
         file_extension = file_extension.lower()
@@ -72,11 +263,20 @@ def _load_and_split_document(local_file_path, s3_key, version_id, last_modified)
             loader = PyPDFLoader(local_file_path)
         elif file_extension == ".txt":
             loader = TextLoader(local_file_path, encoding='utf-8')
-        # Add ppt/pptx handling using UnstructuredFileLoader
-        elif file_extension in ['.ppt', '.pptx']:
+        elif file_extension == '.pptx':
+             # Native slide extractor: one document per slide (text + notes), no Unstructured import
+             try:
+                 loaded_docs = pptx_extractor.load_pptx(local_file_path)
+                 print(f"    Extracted {len(loaded_docs)} slides with native PPTX extractor")
+             except Exception as e:
+                 print(f"    Warning: Native PPTX extraction failed ({e}). Falling back to UnstructuredFileLoader.")
+                 loader = UnstructuredFileLoader(local_file_path, mode="paged")
+        # Legacy binary .ppt still needs Unstructured (LibreOffice conversion)
+        elif file_extension == '.ppt':
              print(f"    Using UnstructuredFileLoader for {file_extension}")
              # You might need to install specific extras like `pip install "unstructured[pptx]"`
-             loader = UnstructuredFileLoader(local_file_path, mode="elements") # Or try mode="single"
+             # "paged" mode groups elements per slide instead of one document per element
+             loader = UnstructuredFileLoader(local_file_path, mode="paged")
         else:
             # Fallback for other types UnstructuredFileLoader might handle
             print(f"    Warning: Attempting to load unsupported file type '{file_extension}' with UnstructuredFileLoader as fallback.")
@@ -88,7 +288,7 @@ def _load_and_split_document(local_file_path, s3_key, version_id, last_modified)
 
         if loader:
             loaded_docs = loader.load()
-        else: # Should not happen if logic above is correct, but as safeguard
+        elif loaded_docs is None: # Should not happen if logic above is correct, but as safeguard
              print(f"    Error: No suitable loader found for file extension {file_extension}")
              return []
 
@@ -96,18 +296,38 @@ def _load_and_split_document(local_file_path, s3_key, version_id, last_modified)
         if not loaded_docs:
              print(f"    Warning: No documents loaded from {local_file_path}. The file might be empty or corrupted.")
              return []
+        return loaded_docs
 
+    except Exception as e:
+        print(f"    ERROR loading local document {local_file_path} (from S3 key {s3_key}): {e}")
+        traceback.print_exc() # Print detailed traceback for debugging
+        return [] # Return empty list on error
+
+def get_text_splitter(name=None):
+    """The chunker selected by config.TEXT_SPLITTER (or `name`)."""
+    if (name or config.TEXT_SPLITTER) == "structure":
+        return structure_splitter.StructureAwareSplitter()
+    return RecursiveCharacterTextSplitter(
+        chunk_size=config.CHUNK_SIZE,
+        chunk_overlap=config.CHUNK_OVERLAP,
+        length_function=len,
+        add_start_index=True # Good for context/debugging
+    )
+
+def _split_loaded_documents(loaded_docs, s3_key, version_id, last_modified, fingerprint=True):
+    """
+    Adds S3 metadata to loaded documents and splits them into chunks.
+    `fingerprint=False` is for part of a file (a page range): its fingerprint is registered once the whole file is read.
+    """
+    try:
         print(f"    Splitting document: {s3_key}")
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=config.CHUNK_SIZE,
-            chunk_overlap=config.CHUNK_OVERLAP,
-            length_function=len,
-            add_start_index=True # Good for context/debugging
-        )
+        text_splitter = get_text_splitter()
 
         # Add metadata BEFORE splitting
         public_url = s3_handler.construct_public_s3_url(s3_key)
         iso_last_modified = last_modified.isoformat() if last_modified else None
+        # Whole-file fingerprint (extracted text), so copies under other keys are recognised
+        content_sha256 = content_registry.file_fingerprint(loaded_docs) if fingerprint else None
 
         for doc in loaded_docs:
             # Ensure metadata dictionary exists and is modifiable
@@ -126,6 +346,7 @@ def _load_and_split_document(local_file_path, s3_key, version_id, last_modified)
             # Keep 'source' consistent as many Langchain components expect it
             doc.metadata[config.SOURCE_METADATA_KEY] = public_url
             doc.metadata[config.LAST_MODIFIED_S3_METADATA_KEY] = iso_last_modified
+            doc.metadata[config.CONTENT_HASH_METADATA_KEY] = content_sha256
             # Preserve original source if loader provided one, otherwise use S3 URL
             if 'source' not in doc.metadata:
                  doc.metadata['source'] = public_url # Default source if loader didn't add one
@@ -136,16 +357,42 @@ def _load_and_split_document(local_file_path, s3_key, version_id, last_modified)
         return doc_chunks
 
     except Exception as e:
-        print(f"    ERROR processing local document {local_file_path} (from S3 key {s3_key}): {e}")
+        print(f"    ERROR splitting document from S3 key {s3_key}: {e}")
         traceback.print_exc() # Print detailed traceback for debugging
         return [] # Return empty list on error
 
+def _load_and_split_document(local_file_path, s3_key, version_id, last_modified, s3_client=None):
+    """
+    Loads a document from a *local* file path, adds S3 metadata, and splits it into chunks.
+    The raw loader output is stored in the parse cache so later re-chunking can skip the parse.
+    """
+    page_count = _large_pdf_page_count(local_file_path, s3_key)
+    if page_count:
+        loaded_docs = []
+        for first_page, docs in iter_pdf_page_ranges(local_file_path, s3_key, page_count):
+            if docs is None:
+                print(f"  Skipping {s3_key}: pages {first_page + 1}+ could not be extracted.")
+                return []
+            loaded_docs.extend(docs)
+        loaded_docs.sort(key=lambda doc: doc.metadata.get("page", 0))
+    else:
+        loaded_docs = _load_document(local_file_path, s3_key)
+    if not loaded_docs:
+        return []
+    parse_cache.put(s3_key, version_id, loaded_docs, s3_client)
+    return _split_loaded_documents(loaded_docs, s3_key, version_id, last_modified)
+
 def process_s3_object(s3_client, s3_key, version_id, last_modified):
     """
-    Downloads a single S3 object to a temporary location,
-    then calls _load_and_split_document to load, process, and split it.
-    Returns a list of Document chunks.
+    Returns a list of Document chunks for one S3 object version.
+    Uses the parsed-text cache when this (s3_key, version_id) was parsed before;
+    otherwise downloads the object to a temporary location and calls
+    _load_and_split_document to load, process, and split it.
     """
+    cached_docs = parse_cache.get(s3_key, version_id, s3_client)
+    if cached_docs:
+        return _split_loaded_documents(cached_docs, s3_key, version_id, last_modified)
+
     # Create a safe local filename from the S3 key
     safe_local_filename = "".join(c if c.isalnum() or c in ('_', '-') else '_' for c in os.path.basename(s3_key))
     if not safe_local_filename: # Handle case where basename is empty or only invalid chars
@@ -156,66 +403,284 @@ def process_s3_object(s3_client, s3_key, version_id, last_modified):
 
         # Download the file from S3
         download_ok = s3_handler.download_s3_object(
-            s3_client, config.S3_BUCKET_NAME, s3_key, temp_file_path
+            s3_client, config.S3_BUCKET_NAME, s3_key, temp_file_path, version_id
         )
 
         if download_ok:
             # If download succeeded, process the local file
-            return _load_and_split_document(temp_file_path, s3_key, version_id, last_modified)
+            return _load_and_split_document(temp_file_path, s3_key, version_id, last_modified, s3_client)
         else:
             # If download failed, log it and return empty list
             print(f"  Skipping processing for s3://{config.S3_BUCKET_NAME}/{s3_key} due to download failure.")
             return []
 
+def process_s3_objects(s3_client, objects_info):
+    """
+    Yields (s3_key, chunks) for many S3 objects ({s3_key: {'VersionId', 'LastModified'}}).
+    Parse-cache hits are split straight away; the remaining objects are downloaded
+    concurrently and parsed as each download completes.
+    """
+    to_download = []
+    for s3_key, info in objects_info.items():
+        cached_docs = parse_cache.get(s3_key, info.get('VersionId'), s3_client)
+        if cached_docs:
+            yield s3_key, _split_loaded_documents(cached_docs, s3_key, info.get('VersionId'), info.get('LastModified'))
+        else:
+            to_download.append(s3_key)
+
+    if not to_download:
+        return
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for s3_key, local_path, ok in s3_handler.download_s3_objects_concurrently(
+                s3_client, config.S3_BUCKET_NAME, to_download, dest_dir=temp_dir,
+                version_ids={s3_key: objects_info[s3_key].get('VersionId') for s3_key in to_download}):
+            if not ok:
+                print(f"  Skipping processing for s3://{config.S3_BUCKET_NAME}/{s3_key} due to download failure.")
+                yield s3_key, []
+                continue
+            info = objects_info[s3_key]
+            try:
+                yield s3_key, _load_and_split_document(
+                    local_path, s3_key, info.get('VersionId'), info.get('LastModified'), s3_client
+                )
+            finally:
+                if os.path.exists(local_path):
+                    os.remove(local_path) # Keep scratch space bounded to the in-flight downloads
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def get_parse_pool():
+    """Shared process pool for CPU-bound document parsing, created on first use."""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # 'spawn' avoids forking a process that already runs server/S3/embedding threads
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=config.PARSE_MAX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _parse_pool
+
+def process_local_files(files_info, s3_client=None):
+    """
+    Parses already-local files in parallel worker processes and yields
+    (s3_key, chunks) as each one finishes.
+    `files_info` maps s3_key -> {'path', 'VersionId', 'LastModified'}.
+    """
+    pool = get_parse_pool()
+    futures = {
+        pool.submit(_load_document, info['path'], s3_key): s3_key
+        for s3_key, info in files_info.items()
+    }
+    for future in as_completed(futures):
+        s3_key = futures[future]
+        info = files_info[s3_key]
+        try:
+            loaded_docs = future.result()
+        except Exception as e:
+            print(f"    ERROR parsing {s3_key} in worker process: {e}")
+            loaded_docs = []
+        if not loaded_docs:
+            yield s3_key, []
+            continue
+        parse_cache.put(s3_key, info.get('VersionId'), loaded_docs, s3_client)
+        yield s3_key, _split_loaded_documents(loaded_docs, s3_key, info.get('VersionId'), info.get('LastModified'))
+
+# --- Page-Parallel PDF Extraction ---
+
+def _load_pdf_pages(local_file_path, first_page, end_page):
+    """
+    Worker-process task: text of pages [first_page, end_page) of a PDF, one
+    Document per page with PyPDFLoader's core metadata (source, page, page_label).
+    """
+    reader = PdfReader(local_file_path)
+    total_pages = len(reader.pages)
+    docs = []
+    for page_number in range(first_page, min(end_page, total_pages)):
+        try:
+            label = reader.page_labels[page_number]
+        except Exception:
+            label = str(page_number + 1)
+        docs.append(Document(
+            page_content=reader.pages[page_number].extract_text() or "",
+            metadata={"source": local_file_path, "page": page_number, "page_label": label, "total_pages": total_pages},
+        ))
+    return docs
+
+def _large_pdf_page_count(local_file_path, s3_key):
+    """Page count of a PDF big enough for page-parallel extraction (config.PDF_PARALLEL_MIN_PAGES), else 0."""
+    if os.path.splitext(s3_key)[1].lower() != ".pdf" or not config.PDF_PARALLEL_MIN_PAGES:
+        return 0
+    try:
+        page_count = len(PdfReader(local_file_path).pages)
+    except Exception as e:
+        print(f"    Warning: Could not read the page count of {s3_key} ({e}). Using the regular loader.")
+        return 0
+    return page_count if page_count >= config.PDF_PARALLEL_MIN_PAGES else 0
+
+def _max_page_tasks(local_file_path):
+    """Page-range tasks allowed in flight under config.PDF_EXTRACT_MEMORY_CAP_MB."""
+    file_mb = os.path.getsize(local_file_path) / (1024 * 1024)
+    by_memory = int(config.PDF_EXTRACT_MEMORY_CAP_MB // (config.PDF_TASK_MEMORY_MB + file_mb))
+    return max(1, min(config.PARSE_MAX_WORKERS, by_memory))
+
+def iter_pdf_page_ranges(local_file_path, s3_key, page_count):
+    """
+    Extracts a PDF in page ranges of config.PDF_PAGES_PER_TASK on the parse
+    pool and yields (first_page, docs) as each range finishes (not in page
+    order). docs is None for a range whose extraction failed: the file is
+    then incomplete and must not be indexed or cached as parsed. Only as many
+    ranges as the memory cap allows run at once.
+    """
+    ranges = [(start, start + config.PDF_PAGES_PER_TASK) for start in range(0, page_count, config.PDF_PAGES_PER_TASK)]
+    max_in_flight = _max_page_tasks(local_file_path)
+    print(f"    Extracting {page_count} pages of {s3_key} in {len(ranges)} ranges ({max_in_flight} at a time)...")
+    pool = get_parse_pool()
+    pending = iter(ranges)
+    in_flight = {}
+    for first_page, end_page in pending:
+        in_flight[pool.submit(_load_pdf_pages, local_file_path, first_page, end_page)] = first_page
+        if len(in_flight) >= max_in_flight:
+            break
+    try:
+        while in_flight:
+            future = next(as_completed(in_flight))
+            first_page = in_flight.pop(future)
+            try:
+                docs = future.result()
+            except Exception as e:
+                print(f"    ERROR extracting pages {first_page}+ of {s3_key}: {e}")
+                traceback.print_exc()
+                docs = None
+            next_range = next(pending, None)
+            if next_range:
+                in_flight[pool.submit(_load_pdf_pages, local_file_path, *next_range)] = next_range[0]
+            yield first_page, docs
+    finally:
+        for future in in_flight: # The caller stopped early (e.g. after a failed range)
+            future.cancel()
+
+def ingest_pdf_progressively(vs, local_file_path, s3_key, version_id, last_modified, s3_client=None):
+    """
+    Indexes a large PDF range by range: each page range is split, embedded and
+    written as soon as its extraction finishes, so the file is partly
+    searchable long before it is fully parsed. The previous version's chunks
+    stay searchable until every page is in; then the references the new
+    version does not hold are released, and the file fingerprint and the
+    parse cache entry are written. The ingestion is logged as one update: if
+    it is interrupted, the startup replay has the file re-indexed.
+    If a page range cannot be extracted the ingestion fails: the file is not
+    registered or cached, its log record is left in place so the key is
+    re-indexed, and RuntimeError is raised.
+    Returns the number of chunks added, or None if the file is not a large PDF
+    (use process_s3_object + replace_documents for it).
+    """
+    page_count = _large_pdf_page_count(local_file_path, s3_key)
+    if not page_count:
+        return None
+    record_path = ingest_log.begin("progressive", [s3_key], targets={s3_key: version_id})
+    all_docs = []
+    chunk_ids = set()
+    for first_page, docs in iter_pdf_page_ranges(local_file_path, s3_key, page_count):
+        if docs is None:
+            # The ranges already written stay referenced next to the previous version until
+            # the key is re-indexed (the pending log record has its version forgotten)
+            raise RuntimeError(f"pages {first_page + 1}+ of {s3_key} could not be extracted; "
+                               f"{len(chunk_ids)} chunks of the partial version were written.")
+        all_docs.extend(docs)
+        chunks = _split_loaded_documents(docs, s3_key, version_id, last_modified, fingerprint=False) if docs else []
+        if not chunks:
+            continue
+        _, range_ids = replace_documents(vs, [], chunks, publish=False, log=False)
+        chunk_ids.update(range_ids)
+        print(f"    Pages {first_page + 1}-{first_page + len(docs)} of {s3_key} indexed "
+              f"({len(chunk_ids)} chunks so far).")
+    if not all_docs:
+        ingest_log.complete(record_path) # Nothing was written; the previous version is untouched
+        return 0
+    all_docs.sort(key=lambda doc: doc.metadata.get("page", 0))
+    with write_lock:
+        if vector_store is not None and vs is not vector_store and vs.persist_directory == vector_store.persist_directory:
+            vs = vector_store # The store was replaced by an embedding migration meanwhile
+        removed = release_keys(vs, [s3_key], keep={s3_key: chunk_ids})
+        registry.register_file(
+            s3_key, version_id, last_modified.isoformat() if last_modified else None,
+            content_registry.file_fingerprint(all_docs), [])
+        vs.persist()
+        ingest_log.complete(record_path)
+    if removed:
+        print(f"    Released {removed} chunks of the previous version of {s3_key}.")
+    parse_cache.put(s3_key, version_id, all_docs, s3_client)
+    publish_index()
+    return len(chunk_ids)
+
+def index_s3_object(vs, s3_client, s3_key, version_id, last_modified):
+    """
+    Indexes one S3 object version in place of the key's current chunks
+    (single uploads). Large PDFs are indexed progressively by page range;
+    everything else goes through process_s3_object and replace_documents.
+    Returns the number of chunks added (0 if the file yielded none); raises
+    RuntimeError if pages of a large PDF could not be extracted.
+    """
+    cached_docs = parse_cache.get(s3_key, version_id, s3_client)
+    if cached_docs:
+        chunks = _split_loaded_documents(cached_docs, s3_key, version_id, last_modified)
+    else:
+        safe_local_filename = "".join(c if c.isalnum() or c in ('_', '-', '.') else '_' for c in os.path.basename(s3_key))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file_path = os.path.join(temp_dir, safe_local_filename or f"s3_dl_{version_id or 'unknown'}")
+            if not s3_handler.download_s3_object(s3_client, config.S3_BUCKET_NAME, s3_key, temp_file_path, version_id):
+                print(f"  Skipping processing for s3://{config.S3_BUCKET_NAME}/{s3_key} due to download failure.")
+                return 0
+            chunk_count = ingest_pdf_progressively(vs, temp_file_path, s3_key, version_id, last_modified, s3_client)
+            if chunk_count is not None:
+                return chunk_count
+            chunks = _load_and_split_document(temp_file_path, s3_key, version_id, last_modified, s3_client)
+    if not chunks:
+        return 0
+    removed, _ = replace_documents(vs, [s3_key], chunks)
+    print(f"  Chunk update successful ({removed} old chunks removed). ChromaDB persisted.")
+    return len(chunks)
+
 # --- Vector Store Management ---
 
 def get_processed_files_from_db(vs):
     """
-    Retrieves a dictionary mapping S3 keys to their last processed VersionIDs
-    by querying the metadata of all documents in the ChromaDB instance.
+    Retrieves a dictionary mapping S3 keys to their last processed VersionIDs.
+    Files are tracked in the content registry (a deduplicated file may own no
+    chunks of its own); a database built before the registry existed is
+    registered from its chunk metadata first. A key whose version is unknown
+    (None, e.g. forgotten by replay_ingest_log) is kept, so the sync treats
+    it as updated and releases what its re-indexed version does not hold.
     """
     processed = {}
     if not vs:
         print("  Vector store not available for metadata query.")
         return processed
     try:
-        print("  Querying ChromaDB for existing S3 metadata...")
-        # Fetch only metadata, specify the keys needed for efficiency if possible
-        # `include=["metadatas"]` fetches all metadata fields for each document
-        results = vs.get(include=["metadatas"]) # Gets all entries
-
-        count = 0
-        s3_keys_found = set()
-        if results and results.get('metadatas') and results.get('ids'):
-            if len(results['ids']) == 0:
-                 print("  ChromaDB exists but contains no documents.")
-                 return processed
-
-            print(f"  Scanning metadata of {len(results['ids'])} chunks in DB...")
-            for metadata in results['metadatas']:
-                s3_key = metadata.get(config.S3_KEY_METADATA_KEY)
-                version_id = metadata.get(config.S3_VERSION_ID_METADATA_KEY)
-
-                # Ensure both key and version_id are present in the metadata
-                if s3_key and version_id:
-                    # Store the version ID associated with the key.
-                    # If a key somehow has multiple versions stored (shouldn't happen with correct update logic),
-                    # this will store the version ID from the *last* chunk encountered for that key.
-                    # The update logic relies on deleting *all* chunks for a key before adding the new ones.
-                    processed[s3_key] = version_id
-                    s3_keys_found.add(s3_key)
-                    count += 1
-                # Log if essential metadata is missing from a chunk (indicates potential issue)
-                # elif s3_key:
-                #     print(f"    Warning: Chunk metadata for S3 key '{s3_key}' is missing '{config.S3_VERSION_ID_METADATA_KEY}'.")
-                # else:
-                #     # This case is less likely if documents are added correctly
-                #     print(f"    Warning: Found chunk metadata missing '{config.S3_KEY_METADATA_KEY}'. Metadata: {metadata}")
-
-
-            print(f"  Found metadata for {len(s3_keys_found)} unique S3 keys across {count} relevant chunk entries in DB.")
+        if registry.is_empty() and vs.count() > 0:
+            print("  Content registry is empty. Registering existing chunks from ChromaDB metadata...")
+            # `include=["metadatas"]` fetches all metadata fields for each document
+            results = vs.get(include=["metadatas"]) # Gets all entries
+            ids = results.get('ids') or []
+            metadatas = results.get('metadatas') or []
+            print(f"  Scanning metadata of {len(ids)} chunks in DB...")
+            file_count = registry.bootstrap(
+                ids, metadatas,
+                key_field=config.S3_KEY_METADATA_KEY,
+                version_field=config.S3_VERSION_ID_METADATA_KEY,
+                last_modified_field=config.LAST_MODIFIED_S3_METADATA_KEY,
+                content_field=config.CONTENT_HASH_METADATA_KEY,
+            )
+            print(f"  Registered {file_count} S3 keys. Existing chunks keep their IDs; "
+                  "rebuild the DB to deduplicate content stored before this.")
+
+        processed = registry.file_versions()
+        rebuild_chunk_index()
+        if processed:
+            print(f"  Found {len(processed)} processed S3 keys in the content registry.")
         else:
-            # This case handles an empty DB or if the .get() call fails unexpectedly
             print("  No documents or metadata found in ChromaDB.")
     except Exception as e:
         print(f"  WARNING: Error fetching or processing metadata from ChromaDB: {e}")
@@ -223,12 +688,704 @@ def get_processed_files_from_db(vs):
         # Return potentially partial results, but log the error. Sync might be incomplete.
     return processed
 
+def rebuild_chunk_index():
+    """Rebuilds the in-memory S3 key -> chunk ID index from the content registry."""
+    try:
+        refs = registry.all_refs()
+        chunk_index.rebuild(refs)
+        print(f"  Chunk index built from {len(refs)} chunk references.")
+    except Exception as e:
+        print(f"  WARNING: Failed to build chunk index: {e}. Scoped queries will find no documents.")
+        traceback.print_exc()
+
+# --- Chunk Metadata Schema ---
+
+def compact_chunk_metadata(metadata):
+    """
+    Stored form of a chunk's metadata: its document (owner S3 key) and its
+    position (config.CHUNK_POSITION_METADATA_KEYS). Per-document fields are not
+    repeated on every chunk; expand_chunk_metadata joins them back on read.
+    """
+    metadata = metadata or {}
+    compact = {config.S3_KEY_METADATA_KEY: metadata.get(config.S3_KEY_METADATA_KEY)}
+    for key in config.CHUNK_POSITION_METADATA_KEYS:
+        compact[key] = metadata.get(key)
+    return {k: v for k, v in compact.items() if isinstance(v, (str, int, float, bool))}
+
+def expand_chunk_metadata(metadatas):
+    """Adds the per-document fields from the registry's files table to stored chunk metadata (in place)."""
+    infos = registry.file_infos({md.get(config.S3_KEY_METADATA_KEY) for md in metadatas if md}) if registry else {}
+    for metadata in metadatas:
+        s3_key = metadata.get(config.S3_KEY_METADATA_KEY)
+        if not s3_key:
+            continue
+        info = infos.get(s3_key, {})
+        public_url = s3_handler.construct_public_s3_url(s3_key)
+        fields = {
+            config.S3_URL_METADATA_KEY: public_url,
+            config.SOURCE_METADATA_KEY: public_url,
+            config.S3_VERSION_ID_METADATA_KEY: info.get('version_id'),
+            config.LAST_MODIFIED_S3_METADATA_KEY: info.get('last_modified'),
+            config.CONTENT_HASH_METADATA_KEY: info.get('content_sha256'),
+        }
+        metadata.update({k: v for k, v in fields.items() if v is not None})
+    return metadatas
+
+# --- Batched Writes ---
+
+def _write_stores(vs):
+    """`vs` plus, while an embedding migration runs, the store it is building (dual writes)."""
+    target = migration_target
+    return [vs] if target is None or target is vs else [vs, target]
+
+def add_chunks_in_batches(vs, chunks, ids, batch_size=None):
+    """
+    Embeds chunks in batches of `batch_size` (several batches in flight against
+    Ollama at once) and writes each batch to one shard's collection with one
+    upsert under the given IDs (aligned with `chunks`).
+    """
+    if not chunks:
+        return []
+    batch_size = batch_size or config.EMBED_BATCH_SIZE
+    batches = [(start, chunks[start:start + batch_size]) for start in range(0, len(chunks), batch_size)]
+    print(f"    Embedding {len(chunks)} chunks in {len(batches)} batch(es) of up to {batch_size}...")
+
+    with ThreadPoolExecutor(max_workers=config.EMBED_MAX_WORKERS, thread_name_prefix="embed") as executor:
+        futures = {
+            executor.submit(vs.embeddings.embed_documents, [chunk.page_content for chunk in batch]): (start, batch)
+            for start, batch in batches
+        }
+        for future in as_completed(futures):
+            start, batch = futures[future]
+            vs._collection.upsert(
+                ids=ids[start:start + len(batch)],
+                embeddings=future.result(),
+                metadatas=[compact_chunk_metadata(chunk.metadata) for chunk in batch],
+                documents=[chunk.page_content for chunk in batch],
+            )
+    return ids
+
+def add_chunks_deduplicated(vs, chunks):
+    """
+    Stores chunks under content-addressed IDs: text already in the collection
+    (from any key, or repeated within a file) is referenced, not re-embedded.
+    Registers each file's references and fingerprint and updates the chunk
+    index. Returns the chunk IDs aligned with `chunks`.
+    """
+    if not chunks:
+        return []
+    ids = [content_registry.chunk_content_id(chunk.page_content) for chunk in chunks]
+    existing = registry.existing_chunk_ids(ids)
+    new_chunks_by_id = {}
+    for chunk_id, chunk in zip(ids, chunks):
+        if chunk_id not in existing and chunk_id not in new_chunks_by_id:
+            new_chunks_by_id[chunk_id] = chunk
+    reused = len(chunks) - len(new_chunks_by_id)
+    if reused:
+        print(f"    {reused} of {len(chunks)} chunks already stored; embedding {len(new_chunks_by_id)}.")
+    # New chunks go to the shard of the key that owns them
+    new_by_shard = {}
+    for chunk_id, chunk in new_chunks_by_id.items():
+        shard_name = shard_store.shard_for_key(chunk.metadata.get(config.S3_KEY_METADATA_KEY) or "")
+        new_by_shard.setdefault(shard_name, ([], []))
+        new_by_shard[shard_name][0].append(chunk)
+        new_by_shard[shard_name][1].append(chunk_id)
+    for store in _write_stores(vs):
+        for shard_name, (shard_chunks, shard_ids) in new_by_shard.items():
+            add_chunks_in_batches(store.shard(shard_name), shard_chunks, shard_ids)
+
+    ids_by_key = {}
+    first_chunk_by_key = {}
+    for chunk_id, chunk in zip(ids, chunks):
+        s3_key = chunk.metadata.get(config.S3_KEY_METADATA_KEY)
+        ids_by_key.setdefault(s3_key, []).append(chunk_id)
+        first_chunk_by_key.setdefault(s3_key, chunk)
+    for s3_key, key_ids in ids_by_key.items():
+        metadata = first_chunk_by_key[s3_key].metadata
+        fingerprint = metadata.get(config.CONTENT_HASH_METADATA_KEY)
+        duplicate_of = registry.find_file_by_fingerprint(fingerprint, exclude_keys={s3_key})
+        if duplicate_of:
+            print(f"    {s3_key} has the same content as {duplicate_of}; its chunks are stored once and shared.")
+        owned_ids = [
+            chunk_id for chunk_id in key_ids
+            if chunk_id in new_chunks_by_id
+            and new_chunks_by_id[chunk_id].metadata.get(config.S3_KEY_METADATA_KEY) == s3_key
+        ]
+        registry.register_file(
+            s3_key,
+            metadata.get(config.S3_VERSION_ID_METADATA_KEY),
+            metadata.get(config.LAST_MODIFIED_S3_METADATA_KEY),
+            fingerprint,
+            key_ids,
+            owned_ids,
+        )
+    chunk_index.add_chunks(ids, chunks)
+    for store in _write_stores(vs):
+        update_document_vectors(store, ids_by_key.keys())
+    bump_corpus_version()
+    return ids
+
+# --- Document-Level Index (coarse retrieval stage) ---
+
+def update_document_vectors(vs, s3_keys):
+    """
+    Stores one vector per S3 key in the store's document index: the mean of
+    the vectors of every chunk the key references (shared chunks included).
+    Keys without chunks lose their document vector.
+    """
+    keys, vectors, metadatas, empty_keys = [], [], [], []
+    for s3_key in s3_keys:
+        if not s3_key:
+            continue
+        chunk_ids = sorted(chunk_index.chunk_ids([s3_key]))
+        rows = vs.get(include=["embeddings"], ids=chunk_ids) if chunk_ids else {"embeddings": []}
+        if not len(rows["embeddings"]):
+            empty_keys.append(s3_key)
+            continue
+        keys.append(s3_key)
+        vectors.append(np.mean(np.asarray(rows["embeddings"], dtype=np.float32), axis=0).tolist())
+        metadatas.append({config.S3_KEY_METADATA_KEY: s3_key, "chunks": len(rows["embeddings"])})
+    if keys:
+        vs.document_index().upsert(ids=keys, embeddings=vectors, metadatas=metadatas)
+    if empty_keys:
+        vs.document_index().delete(ids=empty_keys)
+    return len(keys)
+
+def ensure_document_index(vs, batch_size=100):
+    """Computes document vectors for registered keys that have none (indexes built before the document index)."""
+    indexed = set(vs.document_index().get(include=[])["ids"])
+    missing = [s3_key for s3_key in registry.file_versions() if s3_key not in indexed]
+    if not missing:
+        return 0
+    print(f"  Building document-level vectors for {len(missing)} S3 keys...")
+    built = 0
+    for start in range(0, len(missing), batch_size):
+        built += update_document_vectors(vs, missing[start:start + batch_size])
+    print(f"  Document index holds {vs.document_index().count()} documents.")
+    return built
+
+def _owner_metadata(metadata, owner):
+    metadata = compact_chunk_metadata(metadata)
+    metadata[config.S3_KEY_METADATA_KEY] = owner
+    return metadata
+
+def _reassign_owners(vs, new_owners):
+    """
+    Rewrites the stored metadata of shared chunks whose owner key was removed.
+    A chunk whose new owner lives in another shard is moved there (embedding
+    included), so every chunk stays in its owner's shard.
+    """
+    moves = {}
+    for chunk_id, (old_owner, new_owner) in new_owners.items():
+        route = (shard_store.shard_for_key(old_owner or new_owner), shard_store.shard_for_key(new_owner))
+        moves.setdefault(route, []).append(chunk_id)
+
+    for (source_shard, target_shard), chunk_ids in moves.items():
+        source = vs.shard(source_shard)
+        if source_shard == target_shard:
+            current = source._collection.get(ids=chunk_ids, include=["metadatas"])
+            ids = current.get('ids') or []
+            metadatas = [_owner_metadata(md, new_owners[i][1]) for i, md in zip(ids, current.get('metadatas') or [])]
+            if ids:
+                print(f"    Handing {len(ids)} shared chunks over to their remaining source keys...")
+                source._collection.update(ids=ids, metadatas=metadatas)
+            continue
+        current = source._collection.get(ids=chunk_ids, include=["metadatas", "documents", "embeddings"])
+        ids = current.get('ids') or []
+        if not ids:
+            continue
+        print(f"    Moving {len(ids)} shared chunks from shard '{source_shard}' to '{target_shard}' with their new owner...")
+        vs.shard(target_shard)._collection.upsert(
+            ids=ids,
+            embeddings=current['embeddings'],
+            metadatas=[_owner_metadata(md, new_owners[i][1]) for i, md in zip(ids, current['metadatas'])],
+            documents=current['documents'],
+        )
+        source._collection.delete(ids=ids)
+
+def release_keys(vs, s3_keys, keep=None):
+    """
+    Drops every reference the given keys hold. Chunks no other key references
+    are deleted; shared chunks owned by a removed key are handed to a key that
+    still contains them. `keep` ({s3_key: chunk_ids}) spares the references a
+    replaced key's new version holds (see replace_documents).
+    Returns the number of chunks deleted.
+    """
+    s3_keys = set(s3_keys)
+    keep = {s3_key: set(ids) for s3_key, ids in (keep or {}).items() if s3_key in s3_keys}
+    orphaned, new_owners = registry.remove_keys(s3_keys, keep)
+    if orphaned:
+        print(f"    Deleting {len(orphaned)} chunk IDs no longer referenced by any key...")
+    for store in _write_stores(vs):
+        ids_by_shard = {}
+        for chunk_id, owner in orphaned.items():
+            shard_names = [shard_store.shard_for_key(owner)] if owner else store.shard_names()
+            for shard_name in shard_names:
+                ids_by_shard.setdefault(shard_name, []).append(chunk_id)
+        for shard_name, ids in ids_by_shard.items():
+            store.shard(shard_name).delete(ids=ids)
+        if new_owners:
+            _reassign_owners(store, new_owners)
+        dropped_keys = list(s3_keys - keep.keys())
+        if dropped_keys:
+            store.document_index().delete(ids=dropped_keys)
+    chunk_index.remove_keys(s3_keys - keep.keys())
+    chunk_index.retain(keep)
+    if keep:
+        for store in _write_stores(vs):
+            update_document_vectors(store, keep.keys())
+    bump_corpus_version()
+    return len(orphaned)
+
+def _apply_replace(vs, s3_keys, new_chunks):
+    """
+    Adds `new_chunks`, then releases the references of `s3_keys` the new
+    chunks do not hold. Idempotent, so a logged update can be re-applied.
+    Returns (chunks_removed, chunk_ids, released).
+    """
+    # Added before the release: a key's old version stays searchable until its
+    # new chunks are in, and text both versions share is kept, not re-embedded
+    chunk_ids = add_chunks_deduplicated(vs, new_chunks)
+    keep = {}
+    for chunk_id, chunk in zip(chunk_ids, new_chunks):
+        s3_key = chunk.metadata.get(config.S3_KEY_METADATA_KEY)
+        if s3_key in s3_keys:
+            keep.setdefault(s3_key, set()).add(chunk_id)
+    removed, released = 0, True
+    if s3_keys:
+        try:
+            _refresh_positions(vs, keep, new_chunks, chunk_ids)
+            removed = release_keys(vs, s3_keys, keep)
+        except Exception as e:
+            print(f"    WARNING: Error releasing superseded chunks for {len(s3_keys)} key(s): {e}. "
+                  "The release is retried on the next startup.")
+            traceback.print_exc()
+            released = False
+    return removed, chunk_ids, released
+
+def _refresh_positions(vs, keep, new_chunks, chunk_ids):
+    """
+    Rewrites the stored position metadata of kept chunks a replaced key owns:
+    text the previous version shared may sit on another page or offset now.
+    """
+    chunk_by_id = dict(zip(chunk_ids, new_chunks))
+    owners = registry.chunk_owners(chunk_by_id)
+    for s3_key, ids in keep.items():
+        owned = sorted(chunk_id for chunk_id in ids if owners.get(chunk_id) == s3_key)
+        if not owned:
+            continue
+        metadatas = [compact_chunk_metadata(chunk_by_id[chunk_id].metadata) for chunk_id in owned]
+        for store in _write_stores(vs):
+            store.shard(shard_store.shard_for_key(s3_key))._collection.update(ids=owned, metadatas=metadatas)
+
+def replace_documents(vs, s3_keys, new_chunks, publish=True, log=True):
+    """
+    Replaces every chunk reference of `s3_keys` with `new_chunks`: deduplicated
+    batched embedding/writes, one release of the references the new version
+    no longer holds, and a single persist. Keeps the chunk index in step.
+    The update is recorded in the ingestion log first and only dropped from it
+    once persisted, so a crash or failure part-way is re-applied on startup
+    (replay_ingest_log). `log=False` is for callers that log the update
+    themselves (progressive ingestion). `publish=False` leaves the snapshot
+    to the caller.
+    Returns (chunks_removed, chunk_ids). Raises if the new chunks cannot be
+    added; the key's previous chunks are then still in place.
+    """
+    s3_keys = set(s3_keys)
+    with write_lock:
+        if vector_store is not None and vs is not vector_store and vs.persist_directory == vector_store.persist_directory:
+            vs = vector_store # The store was replaced by an embedding migration while this request ran
+        record_path = None
+        if log:
+            targets = {chunk.metadata.get(config.S3_KEY_METADATA_KEY): chunk.metadata.get(config.S3_VERSION_ID_METADATA_KEY)
+                       for chunk in new_chunks}
+            record_path = ingest_log.begin("replace", s3_keys, new_chunks, targets)
+
+        removed, chunk_ids, released = _apply_replace(vs, s3_keys, new_chunks)
+
+        try:
+            vs.persist()
+        except Exception as e:
+            print(f"    WARNING: Failed to persist ChromaDB changes: {e}")
+            released = False
+        if record_path and released:
+            ingest_log.complete(record_path)
+        if publish:
+            publish_index()
+    return removed, chunk_ids
+
+def replay_ingest_log(vs):
+    """
+    Re-applies every index update the ingestion log still holds (the process
+    stopped, or the update failed, before it was persisted). Cost depends on
+    the pending updates only. A "replace" record is applied again from the
+    chunks it carries; an interrupted progressive ingestion has its key's
+    version forgotten so the S3 sync that follows re-indexes the file. That
+    sync also re-indexes any key whose S3 version moved past a replayed one.
+    Returns the number of records replayed.
+    """
+    records = ingest_log.pending()
+    if not records:
+        return 0
+    print(f"  Replaying {len(records)} unfinished index update(s) from the ingestion log...")
+    replayed = 0
+    with write_lock:
+        for path, record in records:
+            keys = set(record.get("keys", []))
+            try:
+                if record.get("kind") == "progressive":
+                    for s3_key in record.get("targets", {}):
+                        registry.invalidate_file(s3_key)
+                    print(f"    {', '.join(sorted(record.get('targets', {})))}: interrupted progressive ingestion, "
+                          "re-indexed by the S3 sync.")
+                    ingest_log.complete(path)
+                    replayed += 1
+                    continue
+                chunks = ingest_log.record_chunks(record)
+                removed, _, released = _apply_replace(vs, keys, chunks)
+                vs.persist()
+                if released:
+                    ingest_log.complete(path)
+                    replayed += 1
+                print(f"    Update {record['op_id']}: {len(chunks)} chunks for {len(record.get('targets', {}))} key(s) "
+                      f"applied, {removed} superseded chunks deleted.")
+            except Exception as e:
+                print(f"    WARNING: Could not replay ingestion log record '{path}': {e}. It is kept for the next startup.")
+                traceback.print_exc()
+    return replayed
+
+# --- Writer / Read-Replica Deployment ---
+
+def publish_index(wait=False):
+    """
+    Writer role: publishes the working index as a new read-only version.
+    Publishing copies the whole index directory, so writes within
+    config.INDEX_PUBLISH_DEBOUNCE_SECONDS of each other share one publication;
+    `wait=True` publishes now and returns the version. No-op in other roles.
+    """
+    global _publish_timer
+    if config.INDEX_ROLE != "writer":
+        return None
+    if wait or config.INDEX_PUBLISH_DEBOUNCE_SECONDS <= 0:
+        return _publish_now()
+    with _publish_timer_lock:
+        if _publish_timer is None:
+            _publish_timer = threading.Timer(config.INDEX_PUBLISH_DEBOUNCE_SECONDS, _publish_scheduled)
+            _publish_timer.daemon = True
+            _publish_timer.start()
+    return None
+
+def _publish_scheduled():
+    global _publish_timer
+    with _publish_timer_lock:
+        _publish_timer = None
+    _publish_now()
+
+def _publish_now():
+    with write_lock:
+        try:
+            version = index_publisher.publish(config.CHROMA_PATH)
+            print(f"  Published index version '{version}' to '{config.INDEX_PUBLISH_DIR}'.")
+            return version
+        except Exception as e:
+            print(f"  WARNING: Failed to publish index snapshot: {e}. Readers keep serving the previous version.")
+            traceback.print_exc()
+            return None
+
+def acquire_index(vs):
+    """Marks `vs` as used by a chain until release_index (reader role: its version is then kept open)."""
+    with _index_users_lock:
+        _index_users[id(vs)] = _index_users.get(id(vs), 0) + 1
+    return vs
+
+def release_index(vs):
+    with _index_users_lock:
+        remaining = _index_users.get(id(vs), 0) - 1
+        if remaining > 0:
+            _index_users[id(vs)] = remaining
+        else:
+            _index_users.pop(id(vs), None)
+    _close_idle_indexes()
+
+def _close_idle_indexes():
+    """Closes superseded published versions no chain uses any more."""
+    with _index_users_lock:
+        idle = [entry for entry in _retired_indexes if id(entry[1]) not in _index_users]
+        for entry in idle:
+            _retired_indexes.remove(entry)
+    for version, store, old_registry in idle:
+        store.close()
+        old_registry.close()
+        print(f"  Closed superseded index version '{version}'.")
+
+def _refresh_reader_lease():
+    """Reader role: tells the writer which versions this process still has open (so they are not pruned)."""
+    with _index_users_lock:
+        versions = [version for version, _, _ in _retired_indexes]
+    if active_index_version:
+        versions.append(active_index_version)
+    try:
+        index_publisher.write_lease(index_publisher.reader_id(), versions)
+    except Exception as e:
+        print(f"  WARNING: Could not refresh the index lease: {e}")
+
+def _remove_reader_lease():
+    if config.INDEX_ROLE == "reader":
+        index_publisher.remove_lease(index_publisher.reader_id())
+
+atexit.register(_remove_reader_lease)
+
+def load_published_index(version):
+    """
+    Opens a published version and swaps it in as the active index. Chains that
+    are already running keep the store and registry they were created with;
+    the previous version is closed once none of them uses it (release_index).
+    """
+    global vector_store, embeddings, registry, chunk_index, active_index_version, embedding_state
+    path = index_publisher.version_path(version)
+    new_registry = content_registry.ContentRegistry(
+        os.path.join(path, os.path.basename(config.CONTENT_REGISTRY_PATH))
+    )
+    new_chunk_index = ChunkKeyIndex()
+    new_chunk_index.rebuild(new_registry.all_refs())
+    # The writer may have switched embedding models; the version records which one it uses
+    new_store, new_state = open_sharded_store(path)
+    if new_store is None:
+        raise RuntimeError(f"embeddings model '{new_state['model']}' unavailable")
+    # Swap all three together; the old version stays open for in-flight chains
+    if vector_store is not None and active_index_version:
+        with _index_users_lock:
+            _retired_indexes.append((active_index_version, vector_store, registry))
+    vector_store, registry, chunk_index = new_store, new_registry, new_chunk_index
+    embeddings, embedding_state = new_store.embeddings, new_state
+    active_index_version = version
+    bump_corpus_version()
+    _refresh_reader_lease()
+    _close_idle_indexes()
+    print(f"  Serving index version '{version}' ({new_store.count()} chunks).")
+    return new_store
+
+def refresh_published_index():
+    """Reader role: switches to the newest published version if it changed. Returns the new store or None."""
+    version = index_publisher.current_version()
+    if not version or version == active_index_version:
+        if active_index_version:
+            _refresh_reader_lease()
+        return None
+    try:
+        return load_published_index(version)
+    except Exception as e:
+        print(f"  WARNING: Failed to load published index version '{version}': {e}. Keeping the current one.")
+        traceback.print_exc()
+        return None
+
+def initialize_read_replica():
+    """
+    Reader role: loads the newest published index without touching S3 or
+    writing anything. Waits for the writer if nothing has been published yet.
+    """
+    print("\n--- Initializing Read-Only Index Replica ---")
+    if not get_embeddings_model():
+        print("  FATAL: Could not initialize embeddings model. Exiting.")
+        exit(1)
+    while True:
+        vs = refresh_published_index()
+        if vs:
+            print("\n--- Read-Only Index Replica Ready ---")
+            return vs
+        print(f"  No published index in '{config.INDEX_PUBLISH_DIR}' yet. Waiting for the writer process...")
+        time.sleep(config.INDEX_POLL_INTERVAL)
+
+# --- Full Build Checkpointing ---
+
+def load_build_checkpoint():
+    """Returns the interrupted full build's checkpoint ({'completed': {s3_key: version_id}}) or None."""
+    if not os.path.exists(config.BUILD_CHECKPOINT_PATH):
+        return None
+    try:
+        with open(config.BUILD_CHECKPOINT_PATH, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        checkpoint.setdefault("completed", {})
+        return checkpoint
+    except Exception as e:
+        print(f"  WARNING: Unreadable build checkpoint ({e}). Resuming from an empty checkpoint.")
+        return {"completed": {}}
+
+def save_build_checkpoint(checkpoint):
+    """Writes the checkpoint atomically so a crash never leaves a partial file."""
+    _write_json_atomic(config.BUILD_CHECKPOINT_PATH, checkpoint)
+
+def clear_build_checkpoint():
+    if os.path.exists(config.BUILD_CHECKPOINT_PATH):
+        os.remove(config.BUILD_CHECKPOINT_PATH)
+
+def stream_full_build(vs, s3_client, objects_info, checkpoint, checkpoint_to_disk=True):
+    """
+    Builds the index in bounded batches: chunks are buffered only until
+    config.BUILD_BATCH_CHUNKS is reached, then embedded, written and persisted,
+    and the batch's keys are recorded in the checkpoint. Peak memory is one
+    batch plus the in-flight downloads, whatever the bucket size. Chunk IDs are
+    content hashes, so a batch interrupted mid-write is simply rewritten on resume.
+    Returns (files_processed, chunks_processed).
+    """
+    pending_chunks = []
+    pending_keys = {}
+    file_count = 0
+    chunk_count = 0
+
+    def flush():
+        if not pending_chunks:
+            return
+        add_chunks_deduplicated(vs, pending_chunks)
+        vs.persist()
+        checkpoint["completed"].update(pending_keys)
+        if checkpoint_to_disk:
+            save_build_checkpoint(checkpoint)
+        print(f"    Batch committed: {len(pending_chunks)} chunks from {len(pending_keys)} files "
+              f"({len(checkpoint['completed'])} files done).")
+        pending_chunks.clear()
+        pending_keys.clear()
+
+    for s3_key, chunks in process_s3_objects(s3_client, objects_info):
+        print(f"  Processed {s3_key} (Version: {objects_info[s3_key].get('VersionId', 'N/A')}).")
+        if not chunks:
+            # Not checkpointed, so a resumed build (or the next sync) retries it
+            print(f"    Warning: Failed to process or get chunks for {s3_key}. It will not be included in the initial build.")
+            continue
+        pending_chunks.extend(chunks)
+        pending_keys[s3_key] = objects_info[s3_key].get('VersionId')
+        file_count += 1
+        chunk_count += len(chunks)
+        if len(pending_chunks) >= config.BUILD_BATCH_CHUNKS:
+            flush()
+    flush()
+    return file_count, chunk_count
+
+def sync_with_s3(vs, s3_client, shard_name=None):
+    """
+    Brings the vector store in line with the bucket:
+        - Finds new files in S3 -> processes and adds them.
+        - Finds updated files in S3 -> releases old chunks, processes new version, adds new chunks.
+        - Finds files deleted from S3 -> releases their chunks.
+    With `shard_name`, only keys belonging to that shard are considered.
+    """
+    print(f"\n--- Starting S3 Synchronization Check{f' (shard {shard_name})' if shard_name else ''} ---")
+    processed_db_info = get_processed_files_from_db(vs) # Get {s3_key: versionId} from DB
+    current_s3_info = s3_handler.list_s3_objects_versions(s3_client, config.S3_BUCKET_NAME, config.S3_PREFIX) # Get {s3_key: {VersionId, LastModified}} from S3
+    if shard_name:
+        # Only keys that map to this shard take part; other shards are left untouched
+        processed_db_info = {k: v for k, v in processed_db_info.items() if shard_store.shard_for_key(k) == shard_name}
+        current_s3_info = {k: v for k, v in current_s3_info.items() if shard_store.shard_for_key(k) == shard_name}
+
+    chunks_to_add = []
+    keys_to_remove_chunks_for = set() # Collect all S3 keys whose chunks need deletion (updated or deleted)
+    new_files_processed = 0
+    updated_files_processed = 0
+    processed_keys_in_db = set(processed_db_info.keys())
+    current_keys_in_s3 = set(current_s3_info.keys())
+
+    # Identify New and Updated Files
+    print("  Checking for new or updated files in S3...")
+    new_keys = set()
+    objects_to_process = {}
+    for s3_key, s3_info in current_s3_info.items():
+        current_version_id = s3_info.get('VersionId')
+        stored_version_id = processed_db_info.get(s3_key)
+
+        if s3_key not in processed_db_info:
+            # File is in S3 but not in DB -> New file
+            print(f"    + New file detected: {s3_key}")
+            new_keys.add(s3_key)
+            objects_to_process[s3_key] = s3_info
+        elif current_version_id != stored_version_id:
+            # File is in S3 and DB, but VersionID differs -> Updated file
+            print(f"    * Updated file detected: {s3_key} (S3 Ver: {current_version_id}, DB Ver: {stored_version_id})")
+            # Mark this key for deletion of old chunks FIRST
+            keys_to_remove_chunks_for.add(s3_key)
+            objects_to_process[s3_key] = s3_info
+        # else: File exists in both and version matches -> No action needed
+
+    # Process new/updated files (downloads run concurrently)
+    for s3_key, processed_chunks in process_s3_objects(s3_client, objects_to_process):
+        if s3_key in new_keys:
+            if processed_chunks:
+                chunks_to_add.extend(processed_chunks)
+                new_files_processed += 1
+            else:
+                print(f"      Warning: Failed to process new file {s3_key}, it will not be added.")
+        elif processed_chunks:
+            chunks_to_add.extend(processed_chunks) # Add new chunks later
+            updated_files_processed += 1
+        else:
+            # If processing the update fails, DON'T delete the old version chunks.
+            print(f"      Warning: Failed to process updated file {s3_key}. Old version chunks will NOT be removed, and the update will NOT be added.")
+            keys_to_remove_chunks_for.discard(s3_key) # Remove from deletion list
+
+    # Identify Deleted Files
+    print("  Checking for files deleted from S3...")
+    keys_deleted_from_s3 = processed_keys_in_db - current_keys_in_s3
+    if keys_deleted_from_s3:
+        print(f"    - {len(keys_deleted_from_s3)} file(s) deleted from S3 detected:")
+        for key in keys_deleted_from_s3:
+            print(f"      - {key}")
+        # Mark these keys for chunk removal as well
+        keys_to_remove_chunks_for.update(keys_deleted_from_s3)
+    else:
+        print("    No files found deleted from S3.")
+
+    # --- Perform DB Modifications ---
+    # 6. One logged update: new/updated chunks are added first, then the references of
+    # updated/deleted keys that the new versions do not hold are released (see replace_documents)
+    if keys_to_remove_chunks_for or chunks_to_add:
+        print(f"\n  Adding {len(chunks_to_add)} new/updated chunks and releasing superseded chunks "
+              f"of {len(keys_to_remove_chunks_for)} updated/deleted S3 keys...")
+        try:
+            chunks_deleted, _ = replace_documents(vs, keys_to_remove_chunks_for, chunks_to_add, publish=False)
+            print(f"  Update successful ({chunks_deleted} chunks deleted). ChromaDB persisted.")
+        except Exception as e:
+            print(f"    WARNING: Error adding new/updated chunks to ChromaDB: {e}")
+            print(f"    Previous versions stay searchable; the update is retried from the ingestion log on the next startup.")
+            traceback.print_exc()
+    else:
+        print("\n  No changes made to ChromaDB during sync.")
+
+    print(f"\n--- S3 Synchronization Summary ---")
+    print(f"  New files processed: {new_files_processed}")
+    print(f"  Updated files processed: {updated_files_processed}")
+    print(f"  Files deleted from S3: {len(keys_deleted_from_s3)}")
+    print(f"  Chunks added: {len(chunks_to_add)}")
+    print(f"  S3 Keys whose chunks were removed: {len(keys_to_remove_chunks_for)}")
+    print(f"--- S3 Synchronization Complete ---")
+
+def rebuild_shard(vs, s3_client, shard_name):
+    """
+    Rebuilds one shard without touching the others: releases every key that
+    maps to it, drops its collection, then re-processes those keys from S3
+    (parse-cache hits skip the download and parse).
+    Returns (files_processed, chunks_processed).
+    """
+    print(f"\n--- Rebuilding shard '{shard_name}' ---")
+    shard_keys = [k for k in registry.file_versions() if shard_store.shard_for_key(k) == shard_name]
+    if shard_keys:
+        print(f"  Releasing {len(shard_keys)} keys currently stored in the shard...")
+        release_keys(vs, shard_keys)
+    vs.drop_shard(shard_name)
+
+    current_s3_info = s3_handler.list_s3_objects_versions(s3_client, config.S3_BUCKET_NAME, config.S3_PREFIX)
+    shard_info = {k: v for k, v in current_s3_info.items() if shard_store.shard_for_key(k) == shard_name}
+    print(f"  Processing {len(shard_info)} S3 objects for shard '{shard_name}'...")
+    # Same bounded batching as the full build; the checkpoint is only kept in memory here
+    file_count, chunk_count = stream_full_build(vs, s3_client, shard_info, {"completed": {}}, checkpoint_to_disk=False)
+    print(f"--- Shard '{shard_name}' rebuilt: {chunk_count} chunks from {file_count} files ---")
+    return file_count, chunk_count
+
 def initialize_vector_store(force_rebuild=False):
     """
     Initializes the Chroma vector store.
     - Checks if a local DB exists.
     - Handles forced rebuilds by deleting the existing DB.
-    - If no DB exists or rebuild forced: builds a new DB from all current S3 objects.
+    - If no DB exists or rebuild forced: builds a new DB from all current S3 objects,
+      in checkpointed batches (an interrupted build resumes where it stopped).
     - If DB exists: loads it.
     - Performs an S3 synchronization:
         - Finds new files in S3 -> processes and adds them.
@@ -236,7 +1393,7 @@ def initialize_vector_store(force_rebuild=False):
         - Finds files deleted from S3 -> deletes corresponding chunks from DB.
     - Persists changes.
     - Sets the module-level `vector_store` variable.
-    - Returns the Chroma instance or exits fatally on critical errors.
+    - Returns the shard_store.ShardedStore instance or exits fatally on critical errors.
     """
     global vector_store, embeddings
     print("\n--- Initializing Vector Store ---")
@@ -268,76 +1425,94 @@ def initialize_vector_store(force_rebuild=False):
             print(f"  FATAL ERROR deleting existing Chroma DB: {e}. Please remove manually and restart.")
             exit(1)
 
+    # The content registry lives inside the DB directory, so a rebuild starts it fresh too
+    try:
+        open_content_registry()
+    except Exception as e:
+        print(f"  FATAL ERROR opening content registry at '{config.CONTENT_REGISTRY_PATH}': {e}")
+        traceback.print_exc()
+        exit(1)
+
+    # A checkpoint left inside an existing DB means a full build was interrupted
+    build_checkpoint = load_build_checkpoint() if db_exists else None
+
     # 4. Build New DB or Load Existing One
-    if not db_exists:
-        # --- Build New DB from S3 ---
-        print(f"  No DB found at '{db_path}' or rebuild forced. Performing full initial load from S3...")
+    if not db_exists or build_checkpoint is not None:
+        # --- Build New DB from S3 (or resume an interrupted build) ---
+        if build_checkpoint is not None:
+            print(f"  Found an unfinished full build at '{db_path}' "
+                  f"({len(build_checkpoint['completed'])} files completed). Resuming...")
+        else:
+            print(f"  No DB found at '{db_path}' or rebuild forced. Performing full initial load from S3...")
+        resuming = build_checkpoint is not None
         # List current files/versions in S3
         s3_objects_info = s3_handler.list_s3_objects_versions(s3_client, config.S3_BUCKET_NAME, config.S3_PREFIX)
-        all_chunks = []
         if not s3_objects_info:
             print(f"  WARNING: No files found in s3://{config.S3_BUCKET_NAME}/{config.S3_PREFIX}. Initializing an empty DB.")
             # Create an empty DB instance if bucket is empty
             try:
-                 vs = Chroma(embedding_function=embeddings, persist_directory=db_path)
+                 vs, state = open_sharded_store(db_path)
                  # Need to explicitly persist to create the directory structure
                  vs.persist()
+                 clear_build_checkpoint()
                  print(f"  Empty vector store created and persisted at '{db_path}'")
             except Exception as e:
                  print(f"  FATAL ERROR creating empty Chroma DB: {e}")
                  traceback.print_exc()
                  exit(1)
         else:
-             # Process all found S3 objects
-             print(f"  Processing {len(s3_objects_info)} S3 objects for initial embedding...")
-             file_count = 0
-             processed_chunks_count = 0
-             for s3_key, info in s3_objects_info.items():
-                 print(f"  Processing {s3_key} (Version: {info.get('VersionId', 'N/A')})...")
-                 chunks = process_s3_object(s3_client, s3_key, info.get('VersionId'), info.get('LastModified'))
-                 if chunks:
-                     all_chunks.extend(chunks)
-                     file_count += 1
-                     processed_chunks_count += len(chunks)
-                 else:
-                      print(f"    Warning: Failed to process or get chunks for {s3_key}. It will not be included in the initial build.")
-
-             # Create Chroma DB from the collected chunks
-             if not all_chunks:
-                  print("  WARNING: No documents could be successfully processed from S3. Creating an empty DB.")
-                  try:
-                     vs = Chroma(embedding_function=embeddings, persist_directory=db_path)
+             try:
+                 vs, state = open_sharded_store(db_path)
+             except Exception as e:
+                 print(f"  FATAL ERROR creating Chroma DB at '{db_path}': {e}")
+                 traceback.print_exc()
+                 exit(1)
+
+             if not resuming:
+                 build_checkpoint = {"completed": {}}
+                 save_build_checkpoint(build_checkpoint)
+             # Skip files the interrupted build already wrote (same key and version)
+             remaining_info = {
+                 s3_key: info for s3_key, info in s3_objects_info.items()
+                 if build_checkpoint["completed"].get(s3_key) != info.get('VersionId')
+             }
+             already_done = len(s3_objects_info) - len(remaining_info)
+             if resuming:
+                 # Keys the interrupted build wrote at another version: drop that version's references
+                 # first, or they would stay attached next to the re-added version
+                 registered = registry.file_versions()
+                 stale_keys = [s3_key for s3_key, info in remaining_info.items()
+                               if s3_key in registered and registered[s3_key] != info.get('VersionId')]
+                 if stale_keys:
+                     print(f"  Releasing {len(stale_keys)} keys written at a version S3 no longer has...")
+                     release_keys(vs, stale_keys)
                      vs.persist()
-                     print(f"  Empty vector store created and persisted at '{db_path}'")
-                  except Exception as e:
-                     print(f"  FATAL ERROR creating empty Chroma DB after processing failure: {e}")
-                     traceback.print_exc()
-                     exit(1)
-             else:
-                  print(f"\n  Creating new Chroma vector store with {processed_chunks_count} chunks from {file_count} successfully processed files...")
-                  try:
-                      vs = Chroma.from_documents(
-                          documents=all_chunks,
-                          embedding=embeddings, # Pass the initialized embeddings function
-                          persist_directory=db_path
-                      )
-                      vs.persist() # Persist after creation
-                      print(f"  Vector store created with initial data and persisted at '{db_path}'")
-                  except Exception as e:
-                      print(f"  FATAL ERROR creating new Chroma DB from documents: {e}")
-                      traceback.print_exc()
-                      exit(1)
-        # No S3 sync needed immediately after a full build
-        needs_s3_sync = False
+             print(f"  Processing {len(remaining_info)} S3 objects for initial embedding "
+                   f"({already_done} already done) in batches of up to {config.BUILD_BATCH_CHUNKS} chunks...")
+             try:
+                 file_count, processed_chunks_count = stream_full_build(vs, s3_client, remaining_info, build_checkpoint)
+             except Exception as e:
+                 print(f"  FATAL ERROR during full build: {e}")
+                 print("  Completed batches are kept; restart to resume from the checkpoint.")
+                 traceback.print_exc()
+                 exit(1)
+             clear_build_checkpoint()
+             if file_count == 0 and already_done == 0:
+                 print("  WARNING: No documents could be successfully processed from S3. The DB is empty.")
+             print(f"  Vector store built with {vs.count()} unique chunks in {len(vs.shard_names())} shard(s) "
+                   f"({processed_chunks_count} chunks from {file_count} files this run) at '{db_path}'")
+        # No S3 sync needed immediately after a full build; a resumed one may have missed
+        # deletions/updates of files it had already written before the interruption
+        needs_s3_sync = resuming
 
     else:
         # --- Load Existing DB ---
         print(f"  Loading existing Chroma vector store from '{db_path}'...")
         try:
-            vs = Chroma(persist_directory=db_path, embedding_function=embeddings)
+            vs, state = open_sharded_store(db_path)
             # Simple check to see if it loaded something
-            count = vs._collection.count()
-            print(f"  Vector store loaded successfully with {count} existing chunks.")
+            count = vs.count()
+            print(f"  Vector store loaded successfully with {count} existing chunks in {len(vs.shard_names())} shard(s).")
             needs_s3_sync = True # Need to sync after loading
         except Exception as e:
             # Includes errors like directory not found, invalid metadata, etc.
@@ -346,140 +1521,10 @@ def initialize_vector_store(force_rebuild=False):
             traceback.print_exc()
             exit(1) # Exit if loading fails
 
-    # 5. S3 Synchronization (if DB was loaded, not newly built)
+    # 5. Finish updates a crash interrupted, then S3 Synchronization (if DB was loaded, not newly built)
     if vs and needs_s3_sync:
-        print("\n--- Starting S3 Synchronization Check ---")
-        processed_db_info = get_processed_files_from_db(vs) # Get {s3_key: versionId} from DB
-        current_s3_info = s3_handler.list_s3_objects_versions(s3_client, config.S3_BUCKET_NAME, config.S3_PREFIX) # Get {s3_key: {VersionId, LastModified}} from S3
-
-        chunks_to_add = []
-        keys_to_remove_chunks_for = set() # Collect all S3 keys whose chunks need deletion (updated or deleted)
-        new_files_processed = 0
-        updated_files_processed = 0
-        processed_keys_in_db = set(processed_db_info.keys())
-        current_keys_in_s3 = set(current_s3_info.keys())
-
-        # Identify New and Updated Files
-        print("  Checking for new or updated files in S3...")
-        for s3_key, s3_info in current_s3_info.items():
-            current_version_id = s3_info.get('VersionId')
-            last_modified = s3_info.get('LastModified')
-            stored_version_id = processed_db_info.get(s3_key)
-
-            if s3_key not in processed_db_info:
-                # File is in S3 but not in DB -> New file
-                print(f"    + New file detected: {s3_key}")
-                new_chunks = process_s3_object(s3_client, s3_key, current_version_id, last_modified)
-                if new_chunks:
-                    chunks_to_add.extend(new_chunks)
-                    new_files_processed += 1
-                else:
-                    print(f"      Warning: Failed to process new file {s3_key}, it will not be added.")
-            elif current_version_id != stored_version_id:
-                # File is in S3 and DB, but VersionID differs -> Updated file
-                print(f"    * Updated file detected: {s3_key} (S3 Ver: {current_version_id}, DB Ver: {stored_version_id})")
-                # Mark this key for deletion of old chunks FIRST
-                keys_to_remove_chunks_for.add(s3_key)
-                # Process the updated file
-                updated_chunks = process_s3_object(s3_client, s3_key, current_version_id, last_modified)
-                if updated_chunks:
-                    chunks_to_add.extend(updated_chunks) # Add new chunks later
-                    updated_files_processed += 1
-                else:
-                    # If processing the update fails, DON'T delete the old version chunks.
-                    print(f"      Warning: Failed to process updated file {s3_key}. Old version chunks will NOT be removed, and the update will NOT be added.")
-                    keys_to_remove_chunks_for.discard(s3_key) # Remove from deletion list
-            # else: File exists in both and version matches -> No action needed
-
-        # Identify Deleted Files
-        print("  Checking for files deleted from S3...")
-        keys_deleted_from_s3 = processed_keys_in_db - current_keys_in_s3
-        if keys_deleted_from_s3:
-            print(f"    - {len(keys_deleted_from_s3)} file(s) deleted from S3 detected:")
-            for key in keys_deleted_from_s3:
-                print(f"      - {key}")
-            # Mark these keys for chunk removal as well
-            keys_to_remove_chunks_for.update(keys_deleted_from_s3)
-        else:
-            print("    No files found deleted from S3.")
-
-        # --- Perform DB Modifications ---
-        db_changed = False
-
-        # 6. Deletions (Perform first)
-        if keys_to_remove_chunks_for:
-            print(f"\n  Removing chunks for {len(keys_to_remove_chunks_for)} updated/deleted S3 keys...")
-            ids_to_delete = []
-            try:
-                # Build a ChromaDB 'where' filter to find all chunks associated with these keys
-                # Example using $or or iterating if $in isn't directly supported for metadata keys in older versions
-                # Using where filter which is standard:
-                where_filter = {config.S3_KEY_METADATA_KEY: {"$in": list(keys_to_remove_chunks_for)}}
-
-                # Get the IDs of the documents matching the filter
-                print(f"    Querying for chunk IDs to delete with filter: {where_filter}...")
-                existing_data = vs.get(where=where_filter, include=[]) # Only need IDs, not content/metadata
-
-                if existing_data and existing_data.get('ids'):
-                    ids_to_delete = existing_data['ids']
-                    if ids_to_delete:
-                        print(f"    Deleting {len(ids_to_delete)} chunk IDs...")
-                        vs.delete(ids=ids_to_delete)
-                        print("    Deletion successful.")
-                        db_changed = True
-                    else:
-                        # This case might happen if keys were marked but chunks were already gone somehow
-                        print("    No matching chunk IDs found for deletion (might have been deleted previously).")
-                else:
-                    print("    No existing chunks found for keys marked for deletion.")
-            except Exception as e:
-                print(f"    WARNING: Error querying or deleting old chunks: {e}. Some outdated data might remain.")
-                traceback.print_exc()
-        else:
-            print("\n  No chunks require deletion.")
-
-
-        # 7. Additions (Perform after deletions)
-        if chunks_to_add:
-            print(f"\n  Adding {len(chunks_to_add)} new/updated chunks to ChromaDB...")
-            try:
-                # Add documents in batches if list is very large (Chroma handles reasonably large lists well)
-                # batch_size = 500
-                # for i in range(0, len(chunks_to_add), batch_size):
-                #     batch = chunks_to_add[i:i + batch_size]
-                #     vs.add_documents(batch)
-                #     print(f"    Added batch {i//batch_size + 1}...")
-                # Simpler addition for typical cases:
-                vs.add_documents(chunks_to_add)
-                print("  Addition successful.")
-                db_changed = True
-            except Exception as e:
-                print(f"    WARNING: Error adding new/updated chunks to ChromaDB: {e}")
-                print(f"    Some processed files might not be available for search. Consider re-sync or rebuild if errors persist.")
-                traceback.print_exc()
-        else:
-             print("\n  No new or updated chunks require adding.")
-
-
-        # 8. Persist Changes (if any deletions or additions occurred)
-        if db_changed:
-            print("\n  Persisting ChromaDB changes...")
-            try:
-                vs.persist()
-                print("  ChromaDB changes persisted successfully.")
-            except Exception as e:
-                print(f"  WARNING: Failed to persist ChromaDB changes: {e}")
-                traceback.print_exc()
-        else:
-            print("\n  No changes made to ChromaDB during sync.")
-
-        print(f"\n--- S3 Synchronization Summary ---")
-        print(f"  New files processed: {new_files_processed}")
-        print(f"  Updated files processed: {updated_files_processed}")
-        print(f"  Files deleted from S3: {len(keys_deleted_from_s3)}")
-        print(f"  Chunks added: {len(chunks_to_add)}")
-        print(f"  S3 Keys whose chunks were removed: {len(keys_to_remove_chunks_for)}")
-        print(f"--- S3 Synchronization Complete ---")
+        replay_ingest_log(vs)
+        sync_with_s3(vs, s3_client)
 
     elif not vs:
         # This case should ideally be caught earlier by exit(1)
@@ -491,21 +1536,260 @@ def initialize_vector_store(force_rebuild=False):
         print("\nFATAL ERROR: Vector store could not be initialized or loaded after all steps.")
         exit(1)
 
+    _apply_embedding_state(vs, state)
+    try:
+        ensure_document_index(vs)
+    except Exception as e:
+        print(f"  WARNING: Failed to build the document index: {e}. Retrieval falls back to a single stage.")
+        traceback.print_exc()
     vector_store = vs # Assign to the module global
+    embeddings = vs.embeddings
+    publish_index(wait=True) # Writer role: readers pick up the synced index
     print("\n--- Vector Store Initialization Complete ---")
     return vector_store # Return the instance for the main app
 
 
+def _apply_embedding_state(vs, state):
+    """
+    Records the active embedding model in the DB directory and drops
+    collections of other models (left by a finished migration). Collections of
+    an interrupted migration are kept so restarting it reuses their vectors.
+    """
+    global embedding_state
+    if state["model"] != config.EMBEDDING_MODEL:
+        print(f"  NOTE: The index is embedded with '{state['model']}' (config.EMBEDDING_MODEL is "
+              f"'{config.EMBEDDING_MODEL}'). Use an embedding migration to switch models without a rebuild.")
+    keep_suffix = shard_store.collection_suffix_for_model(state["migrating_to"]) if state.get("migrating_to") else None
+    if keep_suffix:
+        print(f"  An embedding migration to '{state['migrating_to']}' did not finish. "
+              "Start it again to resume; vectors it already stored are reused.")
+    for name in vs.foreign_collections():
+        if keep_suffix and name.endswith(keep_suffix):
+            continue
+        print(f"  Dropping collection '{name}' of a retired embedding model...")
+        try:
+            vs.client.delete_collection(name)
+        except Exception as e:
+            print(f"    WARNING: Could not delete collection '{name}': {e}")
+    save_embedding_state(vs.persist_directory, state)
+    embedding_state = state
+
+# --- Embedding Model Migration (see embedding_migration.py) ---
+
+def begin_migration_writes(target_store):
+    """Mirrors every later write to `target_store` and records the migration in the state file."""
+    global migration_target, embedding_state
+    with write_lock:
+        migration_target = target_store
+        state = embedding_state or load_embedding_state(target_store.persist_directory)
+        embedding_state = dict(state, migrating_to=target_store.embeddings.model)
+        save_embedding_state(target_store.persist_directory, embedding_state)
+
+def end_migration_writes():
+    """Stops mirroring writes (migration failed or was abandoned); its collections stay for a retry."""
+    global migration_target
+    with write_lock:
+        migration_target = None
+
+def switch_embedding_model(target_store):
+    """
+    Makes a fully back-filled and reconciled migration target the active
+    index. The caller holds write_lock. New chains use the new store; chains
+    already running finish on the old one, whose collections are dropped after
+    config.MIGRATION_RETIRE_DELAY seconds.
+    """
+    global vector_store, embeddings, embedding_state, migration_target
+    old_store = vector_store
+    state = {"model": target_store.embeddings.model, "suffix": target_store.collection_suffix, "migrating_to": None}
+    save_embedding_state(target_store.persist_directory, state) # Durable switch: a restart opens the new collections
+    vector_store, embeddings, embedding_state = target_store, target_store.embeddings, state
+    migration_target = None
+    bump_corpus_version()
+    publish_index()
+    print(f"  Retrieval switched to embedding model '{state['model']}'.")
+    if old_store is not None and old_store is not target_store:
+        timer = threading.Timer(config.MIGRATION_RETIRE_DELAY, _retire_store, args=(old_store,))
+        timer.daemon = True
+        timer.start()
+
+def _retire_store(old_store):
+    with write_lock:
+        if old_store is vector_store:
+            return
+        for name in old_store.shard_names():
+            old_store.drop_shard(name)
+        old_store.drop_document_index()
+        print(f"  Dropped the collections of retired embedding model '{old_store.embeddings.model}'.")
+        publish_index() # Later snapshots no longer carry the old vectors
+
+
 # --- Chat Chain Creation ---
 
-def get_chat_chain(vs, llm_model_name, chat_history_messages):
+class ThinkingStrippedOutputParser(StrOutputParser):
+    """Plain-text output without reasoning blocks (a reasoning model's condensed question is only the question)."""
+
+    def parse(self, text):
+        return streaming_handler.strip_thinking(text)
+
+# Both chat prompts start with the same instructions followed by the history,
+# which only ever grows by appending turns. That prefix is byte-identical for
+# the condense call, the answer call and the next turn's calls, so Ollama can
+# reuse its KV cache and only prefill the per-request tail (context, question).
+CHAT_PROMPT_PREFIX = """You are a helpful AI assistant with expertise in cryptography. You're having a conversation with a human user.
+
+IMPORTANT INSTRUCTIONS:
+
+1) ANALYZE THE USER'S MESSAGE:
+   * Is it a casual greeting/chat (like "hello", "thanks", "how are you")?
+   * Is it a question or discussion about cryptography?
+   * Is it something else entirely?
+
+2) FOR CASUAL CONVERSATION:
+   * Respond naturally and conversationally
+   * Do NOT include any citations
+   * Be friendly, concise, and engaging
+   * Never mention the "context documents" for casual chat
+
+3) FOR CRYPTOGRAPHY QUESTIONS:
+   * First check if the provided CONTEXT DOCUMENTS contain relevant information
+   * If they do, base your answer primarily on this information
+   * Add citations ONLY when directly using information from the documents
+   * Format citations as: [Source: URL] at the end of the relevant sentence (use the URL from the SOURCE field of the document)
+   * If the context does not contain the answer, clearly state this and then provide a general response based on your knowledge of cryptography
+   * Only cite sources that you actually use information from. Avoid citing unused sources.
+
+4) TONE GUIDELINES:
+   * Be conversational and friendly in all responses
+   * Avoid overly formal academic language unless answering technical questions
+   * Don't overuse citations - only add them when directly referencing document content
+   * For simple questions, keep answers concise
+   * For complex topics, provide more thorough explanations
+
+Chat History:
+{chat_history}
+"""
+
+QA_PROMPT_TEMPLATE = CHAT_PROMPT_PREFIX + """
+CONTEXT DOCUMENTS:
+{context}
+
+User Message: {question}
+
+Your response:"""
+
+CONDENSE_QUESTION_PROMPT_TEMPLATE = CHAT_PROMPT_PREFIX + """
+CURRENT STEP: Do not answer yet. Given the chat history above and a new input from the user, create a standalone question that captures the user's core intent for information retrieval.
+
+If the new input is a simple greeting, confirmation ("ok", "thanks"), or casual chat that doesn't require retrieving documents, return it unchanged.
+If it's a follow-up question related to the topic (e.g., cryptography), reformulate it to be self-contained, incorporating necessary context from the history. Make it suitable for querying a vector database.
+
+New Input: {question}
+
+Standalone question (or unchanged input if casual):"""
+
+# Budget per retrieved chunk when sizing num_ctx: the chunk (token-sized, or ~3 characters per token for the
+# character splitter) plus the SOURCE line and separator
+_CONTEXT_TOKENS_PER_CHUNK = (config.CHUNK_TOKENS if config.TEXT_SPLITTER == "structure" else config.CHUNK_SIZE // 3) + 50
+
+def estimate_num_ctx(llm_model_name, chat_history_messages, question, k):
+    """
+    num_ctx for one chat turn, from the token count of the largest prompt it
+    sends (the QA prompt with `k` retrieved chunks) plus room for the answer.
+    """
+    prompt_tokens = (
+        token_counter.count_tokens(CHAT_PROMPT_PREFIX)
+        + token_counter.count_tokens(history_compactor.format_chat_history(chat_history_messages))
+        + token_counter.count_tokens(question)
+        + k * _CONTEXT_TOKENS_PER_CHUNK
+    )
+    reserve = config.NUM_PREDICT_RESERVE
+    if llm_model_name == config.REASONING_LLM_MODEL:
+        reserve += config.THINKING_TOKEN_BUDGET
+    return token_counter.num_ctx_for(llm_model_name, prompt_tokens, reserve)
+
+def scope_owner_keys(scope_keys):
+    """
+    Stored chunks carry their owner's key, so a scope has to be filtered on the
+    owners of every chunk it references (usually the scope keys themselves).
+    """
+    owner_keys = registry.owner_keys_for(scope_keys) if registry else set()
+    return sorted(owner_keys or scope_keys)
+
+def build_scope_filter(s3_keys):
+    """Chroma `where` filter restricting a search to chunks stored under the given S3 keys."""
+    if len(s3_keys) == 1:
+        return {config.S3_KEY_METADATA_KEY: s3_keys[0]}
+    return {config.S3_KEY_METADATA_KEY: {"$in": list(s3_keys)}}
+
+def search_filter_for_keys(s3_keys):
+    """
+    Retriever arguments that restrict the chunk search to the chunks
+    referenced by `s3_keys`: a `where` filter on their owners, the shards
+    holding them, and (when some owners are outside the keys) an allowed-ID set.
+    """
+    chunk_ids = chunk_index.chunk_ids(s3_keys)
+    owner_keys = scope_owner_keys(s3_keys)
+    search_filter = {
+        'where': build_scope_filter(owner_keys),
+        # Only the shards holding the keys' chunks are searched
+        'shard_names': sorted({shard_store.shard_for_key(k) for k in owner_keys}),
+        'allowed_ids': None,
+        'chunk_count': len(chunk_ids),
+    }
+    if set(owner_keys) - set(s3_keys):
+        # Some shared chunks are owned by keys outside the set: drop those owners' other chunks
+        search_filter['allowed_ids'] = chunk_ids
+    return search_filter
+
+def build_retriever(vs, llm_model_name, scope_keys=None, k=None, use_query_cache=True, use_result_cache=True):
+    """
+    The chat retriever for `vs`: top `k` chunks (config.RETRIEVER_K by default)
+    after the document stage, scope push-down, near-duplicate collapsing and
+    MMR re-ranking with the settings of `llm_model_name`. Results are cached
+    per corpus version (retrieval_cache) unless `use_result_cache` is False.
+    """
+    # Configure retriever (e.g., number of documents 'k')
+    k = k or config.RETRIEVER_K
+    retriever_kwargs = {'k': k} # Retrieve top k relevant chunks
+    # Diversity re-ranking (MMR + per-source cap) over a larger candidate pool, tunable per model
+    mmr = {"lambda": config.MMR_LAMBDA, "fetch_k": config.MMR_FETCH_K, "max_per_source": config.MMR_MAX_PER_SOURCE}
+    mmr.update(config.MMR_SETTINGS_BY_MODEL.get(llm_model_name, {}))
+    retriever_kwargs.update(mmr_lambda=mmr["lambda"], fetch_k=max(config.RETRIEVER_FETCH_K, mmr["fetch_k"], k),
+                            max_per_source=mmr["max_per_source"])
+    if scope_keys:
+        # Push the scope down into the vector search; never ask for more chunks than the scope holds
+        scope_filter = search_filter_for_keys(scope_keys)
+        retriever_kwargs['k'] = max(1, min(k, scope_filter.pop('chunk_count')))
+        retriever_kwargs.update(scope_filter)
+        print(f"    Retrieval scoped to {len(scope_keys)} S3 key(s), k={retriever_kwargs['k']}.")
+    if config.DOC_RETRIEVAL_TOP_N and (not scope_keys or len(scope_keys) > config.DOC_RETRIEVAL_TOP_N):
+        # Coarse stage: pick the closest documents first, then search only their chunks
+        retriever_kwargs['document_top_n'] = config.DOC_RETRIEVAL_TOP_N
+        retriever_kwargs['document_where'] = build_scope_filter(scope_keys) if scope_keys else None
+        retriever_kwargs['search_filter_for'] = search_filter_for_keys
+    # Collapses near-duplicate hits and lists every key that shares a chunk
+    return retrieval_handler.CorpusRetriever(
+        vectorstore=vs,
+        source_keys_for=registry.keys_for_chunks if registry else None,
+        expand_metadata=expand_chunk_metadata,
+        embed_query=query_embedding_cache.query_cache.embed_query if use_query_cache else None,
+        result_cache=retrieval_cache.result_cache if use_result_cache and config.RETRIEVAL_CACHE_ENABLED else None,
+        corpus_version=corpus_version,
+        current_corpus_version=lambda: corpus_version,
+        **retriever_kwargs
+    )
+
+def get_chat_chain(vs, llm_model_name, chat_history_messages, scope_keys=None, question=None):
     """
     Creates and returns a ConversationalRetrievalChain instance for handling chat requests.
 
     Args:
-        vs: The initialized Chroma vector store instance.
+        vs: The initialized vector store (shard_store.ShardedStore).
         llm_model_name: The name of the Ollama model to use (e.g., config.DEFAULT_LLM_MODEL).
-        chat_history_messages: A list of Langchain BaseMessage objects representing the conversation history.
+        chat_history_messages: A list of Langchain BaseMessage objects representing the conversation history
+            (already compacted: an optional summary SystemMessage followed by recent turns).
+        scope_keys: Optional list of resolved S3 keys; retrieval is pushed down to only their chunks.
+        question: The user's message, used to size the model's context window (num_ctx).
 
     Returns:
         A configured ConversationalRetrievalChain instance, or None if an error occurs.
@@ -517,9 +1801,13 @@ def get_chat_chain(vs, llm_model_name, chat_history_messages):
 
     # 1. Initialize LLM
     try:
-        print(f"    Initializing LLM: {llm_model_name}")
+        # Both steps share one num_ctx: a different value would make Ollama reload the model
+        num_ctx = estimate_num_ctx(llm_model_name, chat_history_messages, question, config.RETRIEVER_K)
+        print(f"    Initializing LLM: {llm_model_name} (num_ctx={num_ctx})")
         # Adjust temperature or other parameters as needed
-        llm = ChatOllama(model=llm_model_name, temperature=0.2)
+        llm = ChatOllama(model=llm_model_name, temperature=0.2, num_ctx=num_ctx)
+        # Separate instance for the answer step, tagged so streamed tokens can be told apart
+        answer_llm = ChatOllama(model=llm_model_name, temperature=0.2, num_ctx=num_ctx, tags=[streaming_handler.ANSWER_LLM_TAG])
     except Exception as e:
          print(f"  ERROR: Failed to initialize LLM '{llm_model_name}': {e}")
          traceback.print_exc()
@@ -542,11 +1830,7 @@ def get_chat_chain(vs, llm_model_name, chat_history_messages):
     # 3. Initialize Retriever
     print("    Initializing Retriever from vector store...")
     try:
-        # Configure retriever (e.g., number of documents 'k')
-        retriever = vs.as_retriever(
-            search_type="similarity", # Or "mmr", "similarity_score_threshold"
-            search_kwargs={'k': 5} # Retrieve top 5 relevant chunks
-            )
+        retriever = build_retriever(vs, llm_model_name, scope_keys)
     except Exception as e:
          print(f"  ERROR: Failed to create retriever from vector store: {e}")
          traceback.print_exc()
@@ -561,68 +1845,12 @@ def get_chat_chain(vs, llm_model_name, chat_history_messages):
         f"DOCUMENT: {{page_content}}\nSOURCE: {{{config.S3_URL_METADATA_KEY}}}"
     )
 
-    # Prompt for the QA step, combining context, history, and question
-    print("    Defining main QA prompt...")
-    # Using the detailed template from the original app.py
-    QA_PROMPT_TEMPLATE = """You are a helpful AI assistant with expertise in cryptography. You're having a conversation with a human user.
-
-IMPORTANT INSTRUCTIONS:
-
-1) ANALYZE THE USER'S MESSAGE:
-   * Is it a casual greeting/chat (like "hello", "thanks", "how are you")?
-   * Is it a question or discussion about cryptography?
-   * Is it something else entirely?
-
-2) FOR CASUAL CONVERSATION:
-   * Respond naturally and conversationally
-   * Do NOT include any citations
-   * Be friendly, concise, and engaging
-   * Never mention the "context documents" for casual chat
-
-3) FOR CRYPTOGRAPHY QUESTIONS:
-   * First check if the provided CONTEXT DOCUMENTS contain relevant information
-   * If they do, base your answer primarily on this information
-   * Add citations ONLY when directly using information from the documents
-   * Format citations as: [Source: URL] at the end of the relevant sentence (use the URL from the SOURCE field of the document)
-   * If the context does not contain the answer, clearly state this and then provide a general response based on your knowledge of cryptography
-   * Only cite sources that you actually use information from. Avoid citing unused sources.
-
-4) TONE GUIDELINES:
-   * Be conversational and friendly in all responses
-   * Avoid overly formal academic language unless answering technical questions
-   * Don't overuse citations - only add them when directly referencing document content
-   * For simple questions, keep answers concise
-   * For complex topics, provide more thorough explanations
-
-Chat History:
-{chat_history}
-
-CONTEXT DOCUMENTS:
-{context}
-
-User Message: {question}
-
-Your response:"""
-
+    # Prompts for the QA and condense steps (module-level templates sharing one prefix)
+    print("    Defining main QA prompt and condense question prompt...")
     QA_PROMPT = PromptTemplate(
         input_variables=["chat_history", "context", "question"], # Ensure these match the variables used in the template
         template=QA_PROMPT_TEMPLATE,
     )
-
-    # Prompt to condense the user's input and chat history into a standalone question
-    print("    Defining condense question prompt...")
-    CONDENSE_QUESTION_PROMPT_TEMPLATE = """Given the conversation history and a new input from the user, create a standalone question that captures the user's core intent for information retrieval.
-
-If the new input is a simple greeting, confirmation ("ok", "thanks"), or casual chat that doesn't require retrieving documents, return it unchanged.
-If it's a follow-up question related to the topic (e.g., cryptography), reformulate it to be self-contained, incorporating necessary context from the history. Make it suitable for querying a vector database.
-
-Conversation History:
-{chat_history}
-
-New Input: {question}
-
-Standalone question (or unchanged input if casual):"""
-
     CONDENSE_QUESTION_PROMPT = PromptTemplate.from_template(CONDENSE_QUESTION_PROMPT_TEMPLATE)
 
     # 5. Construct the Chain Components
@@ -632,13 +1860,14 @@ Standalone question (or unchanged input if casual):"""
     question_generator_chain = LLMChain(
         llm=llm,
         prompt=CONDENSE_QUESTION_PROMPT,
+        output_parser=ThinkingStrippedOutputParser(), # The standalone question is embedded and shown to the answer step
         verbose=False # Set to True for debugging this step
         )
 
     # LLM Chain to answer the question using the formatted context
     print("    Building answer generation chain...")
     answer_chain = LLMChain(
-        llm=llm,
+        llm=answer_llm,
         prompt=QA_PROMPT,
         verbose=False # Set to True for debugging this step
         )
@@ -661,9 +1890,11 @@ Standalone question (or unchanged input if casual):"""
             question_generator=question_generator_chain, # Component to create standalone question
             combine_docs_chain=combine_docs_chain, # Component to stuff docs and generate answer
             memory=memory,                        # Component to manage chat history (for this request)
+            get_chat_history=history_compactor.format_chat_history, # Summary of older turns + recent turns
             return_source_documents=True,         # Include retrieved source documents in the output
             # return_generated_question=True,     # Optional: Include the condensed question in output for debugging
             output_key='answer',                  # Specifies the key for the final answer in the output dict
+            metadata={"num_ctx": num_ctx},        # Shared by every LLM call of the turn (e.g. a forced answer)
             verbose=False                         # Set to True for detailed logging of the entire chain execution
         )
         print("  LangChain ConversationalRetrievalChain created successfully.")
@@ -0,0 +1,12 @@
+# wsgi.py
+"""
+WSGI entry point for running several serving workers, e.g.:
+
+    INDEX_ROLE=reader gunicorn -w 4 -k gthread --threads 8 wsgi:app
+
+Each worker initializes on import. Run exactly one `INDEX_ROLE=writer python app.py`
+alongside them to own uploads and S3 sync; route upload requests to it.
+"""
+from app import app, initialize_app
+
+initialize_app()